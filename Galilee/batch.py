@@ -0,0 +1,105 @@
+"""
+批量同步的通用工具
+按块切分、按key合并、逐项校验和整理结果，AD域和vCenter的批量同步共用，不依赖具体的应用
+"""
+import copy
+from itertools import islice
+from django.core.exceptions import ValidationError
+from django.db.models import PositiveIntegerField, PositiveSmallIntegerField
+
+POSITIVE_FIELDS = (PositiveIntegerField, PositiveSmallIntegerField)
+
+
+def chunked(iterable, size):
+    """ 将可迭代对象按size切分成列表 """
+    iterator = iter(iterable)
+    while True:
+        chunk = list(islice(iterator, size))
+        if not chunk:
+            return
+        yield chunk
+
+
+def merge_rows(rows, key):
+    """ 按key合并行，同一对象出现多次时后面的字段覆盖前面的 """
+    merged = {}
+    for row in rows:
+        merged.setdefault(row[key], {}).update(row)
+    return merged
+
+
+def batch_results(items, key, errors, res):
+    """
+    按提交顺序整理批量同步每一项的结果
+    :return [{key: "...", "status": "created/updated/error", "msg": "..."}]
+    """
+    status = dict.fromkeys(res['created'], 'created')
+    status.update(dict.fromkeys(res['updated'], 'updated'))
+    results = []
+    for index, item in enumerate(items):
+        if index in errors:
+            results.append({key: item.get(key) if isinstance(item, dict) else None, 'status': 'error', 'msg': errors[index]})
+        else:
+            results.append({key: item[key], 'status': status[item[key]]})
+    return results
+
+
+def check_items(items, key, allowed):
+    """ 检查批量提交的每一项，返回 {序号: 错误信息} """
+    errors = {}
+    for index, item in enumerate(items):
+        if not isinstance(item, dict) or not item.get(key):
+            errors[index] = "缺少 " + key
+            continue
+        unknown = set(item) - set(allowed)
+        if unknown:
+            errors[index] = "参数中包含不可同步的内容 key:" + ",".join(sorted(unknown))
+    return errors
+
+
+def validate_rows(model, rows, key, skip_choices=()):
+    """
+    按模型字段校验批量提交的每一行，校验通过后将值转换为字段类型写回行中
+    已存在的对象只校验提交的字段，新对象还要校验必填字段；唯一性由upsert按key处理，不在这里校验
+    :param rows: {序号: 行}
+    :param skip_choices: 不按choices校验的字段，例如按位组合的userAccountControl
+    :return {序号: 错误信息}
+    """
+    fields = {field.name: field for field in model._meta.concrete_fields}   # pylint: disable=protected-access
+    existing = model.objects.in_bulk([row[key] for row in rows.values()], field_name=key)
+    errors = {}
+    for index, row in rows.items():
+        submitted = [name for name in row if name in fields]
+        base = existing.get(row[key])   # 同一批中重复的key与upsert一样合并，在前一项的基础上校验
+        obj = copy.copy(base) if base is not None else model()
+        for name in submitted:
+            setattr(obj, name, row[name])
+        exclude = list(skip_choices)
+        if base is not None:
+            exclude += [name for name in fields if name not in submitted]
+        else:   # 新对象未提交的字段中，允许为空或有默认值的不需要校验
+            exclude += [name for name, field in fields.items() if name not in submitted and (field.null or field.has_default())]
+        try:
+            obj.full_clean(exclude=exclude, validate_unique=False)
+            for name in skip_choices:
+                if name in row:
+                    try:
+                        value = fields[name].to_python(row[name])
+                        fields[name].run_validators(value)
+                    except ValidationError as ept:   # 单个字段的错误没有字段名，补上后与full_clean的错误一起整理
+                        raise ValidationError({name: ept.messages})
+                    setattr(obj, name, value)
+            invalid = {name: ["不能为空"] for name, field in fields.items() if name not in exclude and getattr(obj, field.attname) is None
+                       and not field.null and field.editable and not field.primary_key}
+            # Django 3.0的PositiveIntegerField没有最小值校验，负数要到写入时才被数据库的CHECK约束拒绝
+            invalid.update({name: ["不能为负数"] for name in submitted if isinstance(fields[name], POSITIVE_FIELDS)
+                            and getattr(obj, name) is not None and getattr(obj, name) < 0})
+            if invalid:
+                raise ValidationError(invalid)
+        except ValidationError as ept:
+            errors[index] = "; ".join("%s: %s" % (name, ",".join(messages)) for name, messages in ept.message_dict.items())
+            continue
+        for name in submitted:
+            row[name] = getattr(obj, name)
+        existing[row[key]] = obj
+    return errors
@@ -152,6 +152,51 @@ VMMANGE = {
     'VM_POWERON': True,  # 分配虚拟机电源状态
     "DNS": ['127.0.0.1', '127.0.0.1'], # 虚拟机配置的DNS地址
     "VM_HOSTNAME_PREFIX": "test",  # 分配虚拟机的主机名前缀
+    'SESSION_POOL_SIZE': 2,  # 进程内保持的vCenter会话数
+    'SESSION_KEEPALIVE': 600,  # 会话保活间隔秒数，需小于vCenter会话空闲超时
+    'INVENTORY_TTL': 300,  # 名称->对象索引缓存秒数
+    'INVENTORY_MIN_REFRESH': 10,  # 查找不到时索引超过该秒数则重新加载
+    'INVENTORY_PAGE_SIZE': 1000,  # RetrievePropertiesEx每页对象数
+    'WATCH_MAX_WAIT': 60,  # 增量同步每次WaitForUpdatesEx最长等待秒数
+    'WATCH_MAX_OBJECTS': 500,  # 增量同步每次最多返回的对象数
+    'TASK_TIMEOUT': 3600,  # 等待vCenter任务的默认超时秒数，超时后取消任务
+    'TASK_POLL_WAIT': 5,  # 有任务时每次WaitForUpdatesEx最长等待秒数
+    'TASK_RETENTION': 3600,  # 已结束任务保留多少秒供查询
+    'TASK_RETRY_MAX': 60,  # 连接vCenter失败后重试的最长间隔秒数
+}
+
+# AD域连接池
+
+LDAP_POOL = {
+    'SIZE': 10,  # 每个进程最多保持的已绑定连接数
+    'TIMEOUT': 10,  # 连接全部被占用时等待的秒数
+    'CHECK_INTERVAL': 60,  # 连接空闲超过该秒数，借出前做健康检查
+    'MAX_LIFETIME': 3600,  # 连接最长存活秒数
+}
+
+# AD域schema缓存
+
+LDAP_SCHEMA = {
+    'CACHE_DIR': os.path.join(BASE_DIR, 'cache', 'ldap_schema'),   # AD域schema缓存文件目录
+    'TTL': 86400,          # 缓存超过该秒数后在后台刷新
+    'RETRY_INTERVAL': 60,  # 下载失败后重试间隔
+}
+
+# AD域控健康评分和熔断
+
+LDAP_HEALTH = {
+    'FAILURE_THRESHOLD': 3,  # 连续失败该次数后熔断
+    'BACKOFF_BASE': 5,  # 第一次熔断秒数，探测失败后翻倍
+    'BACKOFF_MAX': 300,  # 最长熔断秒数
+    'ERROR_WINDOW': 50,  # 计算错误率的最近请求数
+}
+
+# AD域账号验证
+
+LDAP_AUTH = {
+    'MAX_WORKERS': 20,  # 同时进行验证的最大线程数
+    'PER_SERVER': 5,  # 每台域控同时进行的绑定数
+    'TIMEOUT': 5,  # 一次验证的总超时秒数
 }
 
 # Logging
@@ -11,9 +11,11 @@ router.register('users', infox_views.UserViewSet, 'user')
 router.register('groups', infox_views.GroupViewSet, 'groups')
 router.register('userinfo', infox_views.UserinfoViewSet, 'userinfo')
 router.register('orginfo', infox_views.OrginfoViewSet, 'orginfo')
+router.register('groupinfo', infox_views.GroupinfoViewSet, 'groupinfo')
 router.register('assist', assist_views.AssistViewSet, 'assist')
 router.register('vminfo', vm_views.VminfoViewSet, 'vminfo')
 router.register('check_auth', infox_views.CheckAuthViewSet, 'check_auth')
+router.register('metrics', infox_views.MetricsViewSet, 'metrics')
 
 
 urlpatterns = [
@@ -3,3 +3,6 @@ from django.apps import AppConfig
 
 class InfoxConfig(AppConfig):
     name = 'infox'
+
+    def ready(self):
+        import infox.signals   # pylint: disable=unused-import,import-outside-toplevel
@@ -0,0 +1,17 @@
+"""
+为增加path字段之前已有的OU和用户生成物化路径，升级后执行一次
+python manage.py backfill_path
+"""
+from django.core.management.base import BaseCommand
+from infox.utils.ldap_sync import backfill_paths
+
+
+class Command(BaseCommand):
+    help = "为path为空的OU和用户按dn生成物化路径，用于部门子树查询"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--chunk-size', type=int, default=500, help="每批写入数据库的条数")
+
+    def handle(self, *args, **options):
+        res = backfill_paths(chunk_size=options['chunk_size'])
+        self.stdout.write(self.style.SUCCESS("生成物化路径 OU:%(orgs)s 用户:%(users)s" % res))
@@ -0,0 +1,30 @@
+"""
+从CSV/JSON文件批量导入新员工到AD域和数据库
+python manage.py import_users interns.csv --chunk-size 100
+CSV表头: name,sAMAccountName,pwd,deptId,mail,telephoneNumber   deptId为部门objectGUID
+"""
+from django.core.management.base import BaseCommand, CommandError
+from infox.utils.user_import import UserImporter, read_rows
+
+
+class Command(BaseCommand):
+    help = "批量导入新员工，AD域新增使用异步连接流水线发送"
+
+    def add_arguments(self, parser):
+        parser.add_argument('path', help="CSV或JSON文件路径")
+        parser.add_argument('--chunk-size', type=int, default=100, help="每批发送到AD域和写入数据库的条数")
+
+    def progress(self, done, total):
+        self.stdout.write("进度 %s/%s" % (done, total))
+
+    def handle(self, *args, **options):
+        try:
+            with open(options['path'], 'rb') as fileobj:
+                rows = read_rows(fileobj.read(), options['path'])
+        except (OSError, ValueError) as ept:
+            raise CommandError("读取文件失败 %s" % ept)
+        res = UserImporter(chunk_size=options['chunk_size'], progress=self.progress).run(rows)
+        for row in res['results']:
+            if not row['status']:
+                self.stdout.write(self.style.ERROR("第%(row)s行 %(sAMAccountName)s: %(msg)s" % row))
+        self.stdout.write(self.style.SUCCESS("导入完成 成功:%s 失败:%s 耗时 %ss" % (res['created'], res['total'] - res['created'], res['elapsed'])))
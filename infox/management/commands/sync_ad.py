@@ -0,0 +1,35 @@
+"""
+将AD域用户、OU批量同步到数据库
+python manage.py sync_ad --type active --chunk-size 500
+python manage.py sync_ad --incremental    # 只同步上次同步之后变更、删除的对象
+"""
+from django.core.management.base import BaseCommand, CommandError
+from infox.utils.opt_ldap import OptLdap, AD_SERVER_POOL
+from infox.utils.ldap_sync import AdSync, IncrementalAdSync
+
+
+class Command(BaseCommand):
+    help = "分页读取AD域中的OU和用户，批量同步到数据库"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--type', dest='get_type', default='active', choices=['active', 'all', 'leaved'], help="同步的用户范围")
+        parser.add_argument('--chunk-size', type=int, default=500, help="每批写入数据库的条数")
+        parser.add_argument('--page-size', type=int, default=500, help="LDAP分页查询每页条数")
+        parser.add_argument('--incremental', action='store_true', help="基于uSNChanged增量同步")
+        parser.add_argument('--server', help="增量同步固定使用的域控地址，默认使用连接池")
+
+    def handle(self, *args, **options):
+        server = None
+        if options['server']:
+            server = next((i for i in AD_SERVER_POOL if i.host == options['server']), None)
+            if server is None:
+                raise CommandError("AD_SERVER_POOL中没有该域控 " + options['server'])
+        sync_class = IncrementalAdSync if options['incremental'] else AdSync
+        with OptLdap(server=server) as opt_ldap:
+            res = sync_class(opt_ldap, chunk_size=options['chunk_size'], page_size=options['page_size']).run(get_type=options['get_type'])
+        self.stdout.write("OU 新增:%(created)s 更新:%(updated)s" % res['orgs'])
+        self.stdout.write("用户 新增:%(created)s 更新:%(updated)s" % res['users'])
+        if options['incremental']:
+            self.stdout.write("域控:%s USN:%s -> %s 删除OU:%s 删除用户:%s" % (res['server'], res['usn'][0], res['usn'][1], res['orgs']['deleted'] + res['tombstones']['orgs'],
+                                                                         res['users']['deleted'] + res['tombstones']['users']))
+        self.stdout.write(self.style.SUCCESS("同步完成，耗时 %ss" % res['elapsed']))
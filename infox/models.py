@@ -4,9 +4,75 @@
 import datetime
 import logging
 from django.db import models
+from ldap3.utils.dn import parse_dn
+from ldap3.core.exceptions import LDAPInvalidDnError
 
 model_logger = logging.getLogger("galilee")
 
+def dn_to_path(dn):
+    """
+    将DN转换为从根开始的物化路径，用于按前缀查询子树
+    'CN=张三,OU=IT组,DC=sh,DC=com' -> '/dc=com/dc=sh/ou=it组/cn=张三/'
+    """
+    if not dn:
+        return ''
+    try:
+        rdns = ["%s=%s" % (attr, value) for attr, value, _ in parse_dn(dn, escape=False, strip=True)]
+    except LDAPInvalidDnError:
+        rdns = [i.strip() for i in dn.split(",")]
+    rdns = [i.lower().replace('%', '%25').replace('/', '%2F') for i in reversed(rdns)]
+    return '/' + '/'.join(rdns) + '/'
+
+# userAccountControl中的标志位，用于?flags=过滤
+UAC_FLAGS = {
+    'script': 0x1,
+    'disabled': 0x2,
+    'homedir_required': 0x8,
+    'locked': 0x10,
+    'passwd_notreqd': 0x20,
+    'passwd_cant_change': 0x40,
+    'encrypted_text_pwd_allowed': 0x80,
+    'normal_account': 0x200,
+    'pwd_never_expires': 0x10000,
+    'smartcard_required': 0x40000,
+    'not_delegated': 0x100000,
+    'dont_req_preauth': 0x400000,
+    'password_expired': 0x800000,
+}
+
+# get_status显示的标志，按位从高到低
+UAC_LABELS = [
+    (0x800000, '密码已过期'),
+    (0x10000, '密码永不过期'),
+    (0x40, '用户不可更改密码(只读)'),
+    (0x20, '下次登录修改密码'),
+    (0x10, '用户被锁定'),
+    (0x2, '用户已禁用'),
+]
+
+# 按字节预先计算的标志表，_UAC_BYTE_TABLES[i][b]为第i个字节(从高到低)取值为b时的标志
+_UAC_BYTE_TABLES = [
+    [tuple(label for bit, label in UAC_LABELS if (bit >> shift) & 0xFF & value) for value in range(256)]
+    for shift in (24, 16, 8, 0)
+]
+
+def decode_account_control(value):
+    """ 通过查表解析userAccountControl，返回标志说明的元组 """
+    value = int(value)
+    return (_UAC_BYTE_TABLES[0][(value >> 24) & 0xFF] + _UAC_BYTE_TABLES[1][(value >> 16) & 0xFF]
+            + _UAC_BYTE_TABLES[2][(value >> 8) & 0xFF] + _UAC_BYTE_TABLES[3][value & 0xFF])
+
+def get_account_control_mask(flags):
+    """
+    将标志名转换为位掩码
+    :param flags: ['disabled', 'locked']
+    :raise KeyError: 不支持的标志名
+    """
+    mask = 0
+    for flag in flags:
+        mask |= UAC_FLAGS[flag]
+    return mask
+
 class UserinfoManager(models.Manager):
     def get_dn_by_account(self, account):
         try:
@@ -18,13 +84,13 @@ class UserinfoManager(models.Manager):
 
 class Userinfo(models.Model):
     userStatus = [
-        ('512', 'a'), # 账号正常
-        ('514', 'b'), # 账号已禁用
-        ('544', 'c'), # 下次登录修改密码
-        ('546', 'c, b'), # 下次登录修改密码, 用户已禁用
-        ('66048', 'd'), # 密码永不过期
-        ('66050', 'd, b'), # 密码永不过期, 用户已禁用
-        ('66080', 'd, c') # 密码永不过期, 下次登录修改密码
+        (512, 'a'), # 账号正常
+        (514, 'b'), # 账号已禁用
+        (544, 'c'), # 下次登录修改密码
+        (546, 'c, b'), # 下次登录修改密码, 用户已禁用
+        (66048, 'd'), # 密码永不过期
+        (66050, 'd, b'), # 密码永不过期, 用户已禁用
+        (66080, 'd, c') # 密码永不过期, 下次登录修改密码
     ]
     name = models.CharField(max_length=50)
     displayName = models.CharField(max_length=50)
@@ -35,34 +101,39 @@ class Userinfo(models.Model):
     userPrincipalName = models.CharField(max_length=40)
     mail = models.CharField(max_length=40, blank=True)
     telephoneNumber = models.CharField(max_length=12, blank=True)
-    userAccountControl = models.CharField(choices=userStatus, max_length=8, blank=True)
+    userAccountControl = models.PositiveIntegerField(choices=userStatus, default=512, blank=True)   # 按位保存的账号控制标志
     org = models.ForeignKey('Orginfo', models.SET_NULL, null=True, blank=True)
+    path = models.CharField(max_length=255, blank=True, db_index=True)   # 由dn生成的物化路径
+    groups = models.ManyToManyField('Groupinfo', related_name='members', blank=True)   # 由memberOf同步的组成员关系
     objects = UserinfoManager()
 
+    def save(self, *args, **kwargs):   # pylint: disable=arguments-differ
+        self.path = dn_to_path(self.dn)
+        super().save(*args, **kwargs)
+
     def get_status(self):
-        res = []
-        tmp = self.userAccountControl
-        tmp = tmp - 512
-        attr = {'8388608': '密码已过期',
-                '65535': '密码永不过期',
-                '64': '用户不可更改密码(只读)',
-                '32': '下次登录修改密码',
-                '16': '用户被锁定',
-                '2': '用户已禁用'}
-        for k, v in attr.items():   # pylint: disable=invalid-name
-            if data < int(k):
-                continue
-            tmp = data-int(k)
-            if tmp >= 0:
-                res.append(v)
-                data = tmp
-            else:
-                break
-        res = ['y'] if len(res) == 0 else res
-        return res
+        """ 解析userAccountControl中的状态标志，没有任何标志时返回['y'] """
+        return list(decode_account_control(self.userAccountControl or 0)) or ['y']
 
 
 class Orginfo(models.Model):
     name = models.CharField(max_length=50)
     objectGUID = models.CharField(max_length=40, unique=True)
-    dn = models.CharField(max_length=100)
+    dn = models.CharField(max_length=100, db_index=True)
+    path = models.CharField(max_length=255, blank=True, db_index=True)   # 由dn生成的物化路径
+
+    def save(self, *args, **kwargs):   # pylint: disable=arguments-differ
+        self.path = dn_to_path(self.dn)
+        super().save(*args, **kwargs)
+
+
+class Groupinfo(models.Model):
+    name = models.CharField(max_length=100)
+    dn = models.CharField(max_length=255, unique=True)
+
+
+class SyncWatermark(models.Model):
+    """ 增量同步的高水位，USN只在同一台域控内有效，因此按域控分别记录 """
+    server = models.CharField(max_length=100, unique=True)
+    highestUSN = models.BigIntegerField(default=0)
+    update_time = models.DateTimeField(auto_now=True)
@@ -1,6 +1,7 @@
 from rest_framework import serializers
 from django.contrib.auth.models import User, Group
-from infox.models import  Orginfo, Userinfo
+from infox.models import  Orginfo, Userinfo, Groupinfo
+from infox.utils.org_tree import get_org_tree
 
 
 class UserSerializer(serializers.HyperlinkedModelSerializer):
@@ -16,6 +17,7 @@ class GroupSerializer(serializers.HyperlinkedModelSerializer):
 class UserinfoSerializer(serializers.HyperlinkedModelSerializer):
     status = serializers.CharField(source='get_userAccountControl_display', default='a')
     org = serializers.CharField(source='org.objectGUID')
+    userAccountControl = serializers.IntegerField(required=False)   # 按位组合的标志，不限于choices中的取值
     class Meta:
         model = Userinfo
         fields = ['url', 'id', 'displayName', 'name', 'dn', 'sAMAccountName', 'userPrincipalName', 'badPwdCount', 'memberOf', 'mail', 'telephoneNumber', 'status', 'userAccountControl', 'org']
@@ -30,7 +32,7 @@ class UserinfoSerializer(serializers.HyperlinkedModelSerializer):
         instance.telephoneNumber = validated_data.get('telephoneNumber', instance.telephoneNumber)
         if 'dn' in validated_data:
             instance.dn = validated_data.get('dn', instance.dn)
-            instance.org = Orginfo.objects.get(dn=instance.dn.split(",", 1)[1])
+            instance.org_id = get_org_tree().get_by_dn(instance.dn.split(",", 1)[1]).id
         instance.save()
         return instance
 
@@ -39,3 +41,9 @@ class OrginfoSerializer(serializers.HyperlinkedModelSerializer):
     class Meta:
         model = Orginfo
         fields = ['url', 'dn', 'name', 'objectGUID']
+
+
+class GroupinfoSerializer(serializers.HyperlinkedModelSerializer):
+    class Meta:
+        model = Groupinfo
+        fields = ['url', 'id', 'name', 'dn']
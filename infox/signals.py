@@ -0,0 +1,13 @@
+"""
+InfoX数据模型信号
+"""
+from django.db.models.signals import post_save, post_delete
+from django.dispatch import receiver
+from infox.models import Orginfo
+from infox.utils.org_tree import bump_version
+
+
+@receiver([post_save, post_delete], sender=Orginfo)
+def invalidate_org_tree(sender, **kwargs):
+    """ 部门新增、修改、删除后使部门树缓存失效 """
+    bump_version()
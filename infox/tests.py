@@ -1,3 +1,519 @@
-from django.test import TestCase
+import uuid
+from io import StringIO
+from types import SimpleNamespace
+from unittest import mock
+from django.db.models import Q
+from django.contrib.auth.models import User
+from django.core.management import call_command
+from django.test import SimpleTestCase, TestCase
+from rest_framework.test import APIClient
+from ldap3 import Server, Connection, MOCK_SYNC, OFFLINE_AD_2012_R2
+from infox.models import Userinfo, Orginfo, Groupinfo, SyncWatermark, UAC_LABELS, dn_to_path, decode_account_control, get_account_control_mask
+from infox.utils.ldap_health import ServerSelector, CLOSED, OPEN, HALF_OPEN
+from infox.utils.ldap_pool import LdapConnectionPool, PooledConnection
+from infox.utils.ldap_auth import CredentialChecker
+from infox.utils.opt_ldap import OptLdap
+from infox.utils.ldap_sync import AdSync, IncrementalAdSync, batch_upsert_users, batch_upsert_orgs, move_subtree, upsert_users
+from infox.utils.org_tree import get_org_tree, reload_org_tree
+from infox.utils.user_import import UserImporter
+from infox.utils.ldap_filter import USER_ENTRY_ATTRIBUTES, LdapFilterError, MATCH_ALL, MATCH_NONE, parse_filter, compile_filter, object_kinds, search_local
 
-# Create your tests here.
+USER = '(&(objectCategory=person)(objectClass=user){})'
+
+
+class LdapFilterParseTests(SimpleTestCase):
+    """ LDAP过滤条件解析 """
+    def test_item(self):
+        self.assertEqual(parse_filter('(sAMAccountName=zs)'), ('eq', 'sAMAccountName', b'zs'))
+        self.assertEqual(parse_filter('sAMAccountName=zs'), ('eq', 'sAMAccountName', b'zs'))
+        self.assertEqual(parse_filter('(mail=zhang*)'), ('prefix', 'mail', b'zhang'))
+        self.assertEqual(parse_filter('(mail=*)'), ('present', 'mail'))
+
+    def test_boolean(self):
+        self.assertEqual(parse_filter('(&(a=1)(|(b=2)(!(c=3))))'),
+                         ('and', [('eq', 'a', b'1'), ('or', [('eq', 'b', b'2'), ('not', ('eq', 'c', b'3'))])]))
+
+    def test_escape(self):
+        self.assertEqual(parse_filter(r'(cn=a\28b\29\2a)'), ('eq', 'cn', b'a(b)*'))
+        self.assertEqual(parse_filter(r'(cn=\e5\bc\a0*)'), ('prefix', 'cn', '张'.encode('utf-8')))
+
+    def test_invalid(self):
+        for text in ['(cn=a', '(cn=a))', '(&)', '(cn)', '(cn=*a*)', '(cn~=a)', '(cn:dn:=a)', r'(cn=\zz)']:
+            with self.assertRaises(LdapFilterError, msg=text):
+                parse_filter(text)
+
+
+class LdapFilterCompileTests(SimpleTestCase):
+    """ 过滤条件编译为Q对象 """
+    def compile(self, text, model=Userinfo):
+        return compile_filter(parse_filter(text), model)
+
+    def test_item(self):
+        self.assertEqual(self.compile('(sAMAccountName=zs)'), Q(sAMAccountName__iexact='zs'))
+        self.assertEqual(self.compile('(mail=zhang*)'), Q(mail__istartswith='zhang'))
+        self.assertEqual(self.compile('(mail=*)'), ~Q(mail=''))
+        self.assertEqual(self.compile('(memberOf=*)'), Q(groups__isnull=False))
+        self.assertEqual(self.compile('(badPwdCount=3)'), Q(badPwdCount=3))
+        self.assertEqual(self.compile(r'(cn=a\28b\29)'), Q(name__iexact='a(b)'))
+
+    def test_boolean(self):
+        self.assertEqual(self.compile('(&(name=a)(mail=b*))'), MATCH_ALL & Q(name__iexact='a') & Q(mail__istartswith='b'))
+        self.assertEqual(self.compile('(|(name=a)(name=b))'), MATCH_NONE | Q(name__iexact='a') | Q(name__iexact='b'))
+        self.assertEqual(self.compile('(!(name=a))'), ~Q(name__iexact='a'))
+
+    def test_object_guid(self):
+        guid = uuid.uuid4()
+        escaped = ''.join('\\%02x' % i for i in guid.bytes_le)
+        self.assertEqual(self.compile('(objectGUID=%s)' % escaped, Orginfo), Q(objectGUID=str(guid)))
+        with self.assertRaises(LdapFilterError):
+            self.compile('(objectGUID=abc)', Orginfo)
+
+    def test_unsupported(self):
+        for text in ['(objectGUID=x)', '(badPwdCount=a)', '(badPwdCount=1*)', '(department=IT)']:
+            with self.assertRaises(LdapFilterError, msg=text):
+                self.compile(text)
+
+    def test_object_class(self):
+        self.assertEqual(self.compile('(objectClass=user)'), MATCH_ALL)
+        self.assertEqual(self.compile('(objectClass=organizationalUnit)'), MATCH_NONE)
+        self.assertEqual(self.compile('(objectCategory=CN=Person,CN=Schema,CN=Configuration,DC=x)'), MATCH_ALL)
+        # 限定为OU的分支在用户表上恒假，不检查其中用户表没有的属性
+        self.assertEqual(self.compile('(&(objectClass=organizationalUnit)(objectGUID=x))'), MATCH_NONE)
+
+
+class LdapFilterKindsTests(SimpleTestCase):
+    """ 只有限定为用户或OU的过滤条件才能在本地回答 """
+    def kinds(self, text):
+        return object_kinds(parse_filter(text))
+
+    def test_kinds(self):
+        self.assertEqual(self.kinds(USER.format('(cn=a)')), {'user'})
+        self.assertEqual(self.kinds('(&(objectClass=organizationalUnit)(name=IT))'), {'ou'})
+        self.assertEqual(self.kinds('(&(objectClass=user)(cn=a))'), {'user', 'computer'})
+        self.assertEqual(self.kinds('(&(objectCategory=person)(cn=a))'), {'user', 'contact'})
+        self.assertIn('group', self.kinds('(cn=foo*)'))
+        self.assertIn('group', self.kinds('(!(objectClass=user))'))
+
+    def test_fallback_to_ad(self):
+        for text in ['(name=x)', '(cn=foo*)', '(|(sAMAccountName=zs)(name=IT2))', '(&(objectClass=user)(sAMAccountName=zs))',
+                     '(&(objectClass=group)(cn=a))', USER.format('(department=IT)'),
+                     '(|%s(&(objectClass=organizationalUnit)(sAMAccountName=zs)))' % USER.format('(cn=a)')]:
+            with self.assertRaises(LdapFilterError, msg=text):
+                search_local(text)
+
+    def test_missing_attributes(self):
+        with self.assertRaises(LdapFilterError):
+            search_local(USER.format('(cn=a)'), ['department'])
+
+
+class DnToPathTests(SimpleTestCase):
+    """ DN转换为物化路径 """
+    def test_path(self):
+        self.assertEqual(dn_to_path('CN=张三,OU=IT组,DC=sh,DC=com'), '/dc=com/dc=sh/ou=it组/cn=张三/')
+        self.assertEqual(dn_to_path('OU=IT , DC=sh,DC=com'), '/dc=com/dc=sh/ou=it/')
+        self.assertEqual(dn_to_path(''), '')
+
+    def test_escape(self):
+        self.assertEqual(dn_to_path(r'CN=Zhang\, San,OU=a/b%,DC=com'), r'/dc=com/ou=a%2Fb%25/cn=zhang\, san/')
+
+    def test_subtree_prefix(self):
+        parent = dn_to_path('OU=IT,DC=sh,DC=com')
+        self.assertTrue(dn_to_path('CN=u1,OU=Dev,OU=IT,DC=sh,DC=com').startswith(parent))
+        self.assertFalse(dn_to_path('OU=IT2,DC=sh,DC=com').startswith(parent))
+
+
+class AccountControlTests(SimpleTestCase):
+    """ userAccountControl标志解析 """
+    def test_decode(self):
+        self.assertEqual(decode_account_control(0x200), ())
+        self.assertEqual(decode_account_control('514'), ('用户已禁用',))
+        self.assertEqual(decode_account_control(0x800000 | 0x10000 | 0x200 | 0x10 | 0x2),
+                         ('密码已过期', '密码永不过期', '用户被锁定', '用户已禁用'))
+
+    def test_decode_matches_bits(self):
+        # 查表结果与逐位判断一致
+        for value in [0, 0x2, 0x222, 0x10040, 0x810030, 0xFFFFFF, 0x7FFFFFFF]:
+            expected = tuple(label for bit, label in UAC_LABELS if value & bit)
+            self.assertEqual(decode_account_control(value), expected, msg=hex(value))
+
+    def test_mask(self):
+        self.assertEqual(get_account_control_mask([]), 0)
+        self.assertEqual(get_account_control_mask(['disabled', 'locked', 'disabled']), 0x12)
+        with self.assertRaises(KeyError):
+            get_account_control_mask(['unknown'])
+
+    def test_status(self):
+        self.assertEqual(Userinfo(userAccountControl=512).get_status(), ['y'])
+        self.assertEqual(Userinfo(userAccountControl=None).get_status(), ['y'])
+        self.assertEqual(Userinfo(userAccountControl=546).get_status(), ['下次登录修改密码', '用户已禁用'])
+
+
+class ServerSelectorTests(SimpleTestCase):
+    """ 域控熔断状态机 """
+    def setUp(self):
+        self.now = 1000.0
+        patcher = mock.patch('infox.utils.ldap_health.time.monotonic', lambda: self.now)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.selector = ServerSelector([SimpleNamespace(host='dc%s' % i, port=636) for i in range(2)],
+                                       failure_threshold=2, backoff_base=5, backoff_max=12)
+        self.dc0, self.dc1 = self.selector.servers
+
+    def test_open_after_threshold(self):
+        self.selector.record_failure(self.dc0)
+        self.assertEqual(self.dc0.state, CLOSED)
+        self.selector.record_failure(self.dc0)
+        self.assertEqual((self.dc0.state, self.dc0.backoff, self.dc0.retry_at), (OPEN, 5, 1005.0))
+        self.assertEqual(self.selector.ordered(), [self.dc1])
+
+    def test_half_open_probe(self):
+        self.selector.record_failure(self.dc0)
+        self.selector.record_failure(self.dc0)
+        self.now = 1005.0
+        self.assertEqual(self.selector.ordered(), [self.dc0, self.dc1])
+        self.assertEqual(self.dc0.state, HALF_OPEN)
+        # 同一熔断周期内只放行一次探测
+        self.assertEqual(self.selector.ordered(), [self.dc1])
+        self.selector.record_success(self.dc0, 0.01)
+        self.assertEqual((self.dc0.state, self.dc0.failures, self.dc0.backoff), (CLOSED, 0, 0))
+
+    def test_probe_failure_backoff(self):
+        self.selector.record_failure(self.dc0)
+        self.selector.record_failure(self.dc0)
+        for backoff in [10, 12, 12]:
+            self.now = self.dc0.retry_at
+            self.selector.ordered()
+            self.selector.record_failure(self.dc0)
+            self.assertEqual((self.dc0.state, self.dc0.backoff), (OPEN, backoff))
+
+    def test_all_open(self):
+        for health in [self.dc1, self.dc1, self.dc0, self.dc0]:
+            self.now += 1
+            self.selector.record_failure(health)
+        self.assertEqual(self.selector.ordered(), [self.dc1, self.dc0])
+
+    def test_order_by_score(self):
+        self.selector.record_success(self.dc0, 0.5)
+        self.selector.record_success(self.dc1, 0.1)
+        self.assertEqual(self.selector.ordered(), [self.dc1, self.dc0])
+
+
+class LdapPoolRefreshTests(SimpleTestCase):
+    """ 连接池借出前的检查 """
+    def test_skip_open_server(self):
+        selector = ServerSelector([SimpleNamespace(host='dc0', port=636)], failure_threshold=1)
+        pool = LdapConnectionPool(None, 'user', 'password', selector=selector)
+        entry = PooledConnection(mock.Mock(closed=False, bound=True), selector.servers[0])
+        fresh = PooledConnection(mock.Mock())
+        with mock.patch.object(pool, '_connect', return_value=fresh):
+            self.assertIs(pool._refresh(entry), entry)   # pylint: disable=protected-access
+            selector.record_failure(entry.health)
+            self.assertIs(pool._refresh(entry), fresh)   # pylint: disable=protected-access
+        entry.connection.unbind.assert_called_once_with()
+
+
+class BatchUpsertUsersTests(TestCase):
+    """ 批量同步用户，每一项单独校验 """
+    def item(self, account, **kwargs):
+        return dict({'sAMAccountName': account, 'name': account, 'displayName': account, 'userPrincipalName': account + '@sh.com'}, **kwargs)
+
+    def test_invalid_account_control(self):
+        res = batch_upsert_users([self.item('u1', userAccountControl='abc'), self.item('u2', userAccountControl=-1),
+                                  self.item('u3', userAccountControl='66050')])
+        self.assertEqual([i['status'] for i in res], ['error', 'error', 'created'])
+        self.assertIn('userAccountControl', res[0]['msg'])
+        self.assertIn('userAccountControl', res[1]['msg'])
+        self.assertEqual(Userinfo.objects.get(sAMAccountName='u3').userAccountControl, 66050)
+
+    def test_negative_count(self):
+        Userinfo.objects.create(**self.item('u1'))
+        res = batch_upsert_users([{'sAMAccountName': 'u1', 'badPwdCount': -1}, {'sAMAccountName': 'u1', 'badPwdCount': '2'}])
+        self.assertEqual([i['status'] for i in res], ['error', 'updated'])
+        self.assertEqual(Userinfo.objects.get(sAMAccountName='u1').badPwdCount, 2)
+
+
+class BatchUpsertOrgsTests(TestCase):
+    """ 批量同步OU """
+    def test_normalize_guid(self):
+        guid = uuid.uuid4()
+        Orginfo.objects.create(name='IT', objectGUID=str(guid), dn='OU=IT,DC=sh,DC=com')
+        res = batch_upsert_orgs([{'objectGUID': '{%s}' % str(guid).upper(), 'name': 'IT2'}])
+        self.assertEqual(res, [{'objectGUID': str(guid), 'status': 'updated'}])
+        self.assertEqual(Orginfo.objects.get().name, 'IT2')
+
+    def test_invalid_items(self):
+        guid = str(uuid.uuid4())
+        res = batch_upsert_orgs([{'objectGUID': 'bad', 'name': 'A', 'dn': 'OU=A,DC=sh,DC=com'},
+                                 {'objectGUID': str(uuid.uuid4()), 'name': 'X', 'dn': 'OU=X'},
+                                 {'objectGUID': str(uuid.uuid4()), 'name': 'Y', 'dn': 'CN=Y,DC=sh,DC=com'},
+                                 {'objectGUID': guid, 'name': 'B', 'dn': 'OU=B,DC=sh,DC=com'}])
+        self.assertEqual([i['status'] for i in res], ['error', 'error', 'error', 'created'])
+        self.assertEqual(list(Orginfo.objects.values_list('objectGUID', 'path')), [(guid, '/dc=com/dc=sh/ou=b/')])
+
+
+class CheckExistTests(TestCase):
+    """ 检查账号是否存在，本地能回答时不查询AD域 """
+    url = '/api/v1/userinfo/check_exist/'
+
+    def setUp(self):
+        self.client = APIClient()
+        self.client.force_authenticate(User.objects.create(username='admin'))
+        Userinfo.objects.create(name='张三', displayName='张三', sAMAccountName='zhangsan', userPrincipalName='zhangsan@sh.com',
+                                dn='CN=张三,OU=IT,DC=sh,DC=com')
+        patcher = mock.patch('infox.views.OptLdap', side_effect=AssertionError("不应查询AD域"))
+        self.opt_ldap = patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_local(self):
+        res = self.client.post(self.url, {'sAMAccountName': 'ZhangSan'}, format='json').json()
+        self.assertEqual((res['status'], res['source']), (True, 'db'))
+        self.assertEqual(set(res['obj'][0]['attributes']), set(USER_ENTRY_ATTRIBUTES))
+        self.assertEqual(res['obj'][0]['attributes']['mail'], [])
+
+    def test_local_not_found(self):
+        res = self.client.post(self.url, {'operator': '&', 'obj': {'name': '张三', 'sAMAccountName': 'lisi'}}, format='json').json()
+        self.assertEqual((res['status'], res['obj'], res['source']), (False, [], 'db'))
+
+    def test_form(self):
+        body = 'sAMAccountName=zhangsan&attributes=mail&attributes=sAMAccountName'
+        res = self.client.post(self.url, body, content_type='application/x-www-form-urlencoded').json()
+        self.assertEqual(res['obj'][0]['attributes'], {'sAMAccountName': 'zhangsan', 'mail': []})
+
+    def test_fallback_to_ad(self):
+        self.opt_ldap.side_effect = None
+        opt_ldap = self.opt_ldap.return_value.__enter__.return_value
+        opt_ldap.get_obj_info.return_value = []
+        res = self.client.post(self.url, {'department': 'IT'}, format='json').json()
+        self.assertEqual(res['source'], 'ad')
+        opt_ldap.get_obj_info.assert_called_once_with(filter_all=USER.format('(department=IT)'), attr=USER_ENTRY_ATTRIBUTES)
+
+
+class CredentialCheckerTests(SimpleTestCase):
+    """ 账号验证在并发已满的域控上不等待，直接换下一台 """
+    def setUp(self):
+        servers = [SimpleNamespace(host='dc%s' % i, port=636) for i in range(2)]
+        self.checker = CredentialChecker(servers, per_server=1, timeout=2, slot_wait=0.01)
+        self.addCleanup(self.checker._executor.shutdown)   # pylint: disable=protected-access
+        self.dc0, self.dc1 = self.checker.slots
+        self.dc1.health.latency.record(1)   # dc0优先
+
+    def bind(self, server, **kwargs):   # pylint: disable=unused-argument
+        return mock.Mock(bind=mock.Mock(return_value=True), result={'server': server.host})
+
+    def test_skip_busy_server(self):
+        self.dc0.semaphore.acquire()
+        with mock.patch('infox.utils.ldap_auth.Connection', side_effect=self.bind):
+            res = self.checker.check('user', 'password')
+        self.assertEqual((res['status'], res['server']), (True, 'dc1:636'))
+
+    def test_all_busy(self):
+        self.dc0.semaphore.acquire()
+        self.dc1.semaphore.acquire()
+        self.checker.timeout = 0.1
+        with mock.patch('infox.utils.ldap_auth.Connection', side_effect=self.bind):
+            res = self.checker.check('user', 'password')
+        self.assertFalse(res['status'])
+
+
+class UpdateObjTests(SimpleTestCase):
+    """ update_obj在本地比较出变化的属性，属性名不区分大小写 """
+    dn = 'CN=zs,OU=IT,DC=sh,DC=com'
+
+    def setUp(self):
+        connection = Connection(Server('mock', get_info=OFFLINE_AD_2012_R2), user='CN=admin,DC=sh,DC=com', password='x', client_strategy=MOCK_SYNC)
+        connection.strategy.add_entry('CN=admin,DC=sh,DC=com', {'userPassword': 'x', 'objectClass': 'person'})
+        connection.strategy.add_entry(self.dn, {'objectClass': ['top', 'person', 'organizationalPerson', 'user'], 'name': 'zs',
+                                                'displayName': '张三', 'telephoneNumber': '1'})
+        connection.bind()
+        self.opt_ldap = OptLdap.__new__(OptLdap)
+        self.opt_ldap._pool = None   # pylint: disable=protected-access
+        self.opt_ldap.connect = connection
+        self.addCleanup(self.opt_ldap.close)
+
+    def test_case_insensitive(self):
+        res = self.opt_ldap.update_obj(self.dn, {'displayname': '张三', 'TelephoneNumber': '2'})
+        self.assertEqual((res['status'], res['changed']), (True, ['TelephoneNumber']))
+        res = self.opt_ldap.update_obj(self.dn, {'telephonenumber': '2'})
+        self.assertEqual((res['status'], res['changed']), (True, []))
+
+    def test_rejected(self):
+        self.assertEqual(self.opt_ldap.update_obj(self.dn, {'displayName': '李四'}), {'status': False, 'msg': '不支持的属性 displayName'})
+        self.assertFalse(self.opt_ldap.update_obj(self.dn, {'notAnAttribute': 'x'})['status'])
+        self.assertFalse(self.opt_ldap.update_obj('CN=nobody,OU=IT,DC=sh,DC=com', {'mail': 'x'})['status'])
+
+
+class SubtreePathTests(TestCase):
+    """ 物化路径的生成和子树改写 """
+    def setUp(self):
+        self.it = Orginfo.objects.create(name='IT', objectGUID=str(uuid.uuid4()), dn='OU=IT,DC=sh,DC=com')
+        self.dev = Orginfo.objects.create(name='Dev', objectGUID=str(uuid.uuid4()), dn='OU=Dev,OU=IT,DC=sh,DC=com')
+        self.user = Userinfo.objects.create(name='zs', displayName='zs', sAMAccountName='zs', userPrincipalName='zs@sh.com',
+                                            dn='CN=zs,OU=Dev,OU=IT,DC=sh,DC=com', org=self.dev)
+
+    def test_backfill(self):
+        Orginfo.objects.update(path='')   # 增加path字段之前的数据
+        Userinfo.objects.update(path='')
+        out = StringIO()
+        call_command('backfill_path', stdout=out)
+        self.assertIn('OU:2 用户:1', out.getvalue())
+        self.assertEqual(Userinfo.objects.get().path, '/dc=com/dc=sh/ou=it/ou=dev/cn=zs/')
+        self.assertEqual(Orginfo.objects.filter(path__startswith=dn_to_path(self.it.dn)).count(), 2)
+
+    def test_move_subtree(self):
+        Orginfo.objects.create(name='IT2', objectGUID=str(uuid.uuid4()), dn='OU=IT2,DC=sh,DC=com')
+        self.assertEqual(move_subtree('OU=IT,DC=sh,DC=com', 'OU=R&D,OU=HQ,DC=sh,DC=com'), {'orgs': 2, 'users': 1})
+        self.user.refresh_from_db()
+        self.assertEqual((self.user.dn, self.user.path), ('CN=zs,OU=Dev,OU=R&D,OU=HQ,DC=sh,DC=com', '/dc=com/dc=sh/ou=hq/ou=r&d/ou=dev/cn=zs/'))
+        self.assertEqual(Orginfo.objects.get(name='IT2').dn, 'OU=IT2,DC=sh,DC=com')
+
+
+def ou_entry(dn, guid):
+    return {'dn': dn, 'attributes': {'name': dn.split(',')[0][3:], 'objectGUID': guid}}
+
+
+def user_entry(dn, account, **attributes):
+    attrs = {'name': dn.split(',')[0][3:], 'displayName': account, 'sAMAccountName': account, 'userPrincipalName': account + '@sh.com',
+             'userAccountControl': 512, 'badPwdCount': 0, 'memberOf': []}
+    attrs.update(attributes)
+    return {'dn': dn, 'attributes': attrs}
+
+
+class FakeOptLdap():
+    """ 按给定的查询结果返回的OptLdap """
+    active_base_dn = 'OU=HUPU,DC=sh,DC=com'
+
+    def __init__(self, ous=(), users=(), deleted=(), usn=100):
+        self.ous, self.users, self.deleted, self.usn = list(ous), list(users), list(deleted), usn
+        self.connect = SimpleNamespace(server=SimpleNamespace(host='dc1'))
+
+    def get_user_base_dn(self, get_type):   # pylint: disable=unused-argument
+        return self.active_base_dn
+
+    def iter_ous(self, page_size=500):   # pylint: disable=unused-argument
+        return iter(self.ous)
+
+    def iter_users(self, get_type='active', page_size=500):   # pylint: disable=unused-argument
+        return iter(self.users)
+
+    def iter_changed_ous(self, usn, page_size=500):   # pylint: disable=unused-argument
+        return iter(self.ous)
+
+    def iter_changed_users(self, usn, page_size=500):   # pylint: disable=unused-argument
+        return iter(self.users)
+
+    def iter_deleted_objects(self, usn, page_size=500):   # pylint: disable=unused-argument
+        return iter(self.deleted)
+
+    def get_highest_usn(self):
+        return self.usn
+
+
+class AdSyncTests(TestCase):
+    """ AD域到数据库的全量和增量同步 """
+    hupu, it = str(uuid.uuid4()), str(uuid.uuid4())
+
+    def setUp(self):
+        reload_org_tree()   # 部门树是进程内缓存，测试之间需要重新加载
+
+    def full_sync(self):
+        opt_ldap = FakeOptLdap(
+            ous=[ou_entry('OU=HUPU,DC=sh,DC=com', self.hupu), ou_entry('OU=IT,OU=HUPU,DC=sh,DC=com', self.it)],
+            users=[user_entry('CN=张三,OU=IT,OU=HUPU,DC=sh,DC=com', 'zs', memberOf=['CN=g1,DC=sh,DC=com']),
+                   user_entry('CN=李四,OU=HUPU,DC=sh,DC=com', 'ls', mail='ls@sh.com')])
+        return AdSync(opt_ldap, chunk_size=1).run()
+
+    def test_full(self):
+        res = self.full_sync()
+        self.assertEqual((res['orgs']['created'], res['users']['created']), (2, 2))
+        zs = Userinfo.objects.get(sAMAccountName='zs')
+        self.assertEqual((zs.org.objectGUID, zs.path), (self.it, '/dc=com/dc=sh/ou=hupu/ou=it/cn=张三/'))
+        self.assertEqual(list(zs.groups.values_list('name', flat=True)), ['g1'])
+        res = self.full_sync()
+        self.assertEqual((res['orgs']['updated'], res['users']['updated']), (2, 2))
+        self.assertEqual(Groupinfo.objects.count(), 1)
+
+    def test_upsert_only_submitted_fields(self):
+        self.full_sync()
+        res = upsert_users([{'sAMAccountName': 'ls', 'telephoneNumber': '123'}, {'sAMAccountName': 'ww', 'name': '王五',
+                                                                                'displayName': '王五', 'userPrincipalName': 'ww@sh.com'}])
+        self.assertEqual(res, {'created': ['ww'], 'updated': ['ls']})
+        ls = Userinfo.objects.get(sAMAccountName='ls')
+        self.assertEqual((ls.telephoneNumber, ls.mail), ('123', 'ls@sh.com'))
+
+    def test_incremental(self):
+        self.full_sync()
+        opt_ldap = FakeOptLdap(
+            ous=[ou_entry('OU=R&D,OU=HUPU,DC=sh,DC=com', self.it)],   # IT重命名，下级用户没有变更
+            users=[user_entry('CN=李四,OU=LEAVED,DC=sh,DC=com', 'ls')],   # 移出同步范围
+            deleted=[{'dn': 'CN=g1\0ADEL:x,CN=Deleted Objects,DC=sh,DC=com', 'attributes': {'objectClass': ['top', 'organizationalUnit'], 'objectGUID': self.hupu}}])
+        res = IncrementalAdSync(opt_ldap).run()
+        self.assertEqual((res['orgs']['moved'], res['users']['deleted'], res['tombstones']['orgs']), (1, 1, 1))
+        self.assertEqual(Userinfo.objects.get(sAMAccountName='zs').dn, 'CN=张三,OU=R&D,OU=HUPU,DC=sh,DC=com')
+        self.assertFalse(Userinfo.objects.filter(sAMAccountName='ls').exists())
+        self.assertEqual(SyncWatermark.objects.get(server='dc1').highestUSN, 100)
+
+
+class BatchEndpointTests(TestCase):
+    """ sync_user、sync_org提交列表时逐项返回结果 """
+    def setUp(self):
+        self.client = APIClient()
+        self.client.force_authenticate(User.objects.create(username='admin'))
+        reload_org_tree()
+
+    def test_sync_org_and_user(self):
+        guid = str(uuid.uuid4())
+        res = self.client.post('/api/v1/orginfo/sync_org/', [{'objectGUID': guid, 'name': 'IT', 'dn': 'OU=IT,DC=sh,DC=com'}, {'name': 'x'}],
+                               format='json').json()
+        self.assertEqual([i['status'] for i in res['obj']], ['created', 'error'])
+        items = [{'sAMAccountName': 'zs', 'name': '张三', 'displayName': '张三', 'userPrincipalName': 'zs@sh.com', 'org': 'OU=IT,DC=sh,DC=com',
+                  'memberOf': ['CN=g1,DC=sh,DC=com']},
+                 {'sAMAccountName': 'ls', 'name': '李四', 'displayName': '李四', 'userPrincipalName': 'ls@sh.com', 'org': 'OU=nope,DC=sh,DC=com'}]
+        res = self.client.post('/api/v1/userinfo/sync_user/', items, format='json').json()
+        self.assertEqual([i['status'] for i in res['obj']], ['created', 'error'])
+        zs = Userinfo.objects.get(sAMAccountName='zs')
+        self.assertEqual((zs.org.objectGUID, zs.groups.count()), (guid, 1))
+
+
+class OrgTreeTests(TestCase):
+    """ 进程内部门树 """
+    def test_tree(self):
+        hupu = Orginfo.objects.create(name='HUPU', objectGUID=str(uuid.uuid4()), dn='OU=HUPU,DC=sh,DC=com')
+        Orginfo.objects.create(name='IT', objectGUID=str(uuid.uuid4()), dn='OU=IT,OU=HUPU,DC=sh,DC=com')
+        tree = get_org_tree()
+        self.assertEqual(tree.get_by_dn('ou=it,ou=hupu,dc=sh,dc=com').parent.id, hupu.id)
+        self.assertEqual([i['name'] for i in tree.to_list()[0]['children']], ['IT'])
+        with self.assertRaises(Orginfo.DoesNotExist):
+            tree.get_by_guid('nope')
+
+    def test_reload_on_miss(self):
+        tree = reload_org_tree()
+        guid = str(uuid.uuid4())
+        Orginfo.objects.bulk_create([Orginfo(name='HR', objectGUID=guid, dn='OU=HR,DC=sh,DC=com')])   # 不触发信号，与其他进程写入相同
+        self.assertEqual(tree.get_by_guid(guid).name, 'HR')
+        self.assertEqual(get_org_tree().get_by_dn('OU=HR,DC=sh,DC=com').objectGUID, guid)
+
+
+class UserImporterTests(TestCase):
+    """ 批量导入新员工 """
+    def setUp(self):
+        self.org = Orginfo.objects.create(name='IT', objectGUID=str(uuid.uuid4()), dn='OU=IT,DC=sh,DC=com')
+        Userinfo.objects.create(name='old', displayName='old', sAMAccountName='old', userPrincipalName='old@sh.com')
+        reload_org_tree()
+
+    def test_run(self):
+        connection = mock.Mock()
+        connection.add.side_effect = lambda dn, object_class, attrs: dn
+        connection.strategy.get_response.side_effect = lambda dn: (None, {'result': 68 if 'ad' in dn else 0, 'description': 'entryAlreadyExists'})
+        rows = [{'name': 'new1', 'sAMAccountName': 'new1', 'pwd': 'Pw.1234', 'deptId': self.org.objectGUID},
+                {'name': 'old', 'sAMAccountName': 'OLD', 'pwd': 'p', 'deptId': self.org.objectGUID},
+                {'name': 'x', 'sAMAccountName': 'x', 'pwd': 'p', 'deptId': 'nope'},
+                {'name': 'ad', 'sAMAccountName': 'ad', 'pwd': 'p', 'deptId': self.org.objectGUID},
+                {'name': 'new1', 'sAMAccountName': 'NEW1', 'pwd': 'p', 'deptId': self.org.objectGUID}]
+        with mock.patch('infox.utils.user_import.OptLdap') as opt_ldap:
+            opt_ldap.return_value.__enter__.return_value.iter_accounts.return_value = []
+            res = UserImporter(connection=connection, chunk_size=2).run(rows)
+        self.assertEqual(res['created'], 1)
+        self.assertEqual([i['status'] for i in res['results']], [True, False, False, False, False])
+        user = Userinfo.objects.get(sAMAccountName='new1')
+        self.assertEqual((user.org_id, user.path), (self.org.id, '/dc=com/dc=sh/ou=it/cn=new1/'))
+        connection.unbind.assert_not_called()   # 调用方传入的连接由调用方关闭
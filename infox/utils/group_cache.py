@@ -0,0 +1,62 @@
+"""
+用户的有效组(包含嵌套组)查询和进程内缓存
+通过LDAP_MATCHING_RULE_IN_CHAIN在AD域中一次查询用户直接和间接所属的全部组，结果按用户DN缓存
+组成员关系变更时更新缓存中的版本号使所有进程的缓存失效；组之间的嵌套关系在AD中修改时不经过本系统，依靠MAX_AGE过期
+"""
+import time
+import logging
+import threading
+from collections import OrderedDict
+from django.core.cache import cache
+from infox.utils.opt_ldap import OptLdap
+
+group_logger = logging.getLogger('infox')
+
+GROUP_VERSION_KEY = 'infox:group_version'
+EFFECTIVE_GROUPS_MAX_AGE = 600      # 缓存结果最长使用秒数
+EFFECTIVE_GROUPS_MAX_USERS = 10000  # 每个进程最多缓存的用户数，超过后淘汰最久未使用的
+
+
+def get_group_version():
+    return cache.get(GROUP_VERSION_KEY, 0)
+
+
+def bump_group_version():
+    """ 组成员关系变更后调用，使所有进程缓存的有效组失效 """
+    try:
+        cache.incr(GROUP_VERSION_KEY)
+    except ValueError:
+        cache.set(GROUP_VERSION_KEY, 1, None)
+
+
+_effective_groups = OrderedDict()   # {用户dn(小写): (版本号, 加载时间, 组列表)}
+_effective_groups_lock = threading.Lock()
+
+
+def get_effective_groups(user_dn, refresh=False):
+    """
+    获取用户直接和间接所属的全部组
+    :param refresh: 为True时跳过缓存重新查询
+    :return ([{"name": "...", "dn": "..."}], 是否来自缓存)
+    """
+    key = user_dn.lower()
+    version = get_group_version()
+    with _effective_groups_lock:
+        entry = _effective_groups.get(key)
+        if entry is not None and not refresh and entry[0] == version and time.monotonic() - entry[1] < EFFECTIVE_GROUPS_MAX_AGE:
+            _effective_groups.move_to_end(key)
+            return entry[2], True
+    with OptLdap() as opt_ldap:
+        groups = sorted(({'name': _first(item['attributes'].get('name')), 'dn': item['dn']} for item in opt_ldap.iter_groups_in_chain(user_dn)),
+                        key=lambda group: group['dn'].lower())
+    with _effective_groups_lock:
+        _effective_groups[key] = (version, time.monotonic(), groups)
+        _effective_groups.move_to_end(key)
+        while len(_effective_groups) > EFFECTIVE_GROUPS_MAX_USERS:
+            _effective_groups.popitem(last=False)
+    group_logger.info("查询用户有效组 %s - %s 个", user_dn, len(groups))
+    return groups, False
+
+
+def _first(value):
+    return value[0] if isinstance(value, list) and value else value
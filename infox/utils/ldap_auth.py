@@ -0,0 +1,146 @@
+"""
+AD域账号密码验证
+在独立的线程池中完成NTLM绑定，按域控健康评分选择服务器(见ldap_health.py)，每台域控限制并发数，整体有超时预算
+"""
+import time
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from concurrent.futures import TimeoutError as FutureTimeoutError
+from ldap3 import Connection, NTLM
+from ldap3.core import exceptions
+from django.conf import settings
+from infox.utils.ldap_health import ServerSelector
+
+ldap_logger = logging.getLogger('optLdap')
+
+DEFAULT_AUTH_SETTINGS = {
+    'MAX_WORKERS': 20,   # 同时进行验证的最大线程数
+    'PER_SERVER': 5,     # 每台域控同时进行的绑定数
+    'TIMEOUT': 5,        # 一次验证的总超时秒数，包括在其他域控上的重试
+    'SLOT_WAIT': 0.05,   # 健康的域控并发都已满时，在每台域控上等待空位的秒数，之后换下一台
+}
+
+
+def get_auth_setting(name):
+    """ 获取settings文件中LDAP_AUTH的配置，未配置时使用默认值 """
+    settings_dict = getattr(settings, 'LDAP_AUTH', {})
+    return settings_dict.get(name, DEFAULT_AUTH_SETTINGS[name])
+
+
+class ServerSlot():
+    """ 单台域控的并发限制，耗时和熔断状态记录在health中 """
+    def __init__(self, health, per_server):
+        self.health = health
+        self.server = health.server
+        self.name = health.name
+        self.semaphore = threading.BoundedSemaphore(per_server)
+        self.in_flight = 0
+
+
+BUSY = object()   # 域控并发已满，没有进行绑定
+
+
+class CredentialChecker():
+    """ 账号密码验证服务 """
+    def __init__(self, servers, max_workers=20, per_server=5, timeout=5, schema_cache=None, selector=None, slot_wait=0.05):
+        self.timeout = timeout
+        self.slot_wait = slot_wait
+        self.schema_cache = schema_cache
+        self.selector = selector if selector is not None else ServerSelector(servers)
+        self.slots = [ServerSlot(self.selector.get(server), per_server) for server in servers]
+        self._slots = {id(slot.health): slot for slot in self.slots}
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='ldap-auth')
+        self._lock = threading.Lock()
+        self.timeouts = 0
+
+    def _ordered_slots(self):
+        """ 按域控选择器的顺序，熔断中的域控不参与 """
+        return [self._slots[id(health)] for health in self.selector.ordered()]
+
+    def _bind(self, slot, user, password, remaining, wait=0):
+        """
+        在指定域控上绑定，返回None表示该域控无法完成验证
+        :param wait: 等待并发空位的秒数，为0时不等待；仍然没有空位时返回BUSY
+        """
+        acquired = slot.semaphore.acquire(timeout=wait) if wait > 0 else slot.semaphore.acquire(blocking=False)
+        if not acquired:
+            return BUSY
+        connect = None
+        with self._lock:
+            slot.in_flight += 1
+        try:
+            if self.schema_cache is not None:
+                self.schema_cache.prepare(slot.server)
+            start = time.monotonic()
+            connect = Connection(slot.server, user=user, password=password, authentication=NTLM, receive_timeout=max(1, int(remaining)))
+            status = connect.bind()
+            self.selector.record_success(slot.health, time.monotonic() - start)   # 密码错误也说明域控可用
+            return {'status': status, 'msg': str(connect.result), 'server': slot.name}
+        except exceptions.LDAPException as ept:
+            self.selector.record_failure(slot.health)
+            ldap_logger.warning("域控 %s 验证出现错误 %s", slot.name, ept)
+            return None
+        finally:
+            with self._lock:
+                slot.in_flight -= 1
+            slot.semaphore.release()
+            if connect is not None:
+                try:
+                    connect.unbind()
+                except exceptions.LDAPException:
+                    pass
+
+    def _check(self, user, password, deadline):
+        """ 按域控顺序依次尝试，并发已满的域控直接跳过；全部已满时在这些域控之间轮流短暂等待，直到有空位或超时 """
+        busy = []
+        for slot in self._ordered_slots():
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            res = self._bind(slot, user, password, remaining)
+            if res is BUSY:
+                busy.append(slot)
+            elif res is not None:   # 绑定有结果(包括密码错误)时不再尝试其他域控
+                return res
+        if busy:
+            ldap_logger.warning("域控 %s 验证并发已满", ",".join(slot.name for slot in busy))
+        while busy:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            slot = busy.pop(0)
+            res = self._bind(slot, user, password, remaining, wait=min(remaining, self.slot_wait))
+            if res is BUSY:
+                busy.append(slot)
+            elif res is not None:
+                return res
+        return {'status': False, 'msg': "AD域服务器无法完成验证"}
+
+    def submit(self, user, password):
+        """ 提交验证任务，返回Future """
+        return self._executor.submit(self._check, user, password, time.monotonic() + self.timeout)
+
+    def check(self, user, password):
+        """
+        验证账号密码，超过超时预算时返回失败
+        调用方会一直阻塞到得到结果或超时，线程池不会为单个调用方增加并发，作用是限制全进程同时进行的绑定数，
+        并且在域控无响应时按超时预算返回，不让请求线程卡在socket上；需要并发验证多个账号时使用submit()
+        """
+        future = self.submit(user, password)
+        try:
+            return future.result(timeout=self.timeout)
+        except FutureTimeoutError:
+            with self._lock:
+                self.timeouts += 1
+            ldap_logger.warning("用户 %s 登录验证超时 %ss", user, self.timeout)
+            return {'status': False, 'msg': "AD域验证超时"}
+
+    def get_stats(self):
+        """ 每台域控的耗时p50/p99、熔断状态和当前并发，耗时与连接池共用 """
+        servers = []
+        for slot in self.slots:
+            stats = slot.health.to_dict()
+            stats['in_flight'] = slot.in_flight
+            servers.append(stats)
+        return {'timeout': self.timeout, 'timeouts': self.timeouts, 'servers': servers}
@@ -0,0 +1,308 @@
+"""
+将LDAP过滤条件(RFC 4515)编译为Django ORM的Q对象，在同步到本地的Userinfo/Orginfo表中查询
+只支持 &、|、!、等值(=)、前缀匹配(abc*)和存在性(attr=*)，属性只限于本地表中保存的字段
+本地表只有用户和OU，过滤条件必须通过objectClass/objectCategory限定为这两类对象，否则AD中的组、计算机、联系人等会被遗漏
+不支持的过滤条件抛出LdapFilterError，由调用方转到AD域中查询
+"""
+import uuid
+from django.db.models import Q
+from infox.models import Userinfo, Orginfo
+
+
+class LdapFilterError(ValueError):
+    """ 过滤条件语法错误或无法在本地表中查询 """
+
+
+# 恒真/恒假条件，取反后仍然有效
+MATCH_ALL = Q(pk__isnull=False)
+MATCH_NONE = Q(pk__isnull=True)
+
+# LDAP属性名(小写) -> (字段名, 类型)
+USER_ATTRIBUTES = {
+    'name': ('name', 'str'),
+    'cn': ('name', 'str'),
+    'displayname': ('displayName', 'str'),
+    'distinguishedname': ('dn', 'str'),
+    'samaccountname': ('sAMAccountName', 'str'),
+    'userprincipalname': ('userPrincipalName', 'str'),
+    'mail': ('mail', 'str'),
+    'telephonenumber': ('telephoneNumber', 'str'),
+    'badpwdcount': ('badPwdCount', 'int'),
+    'useraccountcontrol': ('userAccountControl', 'int'),
+    'memberof': ('groups__dn', 'multi'),
+}
+ORG_ATTRIBUTES = {
+    'name': ('name', 'str'),
+    'ou': ('name', 'str'),
+    'distinguishedname': ('dn', 'str'),
+    'objectguid': ('objectGUID', 'guid'),
+}
+MODEL_ATTRIBUTES = {Userinfo: USER_ATTRIBUTES, Orginfo: ORG_ATTRIBUTES}
+
+# 过滤条件可能匹配的AD对象种类，本地表只能回答用户和OU
+ALL_KINDS = frozenset(['user', 'computer', 'contact', 'group', 'ou', 'other'])
+MODEL_KINDS = {Userinfo: 'user', Orginfo: 'ou'}
+# (属性, 值) -> 匹配的对象种类；计算机继承自user，联系人的objectCategory也是person，所以用户需要同时限定两者
+CLASS_KINDS = {
+    ('objectclass', 'top'): ALL_KINDS,
+    ('objectclass', 'person'): frozenset(['user', 'computer', 'contact']),
+    ('objectclass', 'organizationalperson'): frozenset(['user', 'computer', 'contact']),
+    ('objectclass', 'user'): frozenset(['user', 'computer']),
+    ('objectclass', 'computer'): frozenset(['computer']),
+    ('objectclass', 'contact'): frozenset(['contact']),
+    ('objectclass', 'group'): frozenset(['group']),
+    ('objectclass', 'organizationalunit'): frozenset(['ou']),
+    ('objectcategory', 'person'): frozenset(['user', 'contact']),
+    ('objectcategory', 'computer'): frozenset(['computer']),
+    ('objectcategory', 'group'): frozenset(['group']),
+    ('objectcategory', 'organizational-unit'): frozenset(['ou']),
+}
+
+# 本地查询结果中返回的属性，与AD域中的属性名一致
+USER_ENTRY_ATTRIBUTES = ['name', 'displayName', 'distinguishedName', 'sAMAccountName', 'userPrincipalName', 'mail',
+                         'telephoneNumber', 'badPwdCount', 'userAccountControl', 'memberOf']
+ORG_ENTRY_ATTRIBUTES = ['name', 'distinguishedName', 'objectGUID']
+ENTRY_ATTRIBUTES = {Userinfo: USER_ENTRY_ATTRIBUTES, Orginfo: ORG_ENTRY_ATTRIBUTES}
+
+# 将属性条件限定为用户对象
+USER_FILTER = '(&(objectCategory=person)(objectClass=user){})'
+
+
+def _unescape(value):
+    """ 还原过滤条件中的 \\XX 转义，返回bytes """
+    raw = value.encode('utf-8')
+    res = bytearray()
+    i = 0
+    while i < len(raw):
+        if raw[i:i + 1] == b'\\':
+            try:
+                res.append(int(raw[i + 1:i + 3], 16))
+            except ValueError:
+                raise LdapFilterError("无效的转义字符 %s" % value)
+            i += 3
+        else:
+            res.append(raw[i])
+            i += 1
+    return bytes(res)
+
+
+class _Parser():
+    """ 递归下降解析，结果为元组形式的语法树 """
+    def __init__(self, text):
+        self.text = text
+        self.pos = 0
+
+    def parse(self):
+        node = self._filter()
+        if self.pos != len(self.text):
+            raise LdapFilterError("过滤条件结尾有多余字符 %s" % self.text[self.pos:])
+        return node
+
+    def _expect(self, char):
+        if self.text[self.pos:self.pos + 1] != char:
+            raise LdapFilterError("过滤条件第%s个字符应为 %s" % (self.pos, char))
+        self.pos += 1
+
+    def _filter(self):
+        self._expect('(')
+        char = self.text[self.pos:self.pos + 1]
+        if char in ('&', '|'):
+            self.pos += 1
+            children = []
+            while self.text[self.pos:self.pos + 1] == '(':
+                children.append(self._filter())
+            if not children:
+                raise LdapFilterError("%s 条件中没有子条件" % char)
+            node = ('and' if char == '&' else 'or', children)
+        elif char == '!':
+            self.pos += 1
+            node = ('not', self._filter())
+        else:
+            node = self._item()
+        self._expect(')')
+        return node
+
+    def _item(self):
+        end = self.text.find(')', self.pos)
+        if end == -1:
+            raise LdapFilterError("过滤条件缺少 )")
+        item = self.text[self.pos:end]
+        self.pos = end
+        if '=' not in item:
+            raise LdapFilterError("无效的过滤条件 %s" % item)
+        attr, value = item.split('=', 1)
+        if not attr or attr[-1] in '~<>:' or ':' in attr:
+            raise LdapFilterError("不支持的匹配方式 %s" % item)
+        if value == '*':
+            return ('present', attr)
+        if '*' not in value:
+            return ('eq', attr, _unescape(value))
+        if value.endswith('*') and '*' not in value[:-1]:
+            return ('prefix', attr, _unescape(value[:-1]))
+        raise LdapFilterError("不支持的子串匹配 %s" % item)
+
+
+def parse_filter(text):
+    """ 解析LDAP过滤条件，没有外层括号时自动补全 """
+    text = text.strip()
+    if not text.startswith('('):
+        text = '(' + text + ')'
+    return _Parser(text).parse()
+
+
+def _class_kinds(node):
+    """ objectClass/objectCategory条件匹配的对象种类 """
+    if node[0] == 'present':
+        return ALL_KINDS
+    if node[0] != 'eq':
+        raise LdapFilterError("objectClass不支持前缀匹配")
+    attr = node[1].lower()
+    value = node[2].decode('utf-8', 'replace').lower()
+    if attr == 'objectcategory':
+        value = value.split(',', 1)[0].split('=')[-1]   # 支持 CN=Person,CN=Schema,... 形式
+    return CLASS_KINDS.get((attr, value), frozenset(['other']))
+
+
+def object_kinds(node):
+    """ 过滤条件可能匹配的对象种类，没有限定objectClass/objectCategory时为全部种类 """
+    if node[0] == 'and':
+        kinds = ALL_KINDS
+        for child in node[1]:
+            kinds = kinds & object_kinds(child)
+        return kinds
+    if node[0] == 'or':
+        kinds = frozenset()
+        for child in node[1]:
+            kinds = kinds | object_kinds(child)
+        return kinds
+    if node[0] == 'not':
+        return ALL_KINDS
+    if node[1].lower() in ('objectclass', 'objectcategory'):
+        return _class_kinds(node)
+    return ALL_KINDS
+
+
+def compile_filter(node, model):
+    """
+    将语法树编译为model上的Q对象，属性不在本地表中时抛出LdapFilterError
+    限定为其他种类对象的 & 条件直接编译为恒假，不再检查其中的属性
+    """
+    if node[0] == 'and':
+        if MODEL_KINDS[model] not in object_kinds(node):
+            return MATCH_NONE
+        query = MATCH_ALL
+        for child in node[1]:
+            query &= compile_filter(child, model)
+        return query
+    if node[0] == 'or':
+        query = MATCH_NONE
+        for child in node[1]:
+            query |= compile_filter(child, model)
+        return query
+    if node[0] == 'not':
+        return ~compile_filter(node[1], model)
+    attr = node[1].lower()
+    if attr in ('objectclass', 'objectcategory'):
+        return MATCH_ALL if MODEL_KINDS[model] in _class_kinds(node) else MATCH_NONE
+    if attr not in MODEL_ATTRIBUTES[model]:
+        raise LdapFilterError("%s 中没有属性 %s" % (model.__name__, node[1]))
+    field, kind = MODEL_ATTRIBUTES[model][attr]
+    if node[0] == 'present':
+        if kind == 'multi':
+            return Q(**{field.split('__')[0] + '__isnull': False})
+        if kind == 'int':
+            return MATCH_ALL
+        return ~Q(**{field: ''})
+    value = node[2]
+    if kind == 'guid':
+        if node[0] != 'eq' or len(value) != 16:
+            raise LdapFilterError("objectGUID只支持16字节的等值匹配")
+        return Q(**{field: str(uuid.UUID(bytes_le=value))})
+    try:
+        value = value.decode('utf-8')
+    except UnicodeDecodeError:
+        raise LdapFilterError("%s 的值不是有效的字符串" % node[1])
+    if kind == 'int':
+        if node[0] != 'eq':
+            raise LdapFilterError("整数属性 %s 不支持前缀匹配" % node[1])
+        try:
+            return Q(**{field: int(value)})
+        except ValueError:
+            raise LdapFilterError("%s 的值不是整数" % node[1])
+    # AD中这些属性的匹配规则不区分大小写
+    return Q(**{field + ('__iexact' if node[0] == 'eq' else '__istartswith'): value})
+
+
+def _user_entry(user):
+    return {
+        'dn': user.dn,
+        'attributes': {
+            'name': user.name,
+            'displayName': user.displayName,
+            'distinguishedName': user.dn,
+            'sAMAccountName': user.sAMAccountName,
+            'userPrincipalName': user.userPrincipalName,
+            'mail': user.mail,
+            'telephoneNumber': user.telephoneNumber,
+            'badPwdCount': user.badPwdCount,
+            'userAccountControl': user.userAccountControl,
+            'memberOf': user.memberOf.split('\n') if user.memberOf else [],
+        },
+    }
+
+
+def _org_entry(org):
+    return {'dn': org.dn, 'attributes': {'name': org.name, 'distinguishedName': org.dn, 'objectGUID': org.objectGUID}}
+
+
+def _select(entry, attributes):
+    """ 只保留需要返回的属性，与ldap3一样，没有值的属性返回空列表 """
+    if not attributes or '*' in attributes:
+        return entry
+    wanted = {i.lower() for i in attributes}
+    entry['attributes'] = {k: [] if v in ('', None) else v for k, v in entry['attributes'].items() if k.lower() in wanted}
+    return entry
+
+
+def local_kinds(node):
+    """ 过滤条件能在本地回答时返回匹配的对象种类，否则抛出LdapFilterError """
+    kinds = object_kinds(node)
+    if not kinds or not kinds <= set(MODEL_KINDS.values()):
+        raise LdapFilterError("过滤条件没有限定为用户或OU")
+    return kinds
+
+
+def default_attributes(filter_text):
+    """
+    没有指定返回属性时，本地和AD域统一返回本地表中有的属性，用户和OU都可能匹配时取两者共有的属性
+    过滤条件不能在本地回答时返回None，由AD域返回全部属性
+    """
+    try:
+        kinds = local_kinds(parse_filter(filter_text))
+    except LdapFilterError:
+        return None
+    lists = [attributes for model, attributes in ENTRY_ATTRIBUTES.items() if MODEL_KINDS[model] in kinds]
+    return [i for i in lists[0] if all(i in attributes for attributes in lists)]
+
+
+def search_local(filter_text, attributes=None):
+    """
+    在本地表中执行LDAP过滤条件，返回与OptLdap.get_obj_info相同格式的列表
+    过滤条件没有限定为用户(objectCategory=person且objectClass=user)或OU、任一条件无法在本地表中编译、
+    或需要返回的属性本地没有时抛出LdapFilterError，不返回不完整的结果
+    """
+    node = parse_filter(filter_text)
+    kinds = local_kinds(node)
+    queries = []
+    for model, to_entry in ((Userinfo, _user_entry), (Orginfo, _org_entry)):
+        if MODEL_KINDS[model] not in kinds:
+            continue
+        query = compile_filter(node, model)
+        if attributes and '*' not in attributes and {i.lower() for i in attributes} - {i.lower() for i in ENTRY_ATTRIBUTES[model]}:
+            raise LdapFilterError("本地表中没有需要返回的全部属性 %s" % attributes)
+        queries.append((model, query, to_entry))
+    res = []
+    for model, query, to_entry in queries:
+        # memberOf条件会关联组成员表，需要去重
+        res.extend(_select(to_entry(obj), attributes) for obj in model.objects.filter(query).distinct().order_by('id'))
+    return res
@@ -0,0 +1,124 @@
+"""
+AD域控健康评分和熔断
+按每台域控最近的耗时(EWMA)和错误率排序，优先使用最快的健康域控
+连续失败的域控熔断一段时间，到期后放行一次探测请求，探测失败则按指数退避延长熔断时间
+"""
+import time
+import logging
+import threading
+from collections import deque
+from django.conf import settings
+from infox.utils.ldap_metrics import LatencyRecorder
+
+ldap_logger = logging.getLogger('optLdap')
+
+DEFAULT_HEALTH_SETTINGS = {
+    'FAILURE_THRESHOLD': 3,   # 连续失败该次数后熔断
+    'BACKOFF_BASE': 5,        # 第一次熔断的秒数，之后每次探测失败翻倍
+    'BACKOFF_MAX': 300,       # 熔断最长秒数
+    'ERROR_WINDOW': 50,       # 计算错误率的最近请求数
+}
+
+CLOSED, OPEN, HALF_OPEN = 'closed', 'open', 'half_open'
+
+
+def get_health_setting(name):
+    """ 获取settings文件中LDAP_HEALTH的配置，未配置时使用默认值 """
+    settings_dict = getattr(settings, 'LDAP_HEALTH', {})
+    return settings_dict.get(name, DEFAULT_HEALTH_SETTINGS[name])
+
+
+class ServerHealth():
+    """ 单台域控的耗时、错误率和熔断状态 """
+    def __init__(self, server, window=50):
+        self.server = server
+        self.name = "%s:%s" % (server.host, server.port)
+        self.latency = LatencyRecorder()
+        self.recent = deque(maxlen=window)   # 最近请求是否成功
+        self.failures = 0                     # 连续失败次数
+        self.state = CLOSED
+        self.backoff = 0
+        self.retry_at = 0
+
+    @property
+    def error_rate(self):
+        return self.recent.count(False) / len(self.recent) if self.recent else 0
+
+    @property
+    def score(self):
+        """ 分数越低越优先，按错误率放大平均耗时，没有耗时数据的域控为0以便获得数据 """
+        if self.latency.ewma is None:
+            return 0
+        return self.latency.ewma * (1 + 4 * self.error_rate)
+
+    def to_dict(self):
+        stats = self.latency.get_stats()
+        stats.update({
+            'server': self.name,
+            'state': self.state,
+            'score_ms': round(self.score * 1000, 2),
+            'error_rate': round(self.error_rate, 4),
+            'failures': self.failures,
+            'retry_in': max(0, round(self.retry_at - time.monotonic(), 1)) if self.state != CLOSED else 0,
+        })
+        return stats
+
+
+class ServerSelector():
+    """ 进程内共享的域控选择器，连接池和账号验证都通过它选择域控并上报结果 """
+    def __init__(self, servers, failure_threshold=3, backoff_base=5, backoff_max=300, window=50):
+        self.failure_threshold = failure_threshold
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.servers = [ServerHealth(server, window) for server in servers]
+        self._by_server = {id(health.server): health for health in self.servers}
+        self._lock = threading.Lock()
+
+    def get(self, server):
+        return self._by_server.get(id(server))
+
+    def ordered(self):
+        """
+        返回本次请求依次尝试的域控
+        熔断到期的域控作为探测排在最前，同一熔断周期内只放行一次；其余健康的域控按分数排序
+        全部熔断时按恢复时间排序全部返回
+        """
+        now = time.monotonic()
+        healthy, probes = [], []
+        with self._lock:
+            for health in self.servers:
+                if health.state == CLOSED:
+                    healthy.append(health)
+                elif now >= health.retry_at:
+                    health.state = HALF_OPEN
+                    health.retry_at = now + health.backoff   # 探测请求没有上报结果时，下个周期再探测
+                    probes.append(health)
+        healthy.sort(key=lambda health: health.score)
+        if healthy or probes:
+            return probes + healthy
+        return sorted(self.servers, key=lambda health: health.retry_at)
+
+    def record_success(self, health, seconds):
+        health.latency.record(seconds)
+        with self._lock:
+            health.recent.append(True)
+            health.failures = 0
+            if health.state != CLOSED:
+                ldap_logger.warning("域控 %s 恢复", health.name)
+            health.state = CLOSED
+            health.backoff = 0
+
+    def record_failure(self, health):
+        health.latency.record_error()
+        with self._lock:
+            health.recent.append(False)
+            health.failures += 1
+            if health.state != CLOSED or health.failures >= self.failure_threshold:
+                health.backoff = min(self.backoff_max, health.backoff * 2 if health.backoff else self.backoff_base)
+                health.retry_at = time.monotonic() + health.backoff
+                health.state = OPEN
+                ldap_logger.warning("域控 %s 连续失败 %s 次，熔断 %ss", health.name, health.failures, health.backoff)
+
+    def get_stats(self):
+        """ 每台域控的分数、错误率和熔断状态，按当前优先顺序排列 """
+        return sorted((health.to_dict() for health in self.servers), key=lambda stats: (stats['state'] != CLOSED, stats['score_ms']))
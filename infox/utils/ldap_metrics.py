@@ -0,0 +1,45 @@
+"""
+AD域操作的耗时统计
+"""
+import threading
+from collections import deque
+
+
+class LatencyRecorder():
+    """ 记录最近window次操作的耗时和错误次数，计算p50/p99 """
+    def __init__(self, window=1000, alpha=0.2):
+        self.alpha = alpha
+        self._samples = deque(maxlen=window)
+        self._lock = threading.Lock()
+        self.count = 0
+        self.errors = 0
+        self.ewma = None   # 指数加权平均耗时，未有数据时为None
+
+    def record(self, seconds):
+        with self._lock:
+            self._samples.append(seconds)
+            self.count += 1
+            self.ewma = seconds if self.ewma is None else self.alpha * seconds + (1 - self.alpha) * self.ewma
+
+    def record_error(self):
+        with self._lock:
+            self.errors += 1
+
+    def percentile(self, percent):
+        """ 最近window次耗时的百分位数(最近秩法) """
+        with self._lock:
+            samples = sorted(self._samples)
+        if not samples:
+            return None
+        index = max(0, -(-len(samples) * percent // 100) - 1)
+        return samples[int(index)]
+
+    def get_stats(self):
+        p50, p99 = self.percentile(50), self.percentile(99)
+        return {
+            'count': self.count,
+            'errors': self.errors,
+            'p50_ms': None if p50 is None else round(p50 * 1000, 2),
+            'p99_ms': None if p99 is None else round(p99 * 1000, 2),
+            'ewma_ms': None if self.ewma is None else round(self.ewma * 1000, 2),
+        }
@@ -0,0 +1,221 @@
+"""
+AD域连接池
+进程内共享一组已完成NTLM绑定的连接，OptLdap从池中借出连接，用完归还，避免每次请求都重新建立SSL连接并绑定
+"""
+import time
+import queue
+import logging
+import threading
+from ldap3 import Connection, NTLM, BASE
+from ldap3.core import exceptions
+from django.conf import settings
+from infox.utils.ldap_metrics import LatencyRecorder
+from infox.utils.ldap_health import CLOSED
+
+ldap_logger = logging.getLogger('optLdap')
+
+DEFAULT_POOL_SETTINGS = {
+    'SIZE': 10,              # 连接池最大连接数
+    'TIMEOUT': 10,           # 连接池耗尽时等待可用连接的秒数
+    'CHECK_INTERVAL': 60,    # 连接空闲超过该秒数，借出前先做健康检查
+    'MAX_LIFETIME': 3600,    # 连接最长存活秒数，超过后重新建立
+}
+
+
+def get_pool_setting(name):
+    """ 获取settings文件中LDAP_POOL的配置，未配置时使用默认值 """
+    settings_dict = getattr(settings, 'LDAP_POOL', {})
+    return settings_dict.get(name, DEFAULT_POOL_SETTINGS[name])
+
+
+class LdapPoolTimeout(exceptions.LDAPException):
+    """ 等待可用连接超时 """
+
+
+class PooledConnection():
+    """ 池中的连接及其所在域控、创建和使用时间 """
+    def __init__(self, connection, health=None):
+        self.connection = connection
+        self.health = health
+        self.created = time.monotonic()
+        self.last_used = self.created
+
+
+class LdapConnectionPool():
+    """ 已绑定的AD连接池 """
+    def __init__(self, servers, user, password, size=10, timeout=10, check_interval=60, max_lifetime=3600, schema_cache=None, selector=None):
+        self.servers = servers
+        self.schema_cache = schema_cache
+        self.selector = selector   # 按健康评分选择域控，未设置时由ldap3按顺序选择
+        self.user = user
+        self.password = password
+        self.size = size
+        self.timeout = timeout
+        self.check_interval = check_interval
+        self.max_lifetime = max_lifetime
+        self._idle = queue.LifoQueue()   # 后进先出，优先复用最近使用过的连接
+        self._in_use = {}
+        self._created = 0
+        self._lock = threading.Lock()
+        self._stats = {
+            'hits': 0,           # 直接借到空闲连接
+            'misses': 0,         # 没有空闲连接，新建连接
+            'waits': 0,          # 连接池已满，等待其他请求归还
+            'timeouts': 0,       # 等待超时
+            'rebinds': 0,        # 健康检查失败或超过存活时间，重新建立连接
+            'discards': 0,       # 归还时连接已失效被丢弃
+            'wait_time_total': 0.0,
+            'wait_time_max': 0.0,
+        }
+        self.connect_latency = LatencyRecorder()   # 新建连接(含SSL握手和绑定)的耗时
+
+    def _bind(self, server):
+        if self.schema_cache is not None:
+            if isinstance(server, list):
+                self.schema_cache.prepare_all(server)
+            else:
+                self.schema_cache.prepare(server)
+        start = time.monotonic()
+        try:
+            connection = Connection(
+                server=server,
+                auto_bind=True,
+                authentication=NTLM,
+                user=self.user,
+                password=self.password,
+            )
+        except exceptions.LDAPException:
+            self.connect_latency.record_error()
+            raise
+        elapsed = time.monotonic() - start
+        self.connect_latency.record(elapsed)
+        ldap_logger.info("连接池新建AD域连接 %s", connection)
+        return connection, elapsed
+
+    def _connect(self):
+        """ 新建连接并完成NTLM绑定，按域控健康评分依次尝试 """
+        if self.selector is None:
+            return PooledConnection(self._bind(self.servers)[0])
+        error = None
+        for health in self.selector.ordered():
+            try:
+                connection, elapsed = self._bind(health.server)
+            except exceptions.LDAPException as ept:
+                self.selector.record_failure(health)
+                ldap_logger.warning("连接域控 %s 失败 %s", health.name, ept)
+                error = ept
+                continue
+            self.selector.record_success(health, elapsed)
+            return PooledConnection(connection, health)
+        raise error
+
+    def _is_alive(self, entry):
+        """ 通过读取RootDSE检查连接是否可用 """
+        connection = entry.connection
+        if connection.closed or not connection.bound:
+            return False
+        if entry.health is not None and entry.health.state != CLOSED:
+            return False   # 所在域控已熔断，换到其他域控
+        start = time.monotonic()
+        try:
+            alive = connection.search(search_base='', search_filter='(objectClass=*)', search_scope=BASE, attributes=['1.1'])
+        except exceptions.LDAPException as ept:
+            ldap_logger.warning("连接池健康检查失败 %s - %s", connection, ept)
+            alive = False
+        if entry.health is not None:
+            if alive:
+                self.selector.record_success(entry.health, time.monotonic() - start)
+            else:
+                self.selector.record_failure(entry.health)
+        return alive
+
+    def _close(self, entry):
+        try:
+            entry.connection.unbind()
+        except exceptions.LDAPException as ept:
+            ldap_logger.warning("连接池关闭连接失败 %s - %s", entry.connection, ept)
+
+    def _refresh(self, entry):
+        """ 对超过存活时间、所在域控已熔断或者空闲过久的连接做检查，失效的连接重新建立 """
+        now = time.monotonic()
+        expired = now - entry.created > self.max_lifetime
+        if entry.health is not None and entry.health.state != CLOSED:
+            expired = True   # 域控熔断后不再复用其上的空闲连接，即使刚刚用过
+        if not expired and now - entry.last_used < self.check_interval:
+            return entry
+        if not expired and self._is_alive(entry):
+            return entry
+        self._close(entry)
+        with self._lock:
+            self._stats['rebinds'] += 1
+        return self._connect()
+
+    def acquire(self):
+        """ 借出一个已绑定的连接 """
+        start = time.monotonic()
+        entry = None
+        try:
+            entry = self._idle.get_nowait()
+            counter = 'hits'
+        except queue.Empty:
+            with self._lock:
+                can_create = self._created < self.size
+                if can_create:
+                    self._created += 1
+            if can_create:
+                counter = 'misses'
+            else:
+                counter = 'waits'
+                try:
+                    entry = self._idle.get(timeout=self.timeout)
+                except queue.Empty:
+                    with self._lock:
+                        self._stats['timeouts'] += 1
+                    ldap_logger.error("连接池等待可用连接超时 size:%s timeout:%s", self.size, self.timeout)
+                    raise LdapPoolTimeout("LDAP connection pool exhausted")
+        try:
+            entry = self._refresh(entry) if entry else self._connect()
+        except exceptions.LDAPException:
+            with self._lock:
+                self._created -= 1
+            raise
+        waited = time.monotonic() - start
+        entry.last_used = time.monotonic()
+        with self._lock:
+            self._stats[counter] += 1
+            self._stats['wait_time_total'] += waited
+            self._stats['wait_time_max'] = max(self._stats['wait_time_max'], waited)
+            self._in_use[id(entry.connection)] = entry
+        return entry.connection
+
+    def release(self, connection, discard=False):
+        """
+        归还连接，已断开的连接直接丢弃
+        借出期间的具体操作没有经过连接池，不计入域控的耗时评分；评分只来自新建连接和健康检查，
+        操作失败时由调用方以discard=True归还，记为一次失败
+        """
+        with self._lock:
+            entry = self._in_use.pop(id(connection), None)
+        if entry is None:
+            return
+        entry.last_used = time.monotonic()
+        if discard and entry.health is not None:
+            self.selector.record_failure(entry.health)
+        if discard or connection.closed or not connection.bound:
+            self._close(entry)
+            with self._lock:
+                self._created -= 1
+                self._stats['discards'] += 1
+            return
+        self._idle.put(entry)
+
+    def get_stats(self):
+        """ 连接池的命中、等待等统计信息 """
+        with self._lock:
+            stats = dict(self._stats)
+            stats.update({'size': self.size, 'created': self._created, 'in_use': len(self._in_use), 'idle': self._idle.qsize()})
+        requests = stats['hits'] + stats['misses'] + stats['waits']
+        stats['hit_ratio'] = round(stats['hits'] / requests, 4) if requests else 0
+        stats['wait_time_avg'] = round(stats['wait_time_total'] / requests, 6) if requests else 0
+        stats['connect'] = self.connect_latency.get_stats()
+        return stats
@@ -0,0 +1,142 @@
+"""
+AD域服务器信息(DSA info)和schema的本地缓存
+服务器定义为get_info=NONE，建立连接前从缓存文件加载，避免每次连接都下载完整schema
+缓存文件超过TTL后在后台线程中重新下载，首次没有缓存文件时同步下载
+"""
+import os
+import time
+import logging
+import tempfile
+import threading
+from ldap3 import Server, Connection, NTLM, ALL, NONE
+from ldap3.core import exceptions
+from ldap3.protocol.rfc4512 import DsaInfo, SchemaInfo
+from django.conf import settings
+from infox.utils.ldap_metrics import LatencyRecorder
+
+ldap_logger = logging.getLogger('optLdap')
+
+DEFAULT_SCHEMA_SETTINGS = {
+    'CACHE_DIR': os.path.join(tempfile.gettempdir(), 'galilee_ldap_schema'),   # 缓存文件目录
+    'TTL': 86400,          # 缓存文件超过该秒数后在后台刷新
+    'RETRY_INTERVAL': 60,  # 下载失败后重试的间隔秒数
+}
+
+
+def get_schema_setting(name):
+    """ 获取settings文件中LDAP_SCHEMA的配置，未配置时使用默认值 """
+    settings_dict = getattr(settings, 'LDAP_SCHEMA', {})
+    return settings_dict.get(name, DEFAULT_SCHEMA_SETTINGS[name])
+
+
+class SchemaCache():
+    """ 按域控保存的DSA info和schema缓存 """
+    def __init__(self, user, password, cache_dir, ttl=86400, retry_interval=60):
+        self.user = user
+        self.password = password
+        self.cache_dir = cache_dir
+        self.ttl = ttl
+        self.retry_interval = retry_interval
+        self._loaded = {}        # {域控: 缓存内容的生成时间}，下载失败且没有缓存时为0
+        self._retry_at = {}      # {域控: 下载失败后下次允许重试的时间}
+        self._refreshing = set()
+        self._lock = threading.Lock()
+        self.load_latency = LatencyRecorder()
+        self.download_latency = LatencyRecorder()
+
+    @staticmethod
+    def _key(server):
+        return "%s_%s" % (server.host, server.port)
+
+    def _paths(self, server):
+        key = self._key(server)
+        return os.path.join(self.cache_dir, key + '.info.json'), os.path.join(self.cache_dir, key + '.schema.json')
+
+    def _attach(self, server, info, schema):
+        server.attach_dsa_info(info)
+        server.attach_schema_info(schema)
+        server.get_info = NONE   # 已有schema，绑定时不再从服务器读取
+
+    def _load(self, server):
+        """ 从缓存文件加载，返回是否成功 """
+        info_path, schema_path = self._paths(server)
+        if not (os.path.exists(info_path) and os.path.exists(schema_path)):
+            return False
+        start = time.monotonic()
+        try:
+            self._attach(server, DsaInfo.from_file(info_path), SchemaInfo.from_file(schema_path))
+        except (OSError, ValueError) as ept:
+            ldap_logger.warning("加载AD域schema缓存失败 %s - %s", info_path, ept)
+            return False
+        self.load_latency.record(time.monotonic() - start)
+        self._loaded[self._key(server)] = min(os.path.getmtime(info_path), os.path.getmtime(schema_path))
+        return True
+
+    def _download(self, server):
+        """ 连接域控读取DSA info和schema，写入缓存文件后加载到server """
+        key = self._key(server)
+        start = time.monotonic()
+        try:
+            connection = Connection(Server(server.host, port=server.port, use_ssl=server.ssl, tls=server.tls, get_info=ALL, connect_timeout=server.connect_timeout),
+                                    user=self.user, password=self.password, authentication=NTLM, auto_bind=True)
+            try:
+                info, schema = connection.server.info, connection.server.schema
+            finally:
+                connection.unbind()
+            os.makedirs(self.cache_dir, exist_ok=True)
+            for obj, path in zip((info, schema), self._paths(server)):
+                obj.to_file(path + '.tmp')
+                os.replace(path + '.tmp', path)   # 先写临时文件，避免其他进程读到不完整的文件
+        except (exceptions.LDAPException, OSError) as ept:
+            self.download_latency.record_error()
+            ldap_logger.error("下载AD域schema失败 %s - %s", key, ept)
+            # 没有可用的schema时退回到绑定时读取，稍后重试下载
+            if server.schema is None:
+                server.get_info = ALL
+            self._loaded.setdefault(key, 0)
+            self._retry_at[key] = time.time() + self.retry_interval
+            return False
+        self.download_latency.record(time.monotonic() - start)
+        self._attach(server, info, schema)
+        self._loaded[key] = time.time()
+        ldap_logger.info("下载AD域schema %s 耗时 %.3fs", key, time.monotonic() - start)
+        return True
+
+    def _refresh(self, server):
+        try:
+            self._download(server)
+        finally:
+            with self._lock:
+                self._refreshing.discard(self._key(server))
+
+    def prepare(self, server):
+        """ 建立连接前调用，确保server已加载schema，缓存过期时启动后台刷新 """
+        key = self._key(server)
+        if key not in self._loaded:
+            with self._lock:
+                if key not in self._loaded and not self._load(server):
+                    self._download(server)
+            return
+        now = time.time()
+        if now - self._loaded[key] < self.ttl or now < self._retry_at.get(key, 0):
+            return
+        with self._lock:
+            if key in self._refreshing:
+                return
+            self._refreshing.add(key)
+        threading.Thread(target=self._refresh, args=(server,), name='ldap-schema-refresh', daemon=True).start()
+
+    def prepare_all(self, servers):
+        for server in servers:
+            self.prepare(server)
+
+    def get_stats(self):
+        """ 缓存文件的生成时间、加载和下载耗时 """
+        now = time.time()
+        return {
+            'cache_dir': self.cache_dir,
+            'ttl': self.ttl,
+            'servers': {key: {'age': round(now - loaded, 1) if loaded else None} for key, loaded in self._loaded.items()},
+            'load': self.load_latency.get_stats(),
+            'download': self.download_latency.get_stats(),
+        }
@@ -0,0 +1,421 @@
+"""
+AD域用户、OU批量同步到数据库
+通过分页查询逐条读取AD域对象，按块使用bulk_create/bulk_update写入数据库，内存占用与目录大小无关
+"""
+import time
+import uuid
+import logging
+from django.db import transaction
+from django.db.models import CharField, Value
+from django.db.models.functions import Concat, Length, Substr
+from ldap3.utils.dn import parse_dn
+from ldap3.core.exceptions import LDAPInvalidDnError
+from infox.models import Orginfo, Userinfo, Groupinfo, SyncWatermark, dn_to_path
+from infox.utils.org_tree import get_org_tree, reload_org_tree, bump_version
+from infox.utils.group_cache import bump_group_version
+from Galilee.batch import chunked, merge_rows, batch_results, check_items, validate_rows
+
+sync_logger = logging.getLogger('infox')
+
+USER_FIELDS = ['name', 'displayName', 'dn', 'memberOf', 'badPwdCount', 'userPrincipalName', 'mail', 'telephoneNumber', 'userAccountControl']
+ORG_FIELDS = ['name', 'dn']
+
+
+def format_guid(value):
+    """ objectGUID统一转换为不带括号的UUID字符串 """
+    if isinstance(value, bytes):
+        return str(uuid.UUID(bytes_le=value))
+    return str(uuid.UUID(value))
+
+
+def check_dn(dn, rdn_type):
+    """
+    检查批量提交的dn能否解析、首个RDN是否为指定类型并且位于域名(DC)之下
+    :param rdn_type: OU对象为OU，用户为CN
+    :return 错误信息，通过时返回None
+    """
+    try:
+        parts = parse_dn(dn, escape=False, strip=True)
+    except (LDAPInvalidDnError, TypeError, AttributeError):
+        return "dn格式错误 " + str(dn)
+    if not parts or parts[0][0].lower() != rdn_type.lower() or not any(attr.lower() == 'dc' for attr, _, _ in parts):
+        return "dn格式错误 " + str(dn)
+    return None
+
+
+def _single(value, default=''):
+    """ AD中未设置的属性返回空列表，多值属性取第一个 """
+    if isinstance(value, list):
+        return value[0] if value else default
+    return default if value is None else value
+
+
+def user_entry_to_row(entry):
+    """ 将AD域用户对象转换为Userinfo字段 """
+    attrs = entry['attributes']
+    member_of = attrs.get('memberOf') or []
+    if isinstance(member_of, str):
+        member_of = [member_of]
+    return {
+        'name': _single(attrs.get('name')),
+        'displayName': _single(attrs.get('displayName')),
+        'dn': entry['dn'],
+        'memberOf': '\n'.join(member_of),
+        'badPwdCount': int(_single(attrs.get('badPwdCount'), 0)),
+        'sAMAccountName': _single(attrs.get('sAMAccountName')),
+        'userPrincipalName': _single(attrs.get('userPrincipalName')),
+        'mail': _single(attrs.get('mail')),
+        'telephoneNumber': _single(attrs.get('telephoneNumber')),
+        'userAccountControl': int(_single(attrs.get('userAccountControl'), 0)),
+        'org_dn': entry['dn'].split(",", 1)[1],
+    }
+
+
+def org_entry_to_row(entry):
+    """ 将AD域OU对象转换为Orginfo字段 """
+    attrs = entry['attributes']
+    return {
+        'name': _single(attrs.get('name')),
+        'objectGUID': format_guid(_single(attrs.get('objectGUID'))),
+        'dn': entry['dn'],
+    }
+
+
+def split_member_of(member_of):
+    """ memberOf在数据库中以换行分隔保存 """
+    if isinstance(member_of, list):
+        return [i for i in member_of if i]
+    return [i.strip() for i in (member_of or '').splitlines() if i.strip()]
+
+
+def _group_name(dn):
+    try:
+        return parse_dn(dn, escape=False, strip=True)[0][1]
+    except (LDAPInvalidDnError, IndexError):
+        return dn.split(",", 1)[0].split("=", 1)[-1]
+
+
+def sync_memberships(user_groups):
+    """
+    按memberOf重建用户的组成员关系，组不存在时批量创建，成员关系有变化时使有效组缓存失效
+    :param user_groups: {user_id: [group dn]}
+    """
+    dns = {dn for group_dns in user_groups.values() for dn in group_dns}
+    groups = Groupinfo.objects.in_bulk(list(dns), field_name='dn')
+    missing = dns - set(groups)
+    if missing:
+        Groupinfo.objects.bulk_create([Groupinfo(name=_group_name(dn), dn=dn) for dn in missing], ignore_conflicts=True)
+        groups.update(Groupinfo.objects.in_bulk(list(missing), field_name='dn'))
+    membership = Userinfo.groups.through
+    pairs = {(user_id, groups[dn].id) for user_id, group_dns in user_groups.items() for dn in group_dns}
+    existing = set(membership.objects.filter(userinfo_id__in=list(user_groups)).values_list('userinfo_id', 'groupinfo_id'))
+    if pairs == existing:
+        return
+    with transaction.atomic():
+        membership.objects.filter(userinfo_id__in=list(user_groups)).delete()
+        membership.objects.bulk_create([membership(userinfo_id=user_id, groupinfo_id=group_id) for user_id, group_id in pairs])
+    bump_group_version()
+
+
+def in_subtree(dn, base_dn):
+    """ 判断dn是否位于base_dn之下(包含base_dn本身) """
+    dn, base_dn = dn.lower(), base_dn.lower()
+    return dn == base_dn or dn.endswith("," + base_dn)
+
+
+def upsert_orgs(rows):
+    """
+    按objectGUID新增或更新OU，只更新行中提供的字段
+    :param rows: [{"name": "IT组", "objectGUID": "...", "dn": "OU=IT组,..."}]
+    :return {"created": [objectGUID], "updated": [objectGUID]}
+    """
+    rows = merge_rows(rows, 'objectGUID')
+    existing = Orginfo.objects.in_bulk(list(rows), field_name='objectGUID')
+    to_create, to_update, update_fields = [], [], set()
+    for guid, row in rows.items():
+        values = {field: row[field] for field in ORG_FIELDS if field in row}
+        if 'dn' in values:
+            values['path'] = dn_to_path(values['dn'])   # bulk操作不会调用save()，需要手动生成路径
+        if guid in existing:
+            obj = existing[guid]
+            for field, value in values.items():
+                setattr(obj, field, value)
+            update_fields.update(values)
+            to_update.append(obj)
+        else:
+            to_create.append(Orginfo(objectGUID=guid, **values))
+    with transaction.atomic():
+        Orginfo.objects.bulk_create(to_create)
+        if update_fields:
+            Orginfo.objects.bulk_update(to_update, list(update_fields))
+    bump_version()   # bulk操作不会触发信号，需要手动使部门树失效
+    return {'created': [i.objectGUID for i in to_create], 'updated': [i.objectGUID for i in to_update]}
+
+
+def get_org_ids(dns):
+    """ 从部门树得到OU的dn到id的映射 """
+    tree = get_org_tree()
+    dns = set(dns)
+    missing = [dn for dn in dns if dn.lower() not in tree.by_dn]
+    if missing and Orginfo.objects.filter(dn__in=missing).exists():   # 其他进程新增的OU，部门树还没有失效
+        tree = reload_org_tree()
+    org_ids = {}
+    for dn in dns:
+        node = tree.by_dn.get(dn.lower())
+        if node is not None:
+            org_ids[dn] = node.id
+    return org_ids
+
+
+def upsert_users(rows, org_ids=None):
+    """
+    按sAMAccountName新增或更新用户，只更新行中提供的字段，所属部门由org_dn一次查询得到
+    :param rows: user_entry_to_row返回的字典列表
+    :param org_ids: 已查询好的OU dn到id的映射
+    :return {"created": [sAMAccountName], "updated": [sAMAccountName]}
+    """
+    rows = merge_rows(rows, 'sAMAccountName')
+    if org_ids is None:
+        org_ids = get_org_ids(row['org_dn'] for row in rows.values() if 'org_dn' in row)
+    existing = Userinfo.objects.in_bulk(list(rows), field_name='sAMAccountName')
+    to_create, to_update, update_fields = [], [], set()
+    for account, row in rows.items():
+        values = {field: row[field] for field in USER_FIELDS if field in row}
+        if 'dn' in values:
+            values['path'] = dn_to_path(values['dn'])   # bulk操作不会调用save()，需要手动生成路径
+        if 'org_dn' in row:
+            values['org_id'] = org_ids.get(row['org_dn'])
+        if account in existing:
+            obj = existing[account]
+            for field, value in values.items():
+                setattr(obj, field, value)
+            update_fields.update('org' if field == 'org_id' else field for field in values)
+            to_update.append(obj)
+        else:
+            to_create.append(Userinfo(sAMAccountName=account, **values))
+    with transaction.atomic():
+        Userinfo.objects.bulk_create(to_create)
+        if update_fields:
+            Userinfo.objects.bulk_update(to_update, list(update_fields))
+        member_of = {account: split_member_of(row['memberOf']) for account, row in rows.items() if 'memberOf' in row}
+        if member_of:   # bulk_create在MySQL中不会回填主键，需要重新查询用户id
+            user_ids = Userinfo.objects.filter(sAMAccountName__in=list(member_of)).values_list('sAMAccountName', 'id')
+            sync_memberships({user_id: member_of[account] for account, user_id in user_ids})
+    return {'created': [i.sAMAccountName for i in to_create], 'updated': [i.sAMAccountName for i in to_update]}
+
+
+def batch_upsert_orgs(items):
+    """
+    批量同步OU，单个事务内完成，objectGUID转换为与AD同步相同的格式后按其新增或更新
+    :param items: [{"name": "IT组", "objectGUID": "...", "dn": "OU=IT组,..."}]
+    """
+    errors = check_items(items, 'objectGUID', ORG_FIELDS + ['objectGUID'])
+    items = list(items)
+    rows = {}
+    for index, item in enumerate(items):
+        if index in errors:
+            continue
+        try:   # 与AD同步一样保存规范的UUID字符串，否则同一个OU会被当成两个对象
+            guid = format_guid(item['objectGUID'])
+        except (ValueError, TypeError, AttributeError):
+            errors[index] = "objectGUID格式错误 " + str(item['objectGUID'])
+            continue
+        error = check_dn(item['dn'], 'OU') if 'dn' in item else None
+        if error:
+            errors[index] = error
+            continue
+        items[index] = rows[index] = dict(item, objectGUID=guid)
+    errors.update(validate_rows(Orginfo, rows, 'objectGUID'))
+    rows = [row for index, row in rows.items() if index not in errors]
+    res = upsert_orgs(rows) if rows else {'created': [], 'updated': []}
+    return batch_results(items, 'objectGUID', errors, res)
+
+
+def batch_upsert_users(items):
+    """
+    批量同步用户，org为OU的dn，所有OU一次查询，单个事务内完成
+    :param items: [{"sAMAccountName": "zhangsan", "name": "张三", "org": "OU=IT组,...", ...}]
+    """
+    errors = check_items(items, 'sAMAccountName', USER_FIELDS + ['sAMAccountName', 'org'])
+    org_ids = get_org_ids(item['org'] for index, item in enumerate(items) if index not in errors and 'org' in item)
+    rows = {}
+    for index, item in enumerate(items):
+        if index in errors:
+            continue
+        error = check_dn(item['dn'], 'CN') if 'dn' in item else None
+        if error:
+            errors[index] = error
+            continue
+        row = {k: v for k, v in item.items() if k != 'org'}
+        if isinstance(row.get('memberOf'), list):
+            row['memberOf'] = '\n'.join(row['memberOf'])
+        if 'org' in item:
+            if item['org'] not in org_ids:
+                errors[index] = "系统中没有该部门 " + str(item['org'])
+                continue
+            row['org_dn'] = item['org']
+        rows[index] = row
+    errors.update(validate_rows(Userinfo, rows, 'sAMAccountName', skip_choices=['userAccountControl']))
+    rows = [row for index, row in rows.items() if index not in errors]
+    res = upsert_users(rows, org_ids) if rows else {'created': [], 'updated': []}
+    return batch_results(items, 'sAMAccountName', errors, res)
+
+
+def delete_orgs(rows):
+    """ 按objectGUID删除OU，返回删除的条数 """
+    res = Orginfo.objects.filter(objectGUID__in=[row['objectGUID'] for row in rows]).delete()
+    return res[1].get(Orginfo._meta.label, 0)   # pylint: disable=protected-access
+
+
+def delete_users(rows):
+    """ 按sAMAccountName删除用户，返回删除的条数 """
+    res = Userinfo.objects.filter(sAMAccountName__in=[row['sAMAccountName'] for row in rows]).delete()
+    return res[1].get(Userinfo._meta.label, 0)   # pylint: disable=protected-access
+
+
+def backfill_paths(chunk_size=500):
+    """
+    为增加path字段之前已有的OU和用户生成物化路径，path为空的行不会被子树查询和move_subtree匹配到
+    升级后执行一次 python manage.py backfill_path，增量同步开始前也会先检查一次
+    :return {"orgs": 生成的OU数, "users": 生成的用户数}
+    """
+    res = {}
+    for name, model in (('orgs', Orginfo), ('users', Userinfo)):
+        res[name] = 0
+        rows = model.objects.filter(path='').exclude(dn='').only('id', 'dn').order_by('id')
+        for chunk in chunked(rows.iterator(chunk_size=chunk_size), chunk_size):
+            for obj in chunk:
+                obj.path = dn_to_path(obj.dn)
+            model.objects.bulk_update(chunk, ['path'])
+            res[name] += len(chunk)
+    if any(res.values()):
+        sync_logger.info("生成物化路径 %s", res)
+    return res
+
+
+def move_subtree(old_dn, new_dn):
+    """
+    OU重命名或移动后，改写该OU及所有下级OU、用户的dn和path
+    按path前缀匹配子树，每张表一条UPDATE语句，dn只替换末尾的旧OU部分；path为空的旧数据需要先执行backfill_paths
+    :return {"orgs": 改写的OU数, "users": 改写的用户数}
+    """
+    old_path, new_path = dn_to_path(old_dn), dn_to_path(new_dn)
+    res = {}
+    with transaction.atomic():
+        for name, model in (('orgs', Orginfo), ('users', Userinfo)):
+            res[name] = model.objects.filter(path__startswith=old_path).update(
+                dn=Concat(Substr('dn', 1, Length('dn') - len(old_dn)), Value(new_dn), output_field=CharField()),
+                path=Concat(Value(new_path), Substr('path', len(old_path) + 1), output_field=CharField()),
+            )
+    bump_version()   # update()不会触发post_save信号
+    sync_logger.info("改写子树DN %s -> %s - %s", old_dn, new_dn, res)
+    return res
+
+
+class AdSync():
+    """ AD域到数据库的全量同步 """
+    def __init__(self, opt_ldap, chunk_size=500, page_size=500):
+        self.opt_ldap = opt_ldap
+        self.chunk_size = chunk_size
+        self.page_size = page_size
+
+    def _sync(self, entries, to_row, upsert, name):
+        stats = {'created': 0, 'updated': 0, 'chunks': 0}
+        for chunk in chunked(entries, self.chunk_size):
+            res = upsert([to_row(entry) for entry in chunk])
+            stats['created'] += len(res['created'])
+            stats['updated'] += len(res['updated'])
+            stats['chunks'] += 1
+            sync_logger.info("同步%s 第%s批 新增:%s 更新:%s", name, stats['chunks'], len(res['created']), len(res['updated']))
+        return stats
+
+    def sync_orgs(self):
+        """ 同步所有OU """
+        return self._sync(self.opt_ldap.iter_ous(page_size=self.page_size), org_entry_to_row, upsert_orgs, 'OU')
+
+    def sync_users(self, get_type='active'):
+        """ 同步用户，需要先同步OU才能关联到部门 """
+        return self._sync(self.opt_ldap.iter_users(get_type=get_type, page_size=self.page_size), user_entry_to_row, upsert_users, '用户')
+
+    def run(self, get_type='active'):
+        """ 先同步OU，再同步用户 """
+        start = time.monotonic()
+        res = {'orgs': self.sync_orgs(), 'users': self.sync_users(get_type)}
+        res['elapsed'] = round(time.monotonic() - start, 3)
+        sync_logger.info("AD域同步完成 %s", res)
+        return res
+
+
+class IncrementalAdSync(AdSync):
+    """
+    基于uSNChanged的增量同步
+    每台域控记录一次同步时的highestCommittedUSN，下次只读取之后变更的对象和墓碑
+    """
+    def _move_orgs(self, rows):
+        """
+        OU重命名或移动时AD不会更新下级对象的uSNChanged，先按数据库中保存的dn改写整个子树
+        上级先于下级处理，下级的dn在上级改写后可能已经一致
+        :return 改写子树的OU数
+        """
+        incoming = {row['objectGUID']: row['dn'] for row in rows}
+        stored = dict(Orginfo.objects.filter(objectGUID__in=list(incoming)).values_list('objectGUID', 'dn'))
+        moved = sorted((guid for guid, dn in stored.items() if dn.lower() != incoming[guid].lower()), key=lambda guid: len(stored[guid]))
+        for guid in moved:
+            old_dn = Orginfo.objects.filter(objectGUID=guid).values_list('dn', flat=True).first()
+            if old_dn and old_dn.lower() != incoming[guid].lower():
+                move_subtree(old_dn, incoming[guid])
+        return len(moved)
+
+    def _apply_changes(self, entries, to_row, upsert, base_dn, remove, name, move=None):
+        stats = {'created': 0, 'updated': 0, 'deleted': 0, 'moved': 0}
+        for chunk in chunked(entries, self.chunk_size):
+            rows = [to_row(entry) for entry in chunk if in_subtree(entry['dn'], base_dn)]
+            outside = [to_row(entry) for entry in chunk if not in_subtree(entry['dn'], base_dn)]
+            if rows and move is not None:
+                stats['moved'] += move(rows)
+            res = upsert(rows) if rows else {'created': [], 'updated': []}
+            stats['created'] += len(res['created'])
+            stats['updated'] += len(res['updated'])
+            stats['deleted'] += remove(outside) if outside else 0   # 移出同步范围的对象(例如移动到离职OU)从数据库删除
+        sync_logger.info("增量同步%s %s", name, stats)
+        return stats
+
+    def _apply_tombstones(self, usn):
+        guids, accounts = [], []
+        for entry in self.opt_ldap.iter_deleted_objects(usn, page_size=self.page_size):
+            attrs = entry['attributes']
+            object_class = [i.lower() for i in attrs.get('objectClass', [])]
+            if 'organizationalunit' in object_class:
+                guids.append(format_guid(_single(attrs.get('objectGUID'))))
+            elif 'user' in object_class and _single(attrs.get('sAMAccountName')):
+                accounts.append(_single(attrs.get('sAMAccountName')))
+        stats = {'orgs': 0, 'users': 0}
+        with transaction.atomic():
+            for chunk in chunked(guids, self.chunk_size):
+                stats['orgs'] += delete_orgs([{'objectGUID': i} for i in chunk])
+            for chunk in chunked(accounts, self.chunk_size):
+                stats['users'] += delete_users([{'sAMAccountName': i} for i in chunk])
+        sync_logger.info("增量同步墓碑 %s", stats)
+        return stats
+
+    def run(self, get_type='active'):
+        start = time.monotonic()
+        backfill_paths(self.chunk_size)   # move_subtree按path匹配子树
+        server = self.opt_ldap.connect.server.host
+        watermark, _ = SyncWatermark.objects.get_or_create(server=server)
+        usn = watermark.highestUSN
+        highest_usn = self.opt_ldap.get_highest_usn()   # 先读取USN再查询变更，查询期间的变更会在下一次同步中重复应用
+        res = {
+            'server': server,
+            'usn': [usn, highest_usn],
+            'orgs': self._apply_changes(self.opt_ldap.iter_changed_ous(usn, page_size=self.page_size), org_entry_to_row, upsert_orgs,
+                                        self.opt_ldap.active_base_dn, delete_orgs, 'OU', move=self._move_orgs),
+            'users': self._apply_changes(self.opt_ldap.iter_changed_users(usn, page_size=self.page_size), user_entry_to_row, upsert_users,
+                                         self.opt_ldap.get_user_base_dn(get_type), delete_users, '用户'),
+            'tombstones': self._apply_tombstones(usn),
+        }
+        watermark.highestUSN = highest_usn
+        watermark.save()
+        res['elapsed'] = round(time.monotonic() - start, 3)
+        sync_logger.info("AD域增量同步完成 %s", res)
+        return res
@@ -1,82 +1,261 @@
 """
 操作AD域
 """
-import json
+import uuid
+import base64
 import logging
-from ldap3 import ALL, MODIFY_REPLACE, ALL_ATTRIBUTES
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from ldap3 import NONE, MODIFY_REPLACE, MODIFY_ADD, MODIFY_DELETE, ALL_ATTRIBUTES, BASE
 from ldap3 import Server, Connection, NTLM
 from ldap3.core import exceptions
-# from django.
+from ldap3.utils.conv import escape_filter_chars
+from ldap3.utils.ciDict import CaseInsensitiveDict
+from infox.utils.ldap_pool import LdapConnectionPool, get_pool_setting
+from infox.utils.ldap_auth import CredentialChecker, get_auth_setting
+from infox.utils.ldap_schema import SchemaCache, get_schema_setting
+from infox.utils.ldap_health import ServerSelector, get_health_setting
 
 # 注意：ldap3库如果要使用tls（安全连接），需要ad服务先安装并配置好证书服务，才能通过tls连接，否则连接测试时会报LDAPSocketOpenError('unable to open socket'
 # 如果是进行账号密码修改及账户激活时，会报错：“WILL_NOT_PERFORM”
 
 ldap_logger = logging.getLogger('optLdap')
 
-# 定义一个Server
-server1 = Server("127.0.0.1", port=636, use_ssl=True, get_info=ALL, connect_timeout=5)  # 设置多个AD服务器地址
-server2 = Server("127.0.0.1", port=636, use_ssl=True, get_info=ALL, connect_timeout=5)
-server3 = Server("127.0.0.1", port=636, use_ssl=True, get_info=ALL, connect_timeout=5)
+# 定义一个Server，schema从本地缓存加载(见ldap_schema.py)，连接时不再下载
+server1 = Server("127.0.0.1", port=636, use_ssl=True, get_info=NONE, connect_timeout=5)  # 设置多个AD服务器地址
+server2 = Server("127.0.0.1", port=636, use_ssl=True, get_info=NONE, connect_timeout=5)
+server3 = Server("127.0.0.1", port=636, use_ssl=True, get_info=NONE, connect_timeout=5)
 AD_SERVER_POOL = [server1, server2, server3] 
 SERVER_USER = '\\sAMAccountName@domain.com' # 域操作账号,格式为 \\sAMAccountName@domain.com
 SERVER_PASSWORD = 'xxxxxxx' # 域账号密码
 
+_connection_pool = None
+_connection_pool_lock = threading.Lock()
+_schema_cache = None
+_server_selector = None
+
+def get_server_selector():
+    """ 获取进程内共享的域控选择器，连接池和账号验证共用域控的耗时和熔断状态 """
+    global _server_selector   # pylint: disable=global-statement
+    with _connection_pool_lock:
+        if _server_selector is None:
+            _server_selector = ServerSelector(
+                servers=AD_SERVER_POOL,
+                failure_threshold=get_health_setting('FAILURE_THRESHOLD'),
+                backoff_base=get_health_setting('BACKOFF_BASE'),
+                backoff_max=get_health_setting('BACKOFF_MAX'),
+                window=get_health_setting('ERROR_WINDOW'),
+            )
+        return _server_selector
+
+def get_schema_cache():
+    """ 获取进程内共享的schema缓存，首次调用时创建 """
+    global _schema_cache   # pylint: disable=global-statement
+    with _connection_pool_lock:
+        if _schema_cache is None:
+            _schema_cache = SchemaCache(
+                user=SERVER_USER,
+                password=SERVER_PASSWORD,
+                cache_dir=get_schema_setting('CACHE_DIR'),
+                ttl=get_schema_setting('TTL'),
+                retry_interval=get_schema_setting('RETRY_INTERVAL'),
+            )
+        return _schema_cache
+
+def get_connection_pool():
+    """ 获取进程内共享的AD域连接池，首次调用时创建 """
+    global _connection_pool   # pylint: disable=global-statement
+    schema_cache, selector = get_schema_cache(), get_server_selector()
+    with _connection_pool_lock:
+        if _connection_pool is None:
+            _connection_pool = LdapConnectionPool(
+                servers=AD_SERVER_POOL,
+                user=SERVER_USER,
+                password=SERVER_PASSWORD,
+                size=get_pool_setting('SIZE'),
+                timeout=get_pool_setting('TIMEOUT'),
+                check_interval=get_pool_setting('CHECK_INTERVAL'),
+                max_lifetime=get_pool_setting('MAX_LIFETIME'),
+                schema_cache=schema_cache,
+                selector=selector,
+            )
+        return _connection_pool
+
+def _normalize_value(name, value):
+    """ 属性值类型转换，objectGUID转换为UUID字符串，其他二进制值转换为base64 """
+    if isinstance(value, list):
+        return [_normalize_value(name, i) for i in value]
+    if name.lower() == 'objectguid':
+        if isinstance(value, bytes):
+            return str(uuid.UUID(bytes_le=value))
+        return str(uuid.UUID(value))
+    if isinstance(value, bytes):
+        return base64.b64encode(value).decode('ascii')
+    return value
+
+def _same_value(current, value):
+    """ 比较AD中的当前值和需要更新的值，单值属性以列表返回时取第一个 """
+    if isinstance(current, list):
+        current = current[0] if len(current) == 1 else (None if not current else current)
+    if current is None or current == '':
+        return value is None or value == ''
+    return str(current) == str(value)
+
+def normalize_entry(entry):
+    """ 将ldap3的查询结果整理为 {"dn": "", "attributes": {}}，直接读取响应，不经过JSON序列化 """
+    return {'dn': entry['dn'], 'attributes': {name: _normalize_value(name, value) for name, value in entry['attributes'].items()}}
+
 class OptLdap():
     """ AD中的用户与组织单位操作 """
-    def __init__(self):
-        """ 连接初始化 """
-        self.connect = Connection( # 配置服务器连接参数
-            server=AD_SERVER_POOL,
-            auto_bind=True,
-            authentication=NTLM, # 连接Windows AD 使用NTLM方式认证
-            user=SERVER_USER,
-            password=SERVER_PASSWORD,
-        )
+    def __init__(self, server=None):
+        """
+        从连接池中借出已绑定的连接，使用with语句或在使用完毕后调用close()归还，不会在对象回收时自动归还
+        :param server: 指定AD服务器时不使用连接池，单独建立连接(增量同步需要固定在同一台域控上)
+        """
+        self._pool = None if server else get_connection_pool()
+        if server:
+            get_schema_cache().prepare(server)
+            self.connect = Connection(server=server, auto_bind=True, authentication=NTLM, user=SERVER_USER, password=SERVER_PASSWORD)
+        else:
+            self.connect = self._pool.acquire()
         ldap_logger.info("连接AD域服务器 %s", self.connect)
         self.leaved_base_dn = 'OU=LEAVED,DC=sh,DC=hupu,DC=com' # 离职账户的OU
         self.active_base_dn = 'OU=HUPU,DC=sh,DC=hupu,DC=com' # 在职账户的OU
         self.all_base_dn = 'DC=sh,DC=hupu,DC=com' # 所有用户的OU
         self.user_search_filter = '(objectclass=user)' # 只获取用户对象
         self.ou_search_filter = '(objectclass=organizationalUnit)' # 只获取OU对象
+        self.deleted_base_dn = 'CN=Deleted Objects,DC=sh,DC=hupu,DC=com' # 已删除对象(墓碑)所在的容器
+        self.show_deleted_control = ('1.2.840.113556.1.4.417', True, None) # LDAP_SERVER_SHOW_DELETED_OID
+        self.permissive_modify_control = ('1.2.840.113556.1.4.1413', False, None) # LDAP_SERVER_PERMISSIVE_MODIFY_OID，添加已有成员、删除不存在的成员不报错
         self.attributes_ou = ['Name', 'ObjectGUID']
         self.attributes_user = ['name', 'memberOf', 'sAMAccountName', 'badPwdCount', 'displayName', 'mail', 'userAccountControl', 'userPrincipalName', 'telephoneNumber']
 
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        # 连接层面的异常说明socket已不可用，不再放回连接池
+        self.close(discard=isinstance(exc_val, exceptions.LDAPCommunicationError))
+
+    def close(self, discard=False):
+        """ 将连接归还到连接池 """
+        connect = getattr(self, 'connect', None)
+        if connect is None:
+            return
+        self.connect = None
+        if self._pool is None:
+            connect.unbind()
+        else:
+            self._pool.release(connect, discard=discard)
+
     def get_users(self, get_type='active'):
-        """ 获取用户信息 """
+        """ 获取用户信息，返回列表，数据量大时使用iter_users """
+        return list(self.iter_users(get_type=get_type))
+
+    def get_user_base_dn(self, get_type):
+        """ 根据用户类型返回查询的OU """
         if get_type == 'all':
-            self.connect.search(search_base=self.all_base_dn, search_filter=self.user_search_filter, attributes=self.attributes_user)
-        elif get_type == 'leaved':
-            self.connect.search(search_base=self.leaved_base_dn, search_filter=self.user_search_filter, attributes=self.attributes_user)
-        else:
-            self.connect.search(search_base=self.active_base_dn, search_filter=self.user_search_filter, attributes=self.attributes_user)
-        res = json.loads(self.connect.response_to_json())['entries']
-        ldap_logger.info("获取所有用户信息 %s - %s", get_type, self.connect.result)
-        return res
+            return self.all_base_dn
+        if get_type == 'leaved':
+            return self.leaved_base_dn
+        return self.active_base_dn
 
-    def get_obj_info(self, filter_key=None, filter_value=None, filter_all=None, attr=None):
-        """ 根据自定义filter获取用户信息 """
+    def _paged_search(self, search_base, search_filter, attributes, page_size, controls=None):
+        """ 使用分页控件查询，以生成器方式逐条返回整理后的查询结果 """
+        entries = self.connect.extend.standard.paged_search(search_base=search_base, search_filter=search_filter, attributes=attributes, paged_size=page_size, controls=controls, generator=True)
+        for entry in entries:
+            if entry['type'] == 'searchResEntry':
+                yield normalize_entry(entry)
+        ldap_logger.info("分页查询完成 %s - %s - %s", search_base, search_filter, self.connect.result)
+
+    def iter_users(self, get_type='active', page_size=500):
+        """ 分页获取用户信息 """
+        return self._paged_search(self.get_user_base_dn(get_type), self.user_search_filter, self.attributes_user, page_size)
+
+    def iter_ous(self, page_size=500):
+        """ 分页获取OU信息 """
+        return self._paged_search(self.active_base_dn, self.ou_search_filter, self.attributes_ou, page_size)
+
+    def get_highest_usn(self):
+        """ 读取当前域控的highestCommittedUSN，USN只在同一台域控内有效 """
+        self.connect.search(search_base='', search_filter='(objectClass=*)', search_scope=BASE, attributes=['highestCommittedUSN', 'dnsHostName'])
+        attrs = self.connect.response[0]['attributes']
+        ldap_logger.info("获取域控USN %s - %s", attrs['dnsHostName'], attrs['highestCommittedUSN'])
+        return int(attrs['highestCommittedUSN'])
+
+    def iter_changed_users(self, usn, page_size=500):
+        """ 分页获取uSNChanged大于usn的用户，范围包含离职OU，由调用方判断是否仍在职 """
+        search_filter = '(&%s(uSNChanged>=%d))' % (self.user_search_filter, usn + 1)
+        return self._paged_search(self.all_base_dn, search_filter, self.attributes_user, page_size)
+
+    def iter_changed_ous(self, usn, page_size=500):
+        """ 分页获取uSNChanged大于usn的OU """
+        search_filter = '(&%s(uSNChanged>=%d))' % (self.ou_search_filter, usn + 1)
+        return self._paged_search(self.all_base_dn, search_filter, self.attributes_ou, page_size)
+
+    def iter_deleted_objects(self, usn, page_size=500):
+        """ 分页获取uSNChanged大于usn的已删除对象(墓碑) """
+        search_filter = '(&(isDeleted=TRUE)(uSNChanged>=%d))' % (usn + 1)
+        attributes = ['objectGUID', 'objectClass', 'sAMAccountName']
+        return self._paged_search(self.deleted_base_dn, search_filter, attributes, page_size, controls=[self.show_deleted_control])
+
+    def iter_obj_info(self, filter_key=None, filter_value=None, filter_all=None, attr=None, page_size=500):
+        """ 根据自定义filter获取用户信息，以生成器方式逐条返回 """
         if filter_all:
             search_filter = filter_all
         else:
             search_filter = "(" + filter_key + "=" + filter_value + ")"
-        res = []
         attr = attr if attr else ALL_ATTRIBUTES
         try:
-            self.connect.search(search_base=self.all_base_dn, search_filter=search_filter, attributes=attr)
-            res = json.loads(self.connect.response_to_json())['entries']
+            yield from self._paged_search(self.all_base_dn, search_filter, attr, page_size)
         except exceptions.LDAPException as ept:
             ldap_logger.error("获取自定义用户信息失败 %s", ept)
             raise
-        # finally:
-        #     self.connect.unbind()
         ldap_logger.info("获取自定义用户信息 %s - %s", search_filter, self.connect.result)
-        return res
+
+    def iter_groups_in_chain(self, dn, page_size=500):
+        """ 使用LDAP_MATCHING_RULE_IN_CHAIN查询dn直接和间接所属的全部组 """
+        search_filter = "(&(objectClass=group)(member:1.2.840.113556.1.4.1941:=%s))" % escape_filter_chars(dn)
+        return self._paged_search(self.all_base_dn, search_filter, ['name'], page_size)
+
+    def iter_accounts(self, filter_key, values, attr=None, chunk_size=100, page_size=500):
+        """
+        批量查询账号，每chunk_size个值组成一个OR过滤条件，每块一次分页查询
+        :param filter_key: sAMAccountName or mail
+        :param values: 需要查询的值列表
+        """
+        values = list(values)
+        attr = attr if attr else [filter_key]
+        for i in range(0, len(values), chunk_size):
+            search_filter = "(|%s)" % "".join("(%s=%s)" % (filter_key, escape_filter_chars(value)) for value in values[i:i + chunk_size])
+            yield from self.iter_obj_info(filter_all="(&%s%s)" % (self.user_search_filter, search_filter), attr=attr, page_size=page_size)
+
+    def get_obj_info(self, filter_key=None, filter_value=None, filter_all=None, attr=None):
+        """ 根据自定义filter获取用户信息，返回列表 """
+        return list(self.iter_obj_info(filter_key=filter_key, filter_value=filter_value, filter_all=filter_all, attr=attr))
 
     def get_ous(self):
-        """ 获取OU信息 """
-        self.connect.search(search_base=self.active_base_dn, search_filter=self.ou_search_filter, attributes=self.attributes_ou)
-        res = json.loads(self.connect.response_to_json())['entries']
-        ldap_logger.info("获取所有OU信息 %s - %s", self.active_base_dn, self.connect.result)
+        """ 获取OU信息，返回列表 """
+        return list(self.iter_ous())
+
+    def modify_members(self, group_dn, member_dns, operation, chunk_size=500):
+        """
+        批量添加或删除组成员，每chunk_size个成员一次modify
+        :param operation: add or delete
+        :return [(本批成员dn列表, 是否成功, LDAP结果)]
+        """
+        op = {'add': MODIFY_ADD, 'delete': MODIFY_DELETE}[operation]
+        controls = [self.permissive_modify_control] if self.permissive_modify_control else None
+        res = []
+        for i in range(0, len(member_dns), chunk_size):
+            chunk = member_dns[i:i + chunk_size]
+            try:
+                status = self.connect.modify(group_dn, {'member': [(op, chunk)]}, controls=controls)
+                result = self.connect.result
+            except exceptions.LDAPException as ept:
+                status, result = False, str(ept)
+            ldap_logger.info("Modify-Members %s - %s %s 个 - %s", group_dn, operation, len(chunk), result)
+            res.append((chunk, status, result))
         return res
 
     def del_obj(self, dn): # pylint: disable=invalid-name
@@ -125,50 +304,70 @@ class OptLdap():
         更新user or OU
         只允许OU更新name，user不能更新 ["name","sAMAccountName", "userPrincipalName", "displayname"]
         OU or USER都可以移动
+        先读取一次当前对象，在本地比较出变化的属性，一次modify提交，重命名和移动在modify之后用一次modify_dn完成
         :param dn: 需要修改的完整DN
         :param attr: 需要更新的属性值，字典形式
-        :return {"status: True/False, "msg": {'result': 0, 'description': 'success', 'dn': '', 'message': '', 'referrals': None, 'type': 'modDNResponse'}}
+        :return {"status: True/False, "msg": {'result': 0, 'description': 'success', 'dn': '', 'message': '', 'referrals': None, 'type': 'modDNResponse'},
+                 "changed": ["mail", "DistinguishedName"], "dn": "更新后的DN"}
         """
-        changes_dic = {}
-        ldap_logger.info("更新Object的信息 %s - %s", dn, attr)
-        for k, v in attr.items():  # pylint: disable=invalid-name
-            if not self.compare_attr(dn=dn, attr=k, value=v):
-                ldap_logger.info("对比Object信息结果 %s - %s:%s - %s", dn, k, v, self.connect.result)
-                if k == "name":   # 修改name值只允许OU修改，不允许修改CN的name
-                    res = self._rename_obj(dn=dn, newname=attr['name'])
-                    if res['description'] == 'success':
-                        if dn[:2] == "OU":
-                            dn = "OU=%s,%s" % (attr["name"], dn.split(",", 1)[1])
-                        else:
-                            return {"status": False, "msg": "不支持的DN " + dn}
-                elif k == "DistinguishedName":
-                    res = self._move_object(dn=dn, new_dn=v) # 调用移动User or OU 的方法
-                    if res['description'] == 'success':
-                        if dn[:2] == "CN":
-                            dn = "%s" % (attr["DistinguishedName"])
-                        if dn[:2] == "OU":
-                            dn = "%s" % (attr["DistinguishedName"])
-                elif k in ["sAMAccountName", "userPrincipalName", "displayname"]:
-                    return {"status": False, "msg": "不支持的属性 " + k}
-                else:
-                    changes_dic.update({k:[(MODIFY_REPLACE, [v])]})
-                    self.connect.modify(dn=dn, changes=changes_dic)
-        return {"status": True, "msg": self.connect.result}
-
-    def _rename_obj(self, dn, newname):  # pylint: disable=invalid-name
+        attr = CaseInsensitiveDict(attr or {})   # 属性名不区分大小写，与AD一致
+        ldap_logger.info("更新Object的信息 %s - %s", dn, dict(attr))
+        new_dn = attr.pop("DistinguishedName", None)
+        new_name = attr.pop("name", None)
+        read = self._read_obj(dn, list(attr))
+        if not read['status']:
+            return read
+        current = CaseInsensitiveDict(read['obj'])
+        changed = [k for k, v in attr.items() if not _same_value(current.get(k), v)]
+        ldap_logger.info("对比Object信息结果 %s - changed:%s", dn, changed)
+        for k in changed:
+            if k.lower() in ["samaccountname", "userprincipalname", "displayname"]:
+                return {"status": False, "msg": "不支持的属性 " + k}
+        relative_dn, superior = dn.split(",", 1)
+        target_dn = None
+        if new_dn and new_dn.lower() != dn.lower():
+            target_dn = new_dn
+        elif new_name and relative_dn.split("=", 1)[1] != new_name:
+            if dn[:2] != "OU":   # 修改name值只允许OU修改，不允许修改CN的name
+                return {"status": False, "msg": "不支持的DN " + dn}
+            target_dn = "OU=%s,%s" % (new_name, superior)
+        if changed:
+            self.connect.modify(dn=dn, changes={k: [(MODIFY_REPLACE, [attr[k]])] for k in changed})
+            ldap_logger.info("Modify-Object-Info %s - %s", dn, self.connect.result)
+            if self.connect.result['description'] != 'success':
+                return {"status": False, "msg": self.connect.result, "changed": [], "dn": dn}
+        if target_dn:
+            new_relative_dn, new_superior = target_dn.split(",", 1)
+            if new_superior.lower() == superior.lower():
+                self.connect.modify_dn(dn=dn, relative_dn=new_relative_dn)
+            else:
+                self.connect.modify_dn(dn=dn, relative_dn=new_relative_dn, new_superior=new_superior)
+            ldap_logger.info("ModifyDN-Object-Info %s -> %s - %s", dn, target_dn, self.connect.result)
+            if self.connect.result['description'] != 'success':
+                return {"status": False, "msg": self.connect.result, "changed": changed, "dn": dn}
+            changed.append("DistinguishedName")
+            if new_relative_dn.split("=", 1)[1] != relative_dn.split("=", 1)[1]:
+                changed.append("name")
+            dn = target_dn
+        return {"status": True, "msg": self.connect.result, "changed": changed, "dn": dn}
+
+    def _read_obj(self, dn, attributes):
         """
-        OU or User 重命名方法
-        :param dn:需要修改的object的完整dn路径
-        :param newname: 新的名字
-        :return:返回中有：'description': 'success', 表示操作成功
-        {'result': 0, 'description': 'success', 'dn': '', 'message': '', 'referrals': None, 'type': 'modDNResponse'}
+        读取单个对象的属性
+        :return {"status": True, "obj": {属性}}，对象不存在或属性不支持时 {"status": False, "msg": ""}
         """
-        cn_ou = dn.split("=", 1)
-        newname = cn_ou[0] + "=" + newname
-        res = self.connect.modify_dn(dn, newname)
-        ldap_logger.info("Remove-Object-Info %s - %s - %s", dn, self.connect.result, res)
-        return self.connect.result
-
+        try:
+            self.connect.search(search_base=dn, search_filter='(objectClass=*)', search_scope=BASE, attributes=attributes or ['1.1'])
+        except exceptions.LDAPNoSuchObjectResult:
+            entries = []
+        except exceptions.LDAPAttributeError as ept:
+            ldap_logger.warning("读取Object信息失败 %s - %s", dn, ept)
+            return {"status": False, "msg": "不支持的属性 " + str(ept)}
+        else:
+            entries = [i for i in self.connect.response if i['type'] == 'searchResEntry']
+        if not entries:
+            return {"status": False, "msg": "AD域中没有该对象 " + dn}
+        return {"status": True, "obj": normalize_entry(entries[0])['attributes']}
 
     def _move_object(self, dn, new_dn):  # pylint: disable=invalid-name
         """移动员工 or 部门到新部门"""
@@ -183,18 +382,7 @@ class OptLdap():
         ldap_logger.info("Leaved-User %s - Disable - %s", dn, res)
         if res:
             new_dn = dn.split(",")[0] + "," + self.leaved_base_dn
-            res = self._move_object(dn=dn, new_dn=new_dn)
-        return res
-
-    def compare_attr(self, dn, attr, value):   # pylint: disable=invalid-name
-        """比较员工指定的某个属性
-        """
-        try:
-            res = self.connect.compare(dn=dn, attribute=attr, value=value)
-            ldap_logger.info("Commpare-Object-Info %s - %s:%s - %s", dn, attr, value, res)
-        except exceptions.LDAPException as ept:
-            ldap_logger.error("Commpare-Object-Info-Expception %s - %s - %s", dn, self.connect, ept)
-            res = False
+            res = self._move_object(dn=dn, new_dn=new_dn)['result'] == 0
         return res
 
     def reset_password(self, dn, new_pwd):  # pylint: disable=invalid-name
@@ -204,17 +392,53 @@ class OptLdap():
         return res, self.connect.result
 
 
-def check_credentials(username, password):
-    """ 用户认证测试接口 """
-    res = {}
-    ldap_user = '\\{}@sh.hupu.com'.format(username)
+def _leave_one(dn):
     try:
-        connect = Connection(server1, user=ldap_user, password=password, authentication=NTLM)
-        res = {'status': connect.bind(), 'msg': str(connect.result)}
-        ldap_logger.info("用户 %s 登录验证成功 %s", username, str(connect.result))
+        with OptLdap() as opt_ldap:
+            return opt_ldap.leaved_user(dn)
     except exceptions.LDAPException as ept:
-        ldap_logger.warning("用户 %s 登录验证出现错误 %s", username, ept)
-        res = {'status': False, 'msg': ept}
-    finally:
-        connect.unbind()
+        ldap_logger.error("Leaved-User-Exception %s - %s", dn, ept)
+        return False
+
+def leave_users(dns, max_workers=None):
+    """
+    并发处理多个离职用户，每个线程从连接池获取连接，线程数默认为连接池大小
+    :return {dn: True/False}
+    """
+    dns = list(dns)
+    if not dns:
+        return {}
+    max_workers = min(max_workers or get_pool_setting('SIZE'), get_pool_setting('SIZE'), len(dns))
+    with ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='ldap-leave') as executor:
+        return dict(zip(dns, executor.map(_leave_one, dns)))
+
+
+_credential_checker = None
+
+def get_credential_checker():
+    """ 获取进程内共享的账号验证服务，首次调用时创建 """
+    global _credential_checker   # pylint: disable=global-statement
+    schema_cache, selector = get_schema_cache(), get_server_selector()
+    with _connection_pool_lock:
+        if _credential_checker is None:
+            _credential_checker = CredentialChecker(
+                servers=AD_SERVER_POOL,
+                max_workers=get_auth_setting('MAX_WORKERS'),
+                per_server=get_auth_setting('PER_SERVER'),
+                timeout=get_auth_setting('TIMEOUT'),
+                schema_cache=schema_cache,
+                selector=selector,
+                slot_wait=get_auth_setting('SLOT_WAIT'),
+            )
+        return _credential_checker
+
+
+def check_credentials(username, password):
+    """ 用户认证测试接口，在所有域控中按耗时选择服务器验证，失败的域控会换下一台重试 """
+    ldap_user = '\\{}@sh.hupu.com'.format(username)
+    res = get_credential_checker().check(ldap_user, password)
+    if res['status']:
+        ldap_logger.info("用户 %s 登录验证成功 %s", username, res['msg'])
+    else:
+        ldap_logger.warning("用户 %s 登录验证失败 %s", username, res['msg'])
     return res
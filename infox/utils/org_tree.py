@@ -0,0 +1,127 @@
+"""
+进程内缓存的部门(OU)树
+按DN、objectGUID索引部门，并维护上下级关系，避免每次通过dn查询Orginfo
+部门数据变更时通过信号更新缓存中的版本号，各进程发现版本号变化后重新加载
+多进程部署时需要在settings中配置共享的CACHES，版本号才能在进程间生效；
+未配置时其他进程写入的部门在本进程树中查不到，查找不到时会再查一次数据库，存在则立即重新加载
+"""
+import time
+import logging
+import threading
+from django.core.cache import cache
+from infox.models import Orginfo
+
+tree_logger = logging.getLogger('infox')
+
+ORG_TREE_VERSION_KEY = 'infox:org_tree_version'
+ORG_TREE_MAX_AGE = 300   # 缓存的部门树最长使用秒数
+
+
+class OrgNode():
+    """ 部门树中的一个部门 """
+    __slots__ = ['id', 'name', 'objectGUID', 'dn', 'parent', 'children']
+
+    def __init__(self, org_id, name, object_guid, dn):
+        self.id = org_id
+        self.name = name
+        self.objectGUID = object_guid
+        self.dn = dn
+        self.parent = None
+        self.children = []
+
+    def to_dict(self):
+        return {
+            'id': self.id,
+            'name': self.name,
+            'objectGUID': self.objectGUID,
+            'dn': self.dn,
+            'children': [child.to_dict() for child in self.children],
+        }
+
+
+class OrgTree():
+    """ 部门树，DN不区分大小写 """
+    def __init__(self, orgs):
+        self.by_dn = {}
+        self.by_guid = {}
+        self.roots = []
+        for org_id, name, object_guid, dn in orgs:
+            node = OrgNode(org_id, name, object_guid, dn)
+            self.by_dn[dn.lower()] = node
+            self.by_guid[object_guid] = node
+        for dn, node in self.by_dn.items():
+            parent = self.by_dn.get(dn.split(",", 1)[-1])
+            if parent is not None and parent is not node:
+                node.parent = parent
+                parent.children.append(node)
+            else:
+                self.roots.append(node)
+        self._tree = None
+
+    def get_by_dn(self, dn):
+        """ 根据DN获取部门，树中没有但数据库中存在时重新加载部门树，不存在时抛出Orginfo.DoesNotExist """
+        node = self.by_dn.get(dn.lower())
+        if node is None and Orginfo.objects.filter(dn__iexact=dn).exists():
+            node = reload_org_tree().by_dn.get(dn.lower())
+        if node is None:
+            raise Orginfo.DoesNotExist("Orginfo matching dn %s does not exist." % dn)
+        return node
+
+    def get_by_guid(self, object_guid):
+        """ 根据objectGUID获取部门，树中没有但数据库中存在时重新加载部门树，不存在时抛出Orginfo.DoesNotExist """
+        node = self.by_guid.get(object_guid)
+        if node is None and Orginfo.objects.filter(objectGUID=object_guid).exists():
+            node = reload_org_tree().by_guid.get(object_guid)
+        if node is None:
+            raise Orginfo.DoesNotExist("Orginfo matching objectGUID %s does not exist." % object_guid)
+        return node
+
+    def to_list(self):
+        """ 整棵部门树，结果在树的生命周期内缓存 """
+        if self._tree is None:
+            self._tree = [root.to_dict() for root in self.roots]
+        return self._tree
+
+
+def get_version():
+    return cache.get(ORG_TREE_VERSION_KEY, 0)
+
+
+def bump_version():
+    """ 部门数据变更后调用，使所有进程的部门树失效 """
+    try:
+        cache.incr(ORG_TREE_VERSION_KEY)
+    except ValueError:
+        cache.set(ORG_TREE_VERSION_KEY, 1, None)
+
+
+_org_tree = None
+_org_tree_version = None
+_org_tree_loaded = 0
+_org_tree_lock = threading.Lock()
+
+
+def _load(version):
+    global _org_tree, _org_tree_version, _org_tree_loaded   # pylint: disable=global-statement
+    _org_tree = OrgTree(Orginfo.objects.values_list('id', 'name', 'objectGUID', 'dn'))
+    _org_tree_version = version
+    _org_tree_loaded = time.monotonic()
+    tree_logger.info("加载部门树 version:%s count:%s", version, len(_org_tree.by_dn))
+    return _org_tree
+
+
+def get_org_tree():
+    """ 获取当前进程的部门树，版本号变化或超过最长使用时间时重新加载 """
+    version = get_version()
+    if _org_tree is not None and version == _org_tree_version and time.monotonic() - _org_tree_loaded < ORG_TREE_MAX_AGE:
+        return _org_tree
+    with _org_tree_lock:
+        if _org_tree is None or version != _org_tree_version or time.monotonic() - _org_tree_loaded >= ORG_TREE_MAX_AGE:
+            return _load(version)
+        return _org_tree
+
+
+def reload_org_tree():
+    """ 强制重新加载部门树，用于其他进程写入的部门在本进程树中查不到的情况 """
+    with _org_tree_lock:
+        return _load(get_version())
@@ -0,0 +1,202 @@
+"""
+从CSV/JSON文件批量导入新员工
+部门一次解析，账号是否存在分批检查，AD域新增在异步连接上流水线发送，数据库使用bulk_create写入
+"""
+import io
+import csv
+import json
+import time
+import logging
+from ldap3 import Connection, NTLM, ASYNC
+from ldap3.core import exceptions
+from django.db import transaction
+from django.db.models.functions import Lower
+from infox.models import Orginfo, Userinfo, dn_to_path
+from infox.utils.opt_ldap import OptLdap, SERVER_USER, SERVER_PASSWORD, get_schema_cache, get_server_selector
+from infox.utils.org_tree import get_org_tree
+from Galilee.batch import chunked
+
+import_logger = logging.getLogger('optLdap')
+
+REQUIRED_FIELDS = ['name', 'sAMAccountName', 'pwd', 'deptId']
+OPTIONAL_FIELDS = ['mail', 'telephoneNumber']
+USER_OBJECT_CLASS = ['top', 'person', 'organizationalPerson', 'user']
+
+
+def read_rows(content, filename=''):
+    """
+    解析上传的文件内容，文件名以.json结尾或内容以[开头时按JSON解析，否则按带表头的CSV解析
+    :param content: bytes or str
+    """
+    if isinstance(content, bytes):
+        content = content.decode('utf-8-sig')
+    if filename.lower().endswith('.json') or content.lstrip().startswith('['):
+        rows = json.loads(content)
+        if not isinstance(rows, list):
+            raise ValueError("JSON文件内容应为列表")
+        return rows
+    return [{k.strip(): (v or '').strip() for k, v in row.items() if k} for row in csv.DictReader(io.StringIO(content))]
+
+
+def open_async_connection():
+    """ 打开流水线导入使用的异步连接，不占用连接池，按域控健康评分依次尝试 """
+    selector = get_server_selector()
+    error = None
+    for health in selector.ordered():
+        get_schema_cache().prepare(health.server)
+        start = time.monotonic()
+        try:
+            connection = Connection(health.server, user=SERVER_USER, password=SERVER_PASSWORD, authentication=NTLM, client_strategy=ASYNC, auto_bind=True)
+        except exceptions.LDAPException as ept:
+            selector.record_failure(health)
+            import_logger.warning("连接域控 %s 失败 %s", health.name, ept)
+            error = ept
+            continue
+        selector.record_success(health, time.monotonic() - start)
+        return connection
+    raise error
+
+
+def encode_password(pwd):
+    """ AD要求unicodePwd为带双引号的UTF-16LE编码 """
+    return ('"%s"' % pwd).encode('utf-16-le')
+
+
+class UserImporter():
+    """
+    批量导入用户
+    :param connection: 异步策略的ldap3连接，默认新建
+    :param chunk_size: 每批检查、发送和写入数据库的条数
+    :param progress: 回调函数 progress(已处理条数, 总条数)
+    """
+    def __init__(self, connection=None, chunk_size=100, progress=None):
+        self.connection = connection
+        self.chunk_size = chunk_size
+        self.progress = progress
+
+    def _validate(self, rows, results):
+        """ 检查必填字段和文件内重复的账号，返回可以继续处理的序号 """
+        seen = set()
+        valid = []
+        for index, row in enumerate(rows):
+            if not isinstance(row, dict):
+                results[index] = {"status": False, "msg": "格式错误"}
+                continue
+            missing = [i for i in REQUIRED_FIELDS if not row.get(i)]
+            if missing:
+                results[index] = {"status": False, "msg": "缺少 " + ",".join(missing)}
+                continue
+            account = str(row['sAMAccountName']).lower()
+            if account in seen:
+                results[index] = {"status": False, "msg": "文件中重复的账号"}
+                continue
+            seen.add(account)
+            valid.append(index)
+        return valid
+
+    def _resolve_orgs(self, rows, indexes, results):
+        """ 从部门树中解析deptId(objectGUID) """
+        tree = get_org_tree()
+        orgs = {}
+        for index in list(indexes):
+            try:
+                orgs[index] = tree.get_by_guid(str(rows[index]['deptId']))
+            except Orginfo.DoesNotExist:
+                results[index] = {"status": False, "msg": "部门不存在 " + str(rows[index]['deptId'])}
+                indexes.remove(index)
+        return orgs
+
+    def _check_exists(self, rows, indexes, results):
+        """ 先查数据库，再分批到AD域中查询账号是否已存在 """
+        accounts = {str(rows[i]['sAMAccountName']).lower(): i for i in indexes}
+        existing = Userinfo.objects.annotate(account=Lower('sAMAccountName')).filter(account__in=list(accounts))   # 账号不区分大小写
+        for account in existing.values_list('sAMAccountName', flat=True):
+            index = accounts.pop(account.lower(), None)
+            if index is not None:
+                results[index] = {"status": False, "msg": "系统中存在该用户 " + account}
+        if accounts:
+            with OptLdap() as opt_ldap:
+                for entry in opt_ldap.iter_accounts('sAMAccountName', [rows[i]['sAMAccountName'] for i in accounts.values()], chunk_size=self.chunk_size):
+                    account = entry['attributes'].get('sAMAccountName')
+                    account = account[0] if isinstance(account, list) else account
+                    index = accounts.pop(str(account).lower(), None)
+                    if index is not None:
+                        results[index] = {"status": False, "msg": "AD域中存在该用户 " + account}
+        return sorted(accounts.values())
+
+    def _build(self, row, org):
+        attrs = {'name': row['name'], 'sAMAccountName': row['sAMAccountName'], 'displayName': row['name'],
+                 'userPrincipalName': row['sAMAccountName'] + "@sh.hupu.com"}
+        attrs.update({k: row[k] for k in OPTIONAL_FIELDS if row.get(k)})   # AD不接受空值
+        return "CN=%s,%s" % (row['name'], org.dn), attrs
+
+    def _add_chunk(self, chunk):
+        """ 一次发送一批add请求，再依次收取结果，返回 {序号: LDAP结果} """
+        pending = []
+        for index, dn, attrs, pwd in chunk:
+            ad_attrs = dict(attrs, unicodePwd=encode_password(pwd), userAccountControl=512)   # 新增时设置密码并激活账号
+            pending.append((index, dn, self.connection.add(dn, USER_OBJECT_CLASS, ad_attrs)))
+        done = {}
+        for index, dn, message_id in pending:
+            try:
+                _, result = self.connection.strategy.get_response(message_id)
+            except exceptions.LDAPException as ept:
+                result = {'result': -1, 'description': str(ept)}
+            import_logger.info("导入用户 %s - %s", dn, result)
+            done[index] = result
+        return done
+
+    def _save_chunk(self, rows, built, orgs):
+        users = []
+        for index in rows:
+            dn, attrs = built[index]
+            users.append(Userinfo(dn=dn, path=dn_to_path(dn), org_id=orgs[index].id, userAccountControl=512, **attrs))
+        with transaction.atomic():
+            Userinfo.objects.bulk_create(users)   # bulk_create不会调用save()，path已手动生成
+
+    def run(self, rows):
+        """
+        导入用户，返回与rows顺序一致的结果
+        :return {"total": 300, "created": 298, "elapsed": 12.3, "results": [{"row": 1, "sAMAccountName": "...", "status": True, "msg": "success"}]}
+        """
+        start = time.monotonic()
+        results = {}
+        indexes = self._validate(rows, results)
+        orgs = self._resolve_orgs(rows, indexes, results)
+        indexes = self._check_exists(rows, indexes, results)
+        built = {index: self._build(rows[index], orgs[index]) for index in indexes}
+        opened = False
+        if indexes and self.connection is None:
+            self.connection = open_async_connection()
+            opened = True
+        processed = len(rows) - len(indexes)
+        try:
+            for chunk in chunked(indexes, self.chunk_size):
+                done = self._add_chunk([(index, built[index][0], built[index][1], rows[index]['pwd']) for index in chunk])
+                added = []
+                for index in chunk:
+                    if done[index]['result'] == 0:
+                        added.append(index)
+                        results[index] = {"status": True, "msg": "success"}
+                    else:
+                        results[index] = {"status": False, "msg": "AD域创建用户失败 " + str(done[index].get('description', done[index]))}
+                if added:
+                    try:
+                        self._save_chunk(added, built, orgs)
+                    except Exception as ept:   # pylint: disable=broad-except
+                        import_logger.error("导入用户写入数据库失败 %s", ept)
+                        for index in added:
+                            results[index] = {"status": False, "msg": "AD域成功创建，数据库创建失败 " + str(ept)}
+                processed += len(chunk)
+                if self.progress:
+                    self.progress(processed, len(rows))
+        finally:
+            if opened:
+                self.connection.unbind()
+                self.connection = None
+        res = [dict(results[index], row=index + 1, sAMAccountName=row.get('sAMAccountName') if isinstance(row, dict) else None)
+               for index, row in enumerate(rows)]
+        created = len([i for i in res if i['status']])
+        elapsed = round(time.monotonic() - start, 3)
+        import_logger.info("批量导入用户 %s 条，成功 %s 条，耗时 %ss", len(rows), created, elapsed)
+        return {"total": len(rows), "created": created, "elapsed": elapsed, "results": res}
@@ -1,6 +1,7 @@
 """
 创建视图
 """
+import time
 import logging
 import uuid
 from rest_framework import viewsets
@@ -9,15 +10,35 @@ from rest_framework.views import APIView
 from rest_framework.settings import api_settings
 from rest_framework.response import Response
 from rest_framework.decorators import action
+from rest_framework.exceptions import ValidationError
+from rest_framework.parsers import JSONParser, MultiPartParser
+from django.db import transaction, DatabaseError
+from django.db.models import F
+from django.http import QueryDict
 from django.contrib.auth.models import User, Group
-from infox.models import Orginfo, Userinfo
-from infox.serializers import UserSerializer, GroupSerializer, OrginfoSerializer, UserinfoSerializer
+from infox.models import Orginfo, Userinfo, Groupinfo, dn_to_path, get_account_control_mask
+from infox.serializers import UserSerializer, GroupSerializer, OrginfoSerializer, UserinfoSerializer, GroupinfoSerializer
 
 from infox.utils.opt_ldap import OptLdap
-from infox.utils.opt_ldap import check_credentials
+from infox.utils.opt_ldap import check_credentials, get_connection_pool, get_credential_checker, get_schema_cache, get_server_selector, leave_users
+from infox.utils.org_tree import get_org_tree
+from infox.utils.ldap_filter import USER_FILTER, search_local, default_attributes, LdapFilterError
+from infox.utils.user_import import UserImporter, read_rows
+from infox.utils.group_cache import get_effective_groups, bump_group_version
+from infox.utils.ldap_sync import AdSync, IncrementalAdSync, batch_upsert_users, batch_upsert_orgs, sync_memberships, split_member_of, move_subtree
 
 views_logger = logging.getLogger("infox")
 
+def filter_subtree(queryset, request, view_action):
+    """ 列表接口按部门子树过滤，使用物化路径的前缀查询，path为空的旧数据需要先执行 python manage.py backfill_path """
+    subtree = request.query_params.get('subtree')
+    if view_action != 'list' or not subtree:
+        return queryset
+    org = get_org_tree().by_guid.get(subtree)
+    if org is None:
+        return queryset.none()
+    return queryset.filter(path__startswith=dn_to_path(org.dn))
+
 class UserViewSet(viewsets.ModelViewSet):
     """ 用户视图集合 """
     queryset = User.objects.all()
@@ -32,21 +53,90 @@ class GroupViewSet(viewsets.ModelViewSet):
 
 class UserinfoViewSet(viewsets.ModelViewSet):
     """ AD域用户信息视图集合 """
-    queryset = Userinfo.objects.all().order_by("id")
+    queryset = Userinfo.objects.select_related("org").order_by("id")
     serializer_class = UserinfoSerializer
     permission_classes = [permissions.IsAuthenticated]
 
+    def get_queryset(self):
+        """
+        ?subtree=<objectGUID> 只返回该部门及所有下级部门中的用户
+        ?member_of=<group dn> 只返回该组的成员
+        ?flags=disabled,locked,pwd_never_expires 只返回userAccountControl中同时带有这些标志的用户
+        """
+        queryset = filter_subtree(super().get_queryset(), self.request, self.action)
+        if self.action != 'list':
+            return queryset
+        member_of = self.request.query_params.get('member_of')
+        if member_of:
+            queryset = queryset.filter(groups__dn=member_of)
+        flags = self.request.query_params.get('flags')
+        if flags:
+            try:
+                mask = get_account_control_mask(i.strip() for i in flags.split(",") if i.strip())
+            except KeyError as ept:
+                raise ValidationError({"flags": "不支持的账号状态标志 " + str(ept)})
+            queryset = queryset.annotate(uac_masked=F('userAccountControl').bitand(mask)).filter(uac_masked=mask)
+        return queryset
+
     @action(methods=['post'], detail=False, permission_classes=[permissions.IsAuthenticated])
     def sync_user(self, request, *args, **kwargs):     
-        """ 将AD域用户信息同步到系统 """
+        """
+        将AD域用户信息同步到系统
+        提交列表时批量同步，返回每一项的 created/updated/error 结果
+        """
         args = request.data
-        args['org'] = Orginfo.objects.get(dn=args['org'])
+        if isinstance(args, list):
+            res = batch_upsert_users(args)
+            views_logger.info("批量同步用户信息 %s 条", len(res))
+            return Response({"status": True, "msg": "success", "obj": res})
+        args['org_id'] = get_org_tree().get_by_dn(args.pop('org')).id
         views_logger.info(args)
         query, status = Userinfo.objects.get_or_create(sAMAccountName=args['sAMAccountName'], defaults=args)
+        if status and query.memberOf:
+            sync_memberships({query.id: split_member_of(query.memberOf)})
         views_logger.info("系统同步到域信息 name:%s - %s", query.name, status)
         ser = self.get_serializer(query)
         return Response(ser.data)
 
+    @action(methods=['get'], detail=True, permission_classes=[permissions.IsAuthenticated])
+    def groups(self, request, *args, **kwargs):
+        """
+        用户所在的组
+        :URL: /userinfo/<pk>/groups/
+        :PK - sAMAccountName
+        """
+        query = Userinfo.objects.get(sAMAccountName=kwargs['pk'])
+        ser = GroupinfoSerializer(query.groups.order_by('id'), many=True, context={'request': request})
+        return Response(ser.data)
+
+    @action(methods=['get'], detail=True, permission_classes=[permissions.IsAuthenticated])
+    def effective_groups(self, request, *args, **kwargs):
+        """
+        用户直接和间接(嵌套组)所属的全部组，结果按用户缓存
+        :URL: /userinfo/<pk>/effective_groups/?refresh=1
+        :PK - sAMAccountName
+        """
+        query = Userinfo.objects.get(sAMAccountName=kwargs['pk'])
+        groups, cached = get_effective_groups(query.dn, refresh=request.query_params.get('refresh') in ('1', 'true'))
+        return Response({"status": True, "msg": "success", "obj": groups, "cached": cached})
+
+    @action(methods=['post'], detail=False, permission_classes=[permissions.IsAuthenticated])
+    def sync_ad(self, request, *args, **kwargs):
+        """
+        从AD域批量同步OU和用户到系统
+        :param {"type": "active", "chunk_size": 500, "incremental": true}
+        incremental为true时只同步上次同步之后变更、删除的对象
+        """
+        data = request.data
+        get_type = data.get('type', 'active')
+        if get_type not in ['active', 'all', 'leaved']:
+            return Response({"status": False, "msg": "不支持的同步类型 " + get_type})
+        sync_class = IncrementalAdSync if data.get('incremental') else AdSync
+        with OptLdap() as opt_ldap:
+            res = sync_class(opt_ldap, chunk_size=int(data.get('chunk_size', 500))).run(get_type=get_type)
+        views_logger.info("AD域批量同步 %s - %s", get_type, res)
+        return Response({"status": True, "msg": "success", "obj": res})
+
     @action(methods=['post'], detail=True, permission_classes=[permissions.IsAuthenticated])
     def update_user(self, request, *args, **kwargs):    
         """
@@ -64,10 +154,10 @@ class UserinfoViewSet(viewsets.ModelViewSet):
                 return Response({"status": False, "msg": "参数中包含不可更新的内容 key:" + i + " - value:" + data[i]})
         org_uuid = data.pop('deptId')
         if org_uuid != query.org.objectGUID:
-            org_query = Orginfo.objects.get(objectGUID=org_uuid)
+            org_query = get_org_tree().get_by_guid(org_uuid)
             data['DistinguishedName'] = "CN=%s,%s" % (query.displayName, org_query.dn)
-        opt_ldap = OptLdap()
-        res = opt_ldap.update_obj(query.dn, data)
+        with OptLdap() as opt_ldap:
+            res = opt_ldap.update_obj(query.dn, data)
         if not res['status']:
             return Response(res)
         if 'DistinguishedName' in data:
@@ -95,15 +185,15 @@ class UserinfoViewSet(viewsets.ModelViewSet):
         """
         new_data = {}
         data = request.data
-        org_query = Orginfo.objects.get(objectGUID=data['deptId'])   # 获取部门信息
+        org_query = get_org_tree().get_by_guid(data['deptId'])   # 获取部门信息
         new_data = {k:v for k, v in data.items() if k not in ['pwd', 'deptId']}
         new_data.update({'displayName': data['name'], 'userPrincipalName': data['sAMAccountName'] + "@sh.hupu.com"})
         dn = "CN=%s,%s" % (data['name'], org_query.dn)     # 构造dn   pylint: disable=invalid-name
-        opt_ldap = OptLdap()
-        check = opt_ldap.get_obj_info(filter_key="sAMAccountName", filter_value=data['sAMAccountName'], attr=['name', 'Displayname'])   # 查询AD域中是否有该账号
-        if len(check) != 0:
-            return Response({"status": False, "msg": "AD域中存在该用户 " + data['sAMAccountName']})
-        res, msg = opt_ldap.create_obj(dn, 'user', data['pwd'], new_data)
+        with OptLdap() as opt_ldap:
+            check = opt_ldap.get_obj_info(filter_key="sAMAccountName", filter_value=data['sAMAccountName'], attr=['name', 'Displayname'])   # 查询AD域中是否有该账号
+            if len(check) != 0:
+                return Response({"status": False, "msg": "AD域中存在该用户 " + data['sAMAccountName']})
+            res, msg = opt_ldap.create_obj(dn, 'user', data['pwd'], new_data)
         if not res:
             views_logger.warning("AD域创建用户失败 %s - %s - %s", dn, new_data, "False")
             return Response({"status": res, "msg": "AD域创建用户失败 " + str(msg)})
@@ -117,6 +207,27 @@ class UserinfoViewSet(viewsets.ModelViewSet):
         views_logger.info("数据库新增操作 %s - %s", new_data, "True")
         return Response({"status": True, "msg": "success", "obj": res.data})
 
+    @action(methods=['post'], detail=False, permission_classes=[permissions.IsAuthenticated], parser_classes=[MultiPartParser, JSONParser])
+    def import_users(self, request, *args, **kwargs):
+        """
+        批量导入新员工，上传CSV/JSON文件(file字段)或直接提交JSON列表
+        : param  [{"name": "张三", "sAMAccountName": "zhangsan", "pwd": "123456", "deptId": "<objectGUID>", "mail": "", "telephoneNumber": ""}]
+        :return 每一行的导入结果
+        """
+        if 'file' in request.FILES:
+            upload = request.FILES['file']
+            try:
+                rows = read_rows(upload.read(), upload.name)
+            except ValueError as ept:
+                return Response({"status": False, "msg": "文件解析失败 " + str(ept)})
+        elif isinstance(request.data, list):
+            rows = request.data
+        else:
+            return Response({"status": False, "msg": "请上传CSV/JSON文件或提交用户列表"})
+        res = UserImporter().run(rows)
+        views_logger.warning("批量导入用户 %s 条，成功 %s 条", res['total'], res['created'])
+        return Response({"status": res['created'] == res['total'], "msg": "success", "obj": res})
+
     @action(methods=['get'], detail=True, permission_classes=[permissions.IsAuthenticated])
     def leave_user(self, request, *args, **kwargs):    
         """
@@ -127,8 +238,8 @@ class UserinfoViewSet(viewsets.ModelViewSet):
         if 'pk' not in kwargs:
             return Response({'status': False, 'msg': "无用户名信息！"})
         query = Userinfo.objects.get(sAMAccountName=kwargs['pk'])
-        opt_ldap = OptLdap()
-        res = opt_ldap.leaved_user(query.dn)
+        with OptLdap() as opt_ldap:
+            res = opt_ldap.leaved_user(query.dn)
         if not res:
             views_logger.warning("AD域操作用户离职失败 DN:%s - %s", query.dn, "False")
             return Response({"status": False, "msg": "AD域操作失败，详细信息请查看LDAP Log。"})
@@ -141,6 +252,28 @@ class UserinfoViewSet(viewsets.ModelViewSet):
         views_logger.info("数据库删除操作 ID：%s - %s - %s", query.id, query.dn, "True")
         return Response({"status": True, "msg": "success"})
 
+    @action(methods=['post'], detail=False, permission_classes=[permissions.IsAuthenticated])
+    def leave_users(self, request, *args, **kwargs):
+        """
+        批量处理离职用户，AD域中的禁用和移动并发执行，成功的用户在数据库中一次删除
+        :param {"sAMAccountName": ["zhangsan", "lisi"], "workers": 10}
+        :return 每个账号的处理结果和总耗时
+        """
+        accounts = request.data.get('sAMAccountName')
+        if not isinstance(accounts, list) or not accounts:
+            return Response({'status': False, 'msg': "请提交需要离职的用户名列表！"})
+        start = time.monotonic()
+        users = {account: (user_id, dn) for account, user_id, dn in Userinfo.objects.filter(sAMAccountName__in=accounts).values_list('sAMAccountName', 'id', 'dn')}
+        res = {account: {"status": False, "msg": "数据库中没有该用户"} for account in accounts if account not in users}
+        done = leave_users([dn for _, dn in users.values()], max_workers=int(request.data.get('workers') or 0) or None)
+        for account, (_, dn) in users.items():
+            res[account] = {"status": done[dn], "msg": "success" if done[dn] else "AD域操作失败，详细信息请查看LDAP Log。"}
+        ids = [user_id for account, (user_id, _) in users.items() if res[account]['status']]
+        Userinfo.objects.filter(id__in=ids).delete()
+        elapsed = round(time.monotonic() - start, 3)
+        views_logger.warning("批量离职用户 %s 个，成功 %s 个，耗时 %ss", len(accounts), len(ids), elapsed)
+        return Response({"status": len(ids) == len(accounts), "msg": "success", "obj": res, "elapsed": elapsed})
+
     @action(methods=['post'], detail=False, permission_classes=[permissions.IsAuthenticated])
     def reset_password(self, request, *args, **kwargs):    
         """ 重置AD域密码 """
@@ -148,8 +281,8 @@ class UserinfoViewSet(viewsets.ModelViewSet):
         if 'name' not in args or 'pwd' not in args:
             return Response({'status': False, 'msg': "提交的用户名和密码信息有误！"})
         query = Userinfo.objects.get(sAMAccountName=args['name'])
-        opt_ldap = OptLdap()
-        res, msg = opt_ldap.reset_password(query.dn, args['pwd'])
+        with OptLdap() as opt_ldap:
+            res, msg = opt_ldap.reset_password(query.dn, args['pwd'])
         views_logger.info("AD域重置密码 sAMAccountName:%s - %s - %s", args['name'], msg, res)
         return Response({"status": res, "msg": msg['description']})
 
@@ -158,35 +291,81 @@ class UserinfoViewSet(viewsets.ModelViewSet):
         """ 删除离职用户 """
         if 'pk' not in kwargs:
             return Response({'status': False, 'msg': "无用户名信息！"})
-        opt_ldap = OptLdap()
-        res = opt_ldap.get_obj_info(filter_key='sAMAccountName', filter_value=kwargs['pk'], attr=['name', 'displayName', 'sAMAccountName'])
-        if len(res) == 0:
-            views_logger.info("AD域不存在该用户 %s - %s", kwargs['pk'], "False")
-            return Response({"status": False, "msg": "AD域中没有该用户，详细信息请查看Log"})
-        res, msg = opt_ldap.del_obj(res[0]['dn'])
+        with OptLdap() as opt_ldap:
+            res = opt_ldap.get_obj_info(filter_key='sAMAccountName', filter_value=kwargs['pk'], attr=['name', 'displayName', 'sAMAccountName'])
+            if len(res) == 0:
+                views_logger.info("AD域不存在该用户 %s - %s", kwargs['pk'], "False")
+                return Response({"status": False, "msg": "AD域中没有该用户，详细信息请查看Log"})
+            res, msg = opt_ldap.del_obj(res[0]['dn'])
         views_logger.info("AD域删除用户 %s - %s", msg, res)
         return Response({"status": res, "msg": msg['description']})
 
+    @action(methods=['post'], detail=False, permission_classes=[permissions.IsAuthenticated])
+    def check_accounts(self, request, *args, **kwargs):
+        """
+        批量检查账号是否存在，先查数据库，数据库中没有的再分块到AD域中查询
+        :param {"sAMAccountName": ["zhangsan", "lisi"]} or {"mail": ["zhangsan@hupu.com"]}
+        :return {"obj": {"zhangsan": {"found": true, "source": "db", "dn": "..."}, "lisi": {"found": false, "source": "ad", "dn": null}}}
+        """
+        data = request.data
+        keys = [i for i in ['sAMAccountName', 'mail'] if i in data]
+        if not keys or set(data) - set(keys):
+            return Response({"status": False, "msg": "只支持按 sAMAccountName 或 mail 批量查询"})
+        res = {}
+        for key in keys:
+            values = {str(i).lower(): str(i) for i in data[key] if i}   # AD中账号和邮箱不区分大小写
+            for value, dn in Userinfo.objects.filter(**{key + '__in': list(values.values())}).values_list(key, 'dn'):
+                if value.lower() in values:
+                    res[values.pop(value.lower())] = {"found": True, "source": "db", "dn": dn}
+            if values:
+                with OptLdap() as opt_ldap:
+                    for entry in opt_ldap.iter_accounts(key, values.values()):
+                        value = entry['attributes'].get(key)
+                        value = value[0] if isinstance(value, list) and value else value
+                        if value and value.lower() in values:
+                            res[values.pop(value.lower())] = {"found": True, "source": "ad", "dn": entry['dn']}
+                res.update({value: {"found": False, "source": "ad", "dn": None} for value in values.values()})
+        views_logger.info("批量检查账号 %s 个，存在 %s 个", len(res), len([i for i in res.values() if i['found']]))
+        return Response({"status": True, "msg": "success", "obj": res})
+
     @action(methods=['post'], detail=False, permission_classes=[permissions.IsAuthenticated])
     def check_exist(self, request, *args, **kwargs):
         """
-        检查账号是否存在
+        检查账号是否存在，能在本地同步表中回答的过滤条件直接查询数据库(没有结果也不再查询AD域)，不支持时查询AD域
+        属性条件和operator条件只查询用户对象；没有指定attributes时本地和AD域返回相同的属性
         :param {"name": "张三", "sAMAccountName": "zhangsan"}
+        :param {"operator": "&", "obj": {"name": "张三", "sAMAccountName": "zhangsan"}}
+        :param {"filter": "(&(objectCategory=person)(objectClass=user)(mail=zhang*))", "attributes": ["sAMAccountName", "mail"]}
+        :return 返回中的source表示结果来源 db/ad
         """
-        data = request.data
-        if not data:
+        if isinstance(request.data, QueryDict):   # 表单提交的QueryDict直接转换为dict时每个值都是列表
+            data = request.data.dict()
+            data.pop('attributes', None)
+            attributes = request.data.getlist('attributes') or None
+        else:
+            data = dict(request.data)
+            attributes = data.pop('attributes', None)
+        if "filter" in data:
+            filter_all = data['filter']
+        elif "operator" in data:
+            filter_all = USER_FILTER.format("({}{})".format(data['operator'], "".join("({}={})".format(k, v) for k, v in data['obj'].items())))
+        elif len(data) == 1:
+            filter_all = USER_FILTER.format("({}={})".format(*list(data.items())[0]))
+        else:
             return Response({"status": False, "msg": "未接收到任何请求参数"})
-        opt_ldap = OptLdap()
-        if "operator" in data:
-            filter_all = data.pop('operator')
-            for i in data['obj']:
-                filter_all = "{}({}={})".format(filter_all, i, data['obj'][i])
-            res = opt_ldap.get_obj_info(filter_all="(" + filter_all + ")", attr=None)
-        if len(data) == 1:
-            res = opt_ldap.get_obj_info(filter_key=list(data.keys())[0], filter_value=list(data.values())[0], attr=None)
+        if not attributes:
+            attributes = default_attributes(filter_all)
+        try:
+            res = search_local(filter_all, attributes)
+            source = "db"
+        except LdapFilterError as ept:
+            views_logger.info("过滤条件 %s 无法在本地查询: %s", filter_all, ept)
+            source = "ad"
+            with OptLdap() as opt_ldap:
+                res = opt_ldap.get_obj_info(filter_all=filter_all, attr=attributes)
         if len(res) == 0:
-            return Response({"status":False, "msg": "not user", "obj": res})
-        return Response({"status":True, "msg": "success", "obj": res})
+            return Response({"status":False, "msg": "not user", "obj": res, "source": source})
+        return Response({"status":True, "msg": "success", "obj": res, "source": source})
 
 
 class OrginfoViewSet(viewsets.ModelViewSet):
@@ -195,10 +374,21 @@ class OrginfoViewSet(viewsets.ModelViewSet):
     serializer_class = OrginfoSerializer
     permission_classes = [permissions.IsAuthenticated]
 
+    def get_queryset(self):
+        """ ?subtree=<objectGUID> 只返回该部门及所有下级部门 """
+        return filter_subtree(super().get_queryset(), self.request, self.action)
+
     @action(methods=['post'], detail=False, permission_classes=[permissions.IsAuthenticated])
     def sync_org(self, request, *args, **kwargs):
-        """ 将AD域OU信息同步到系统 """
+        """
+        将AD域OU信息同步到系统
+        提交列表时批量同步，返回每一项的 created/updated/error 结果
+        """
         args = request.data
+        if isinstance(args, list):
+            res = batch_upsert_orgs(args)
+            views_logger.info("批量同步OU信息 %s 条", len(res))
+            return Response({"status": True, "msg": "success", "obj": res})
         views_logger.info(args)
         query, status = Orginfo.objects.get_or_create(objectGUID=args['objectGUID'], defaults=args)
         views_logger.info("系统同步到域信息 name:%s - %s", query.name, status)
@@ -211,14 +401,14 @@ class OrginfoViewSet(viewsets.ModelViewSet):
         for i in data:
             if i not in ['name', 'parent_objectGUID']:
                 return Response({"status": False, "msg": "参数中包含异常的内容 key:" + i + " - value:" + data[i]})
-        parent_dpt_query = Orginfo.objects.get(objectGUID=data.pop('parent_objectGUID'))
+        parent_dpt_query = get_org_tree().get_by_guid(data.pop('parent_objectGUID'))
         dn = "OU=%s,%s" % (data['name'], parent_dpt_query.dn)   #pylint: disable=invalid-name
-        opt_ldap = OptLdap()
-        res, msg = opt_ldap.create_obj(dn=dn, obj_type="ou")
-        if not res:
-            views_logger.warning("AD域创建OU失败 %s - %s - %s", dn, msg, res)
-            return Response({"status": False, "msg": "AD域创建OU失败 - " + str(msg)})
-        ad_info = opt_ldap.get_obj_info(filter_key="DistinguishedName", filter_value=dn, attr=['objectGUID'])
+        with OptLdap() as opt_ldap:
+            res, msg = opt_ldap.create_obj(dn=dn, obj_type="ou")
+            if not res:
+                views_logger.warning("AD域创建OU失败 %s - %s - %s", dn, msg, res)
+                return Response({"status": False, "msg": "AD域创建OU失败 - " + str(msg)})
+            ad_info = opt_ldap.get_obj_info(filter_key="DistinguishedName", filter_value=dn, attr=['objectGUID'])
         data.update({'dn': dn, 'objectGUID': str(uuid.UUID(ad_info[0]['attributes']['objectGUID']))})
         request._full_data = data             # 修改request.data的值   pylint: disable=protected-access  
         res = super().create(request)
@@ -228,22 +418,27 @@ class OrginfoViewSet(viewsets.ModelViewSet):
         views_logger.info("数据库新增操作成功 %s - %s", data, "True")
         return Response({"status": True, "msg": "success", "obj": res.data})
 
+    @action(methods=['get'], detail=False, permission_classes=[permissions.IsAuthenticated])
+    def tree(self, request, *args, **kwargs):
+        """ 返回完整的部门树，数据来自进程内缓存 """
+        return Response(get_org_tree().to_list())
+
     @action(methods=['get'], detail=True, permission_classes=[permissions.IsAuthenticated])
     def del_org(self, request, *args, **kwargs):
         """ 删除OU接口 """
         if "pk" not in kwargs:
             return Response({'status': False, 'msg': "无OU的UUID信息！"})
-        opt_ldap = OptLdap()
-        ad_info = opt_ldap.get_obj_info(filter_key='objectGUID', filter_value=kwargs['pk'], attr=opt_ldap.attributes_ou)   # 删除AD域中OU信息
-        if len(ad_info) == 0:   # 检查该信息是否在AD域中存在
-            views_logger.info("AD域不存在该OU %s - %s", kwargs['pk'], "False")
-            return Response({"status": False, "msg": "AD域中没有该用户，详细信息请查看Log"})
-        res, msg = opt_ldap.del_obj(ad_info[0]['dn'])
+        with OptLdap() as opt_ldap:
+            ad_info = opt_ldap.get_obj_info(filter_key='objectGUID', filter_value=kwargs['pk'], attr=opt_ldap.attributes_ou)   # 删除AD域中OU信息
+            if len(ad_info) == 0:   # 检查该信息是否在AD域中存在
+                views_logger.info("AD域不存在该OU %s - %s", kwargs['pk'], "False")
+                return Response({"status": False, "msg": "AD域中没有该用户，详细信息请查看Log"})
+            res, msg = opt_ldap.del_obj(ad_info[0]['dn'])
         if not res:
             views_logger.warning("AD域删除OU失败 %s - %s", msg, res)
             return Response({'status': False, 'msg': "无OU的UUID信息！"})
         views_logger.warning("AD域操作用户离职 DN:%s - %s", ad_info[0]['dn'], "True")
-        db_info = Orginfo.objects.get(objectGUID=kwargs['pk'])
+        db_info = get_org_tree().get_by_guid(kwargs['pk'])
         self.kwargs['pk'] = db_info.id
         res = self.destroy(self, request)  #pylint: disable=no-member
         if res.status_code != 204:
@@ -264,28 +459,35 @@ class OrginfoViewSet(viewsets.ModelViewSet):
             return Response({'status': False, 'msg': "无OU的UUID信息！"})
         data = request.data
         attr = {}
-        current_ou = Orginfo.objects.get(objectGUID=kwargs['pk'])
+        current_ou = Orginfo.objects.filter(objectGUID=kwargs['pk']).first()   # 直接读数据库，避免部门树过期时使用移动前的DN
+        if current_ou is None:
+            return Response({'status': False, 'msg': "系统中没有该部门"})
         if "parentID" in data:
-            new_ou_path = Orginfo.objects.get(objectGUID=data['parentID'])
-            attr['DistinguishedName'] = "OU={},{}".format(data['name'], new_ou_path.dn)
+            new_ou_path = get_org_tree().get_by_guid(data['parentID'])
+            attr['DistinguishedName'] = "OU={},{}".format(data.get('name', current_ou.name), new_ou_path.dn)
             if current_ou.dn == attr['DistinguishedName']:
                 attr.pop("DistinguishedName")
         if "name" in data:
             if current_ou.name != data['name']:
                 attr['name'] = data['name']
-        views_logger.info("更新部门信息 dn:%s attr:%d", current_ou.dn, attr)
-        opt_ldap = OptLdap()
-        res = opt_ldap.update_obj(dn=current_ou.dn, attr=attr)
+        views_logger.info("更新部门信息 dn:%s attr:%s", current_ou.dn, attr)
+        with OptLdap() as opt_ldap:
+            res = opt_ldap.update_obj(dn=current_ou.dn, attr=dict(attr))
         if not res['status']:
             return Response(res)
-        self.kwargs.update({'partial': True, 'pk': current_ou.id})
-        request._full_data = attr    # pylint: disable=protected-access
-        res = self.update(request, **self.kwargs)   # pylint: disable=no-member
-        if res.status_code != 200:
-            views_logger.warning("数据库更新操作失败 ID:%s - %s - %s", current_ou.id, attr, "False")
+        try:
+            with transaction.atomic():
+                if 'name' in attr:
+                    Orginfo.objects.filter(id=current_ou.id).update(name=attr['name'])
+                if res['dn'] != current_ou.dn:   # 改名或移动后改写所有下级OU和用户的DN
+                    moved = move_subtree(current_ou.dn, res['dn'])
+                    views_logger.info("改写下级DN OU:%(orgs)s 用户:%(users)s", moved)
+        except DatabaseError as ept:
+            views_logger.warning("数据库更新操作失败 ID:%s - %s - %s", current_ou.id, attr, ept)
             return Response({"status": False, "msg": "AD域更新成功，数据库更新失败，详细信息请查看系统Log"})
         views_logger.info("数据库更新操作成功 ID:%s - %s - %s", current_ou.id, attr, "True")
-        return Response({"status": True, "msg": "success", "obj": res.data})
+        serializer = self.get_serializer(Orginfo.objects.get(id=current_ou.id))
+        return Response({"status": True, "msg": "success", "obj": serializer.data})
 
     def partial_update(self, request, *args, **kwargs):
         """
@@ -294,6 +496,68 @@ class OrginfoViewSet(viewsets.ModelViewSet):
         """
         return Response({'status': False, 'msg': "不支持PATCH方式提交"})
 
+class GroupinfoViewSet(viewsets.ModelViewSet):
+    """ AD域组信息视图集合，组和成员关系由用户同步时的memberOf生成 """
+    queryset = Groupinfo.objects.all().order_by('id')
+    serializer_class = GroupinfoSerializer
+    permission_classes = [permissions.IsAuthenticated]
+
+    @action(methods=['get'], detail=True, permission_classes=[permissions.IsAuthenticated])
+    def members(self, request, *args, **kwargs):
+        """
+        组的成员列表
+        :URL: /groupinfo/<pk>/members/
+        """
+        queryset = self.get_object().members.select_related('org').order_by('id')
+        page = self.paginate_queryset(queryset)
+        ser = UserinfoSerializer(page, many=True, context={'request': request})
+        return self.get_paginated_response(ser.data)
+
+    def _change_members(self, request, operation):
+        """ 在AD域中分块修改组成员，成功的部分用一条语句同步到本地成员关系表 """
+        accounts = request.data.get('sAMAccountName')
+        if not isinstance(accounts, list) or not accounts:
+            return Response({'status': False, 'msg': "请提交用户名列表！"})
+        group = self.get_object()
+        users = {account: (user_id, dn) for account, user_id, dn in Userinfo.objects.filter(sAMAccountName__in=accounts).values_list('sAMAccountName', 'id', 'dn')}
+        res = {account: {"status": False, "msg": "数据库中没有该用户"} for account in accounts if account not in users}
+        by_dn = {dn: account for account, (_, dn) in users.items()}
+        with OptLdap() as opt_ldap:
+            chunks = opt_ldap.modify_members(group.dn, list(by_dn), operation)
+        ids = []
+        for chunk, status, result in chunks:
+            for dn in chunk:
+                res[by_dn[dn]] = {"status": status, "msg": "success" if status else "AD域修改组成员失败 " + str(result)}
+                if status:
+                    ids.append(users[by_dn[dn]][0])
+        membership = Userinfo.groups.through
+        if ids and operation == 'add':
+            membership.objects.bulk_create([membership(userinfo_id=user_id, groupinfo_id=group.id) for user_id in ids], ignore_conflicts=True)
+        elif ids:
+            membership.objects.filter(groupinfo_id=group.id, userinfo_id__in=ids).delete()
+        if ids:
+            bump_group_version()
+        views_logger.warning("组 %s %s成员 %s 个，成功 %s 个", group.dn, operation, len(accounts), len(ids))
+        return Response({"status": len(ids) == len(accounts), "msg": "success", "obj": res})
+
+    @action(methods=['post'], detail=True, permission_classes=[permissions.IsAuthenticated])
+    def add_members(self, request, *args, **kwargs):
+        """
+        批量添加组成员
+        :URL: /groupinfo/<pk>/add_members/
+        :param {"sAMAccountName": ["zhangsan", "lisi"]}
+        """
+        return self._change_members(request, 'add')
+
+    @action(methods=['post'], detail=True, permission_classes=[permissions.IsAuthenticated])
+    def remove_members(self, request, *args, **kwargs):
+        """
+        批量删除组成员
+        :URL: /groupinfo/<pk>/remove_members/
+        :param {"sAMAccountName": ["zhangsan", "lisi"]}
+        """
+        return self._change_members(request, 'delete')
+
 class ApiInfoView(APIView):
 
     def get(self, request):
@@ -308,3 +572,32 @@ class CheckAuthViewSet(viewsets.GenericViewSet):
             return Response({'status': False, 'msg': "提交的用户名和密码信息有误！"})
         check_res = check_credentials(args['name'], args['pwd'])
         return Response(check_res)
+
+
+class MetricsViewSet(viewsets.ViewSet):
+    """ 运行状态统计信息 """
+    permission_classes = [permissions.IsAuthenticated]
+
+    def list(self, request, *args, **kwargs):
+        return Response({"ldap_pool": get_connection_pool().get_stats(), "ldap_auth": get_credential_checker().get_stats(),
+                         "ldap_schema": get_schema_cache().get_stats(), "ldap_servers": get_server_selector().get_stats()})
+
+    @action(methods=['get'], detail=False, permission_classes=[permissions.IsAuthenticated])
+    def ldap_pool(self, request, *args, **kwargs):
+        """ AD域连接池的命中、等待统计，用于评估连接池大小 """
+        return Response(get_connection_pool().get_stats())
+
+    @action(methods=['get'], detail=False, permission_classes=[permissions.IsAuthenticated])
+    def ldap_auth(self, request, *args, **kwargs):
+        """ 账号验证在各域控上的绑定耗时p50/p99 """
+        return Response(get_credential_checker().get_stats())
+
+    @action(methods=['get'], detail=False, permission_classes=[permissions.IsAuthenticated])
+    def ldap_servers(self, request, *args, **kwargs):
+        """ 各域控的健康评分、错误率和熔断状态，按当前选择顺序排列 """
+        return Response(get_server_selector().get_stats())
+
+    @action(methods=['get'], detail=False, permission_classes=[permissions.IsAuthenticated])
+    def ldap_schema(self, request, *args, **kwargs):
+        """ schema缓存的生成时间和加载、下载耗时 """
+        return Response(get_schema_cache().get_stats())
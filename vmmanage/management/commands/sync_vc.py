@@ -0,0 +1,18 @@
+"""
+将vCenter中的虚拟机批量同步到数据库
+python manage.py sync_vc --chunk-size 500
+"""
+from django.core.management.base import BaseCommand
+from vmmanage.utils.vm_sync import sync_vc_inventory
+
+
+class Command(BaseCommand):
+    help = "分页读取vCenter中的虚拟机，按instanceUuid批量同步到数据库，删除vCenter中已不存在的虚拟机"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--chunk-size', type=int, default=500, help="每批写入数据库的条数")
+
+    def handle(self, *args, **options):
+        res = sync_vc_inventory(chunk_size=options['chunk_size'])
+        self.stdout.write("虚拟机 新增:%(created)s 更新:%(updated)s 删除:%(deleted)s 跳过:%(skipped)s" % res)
+        self.stdout.write(self.style.SUCCESS("同步完成，耗时 %ss" % res['elapsed']))
@@ -0,0 +1,30 @@
+"""
+监听vCenter中虚拟机的变更并增量写入数据库，常驻运行
+python manage.py watch_vc
+python manage.py watch_vc --reset    # 丢弃保存的版本号，重新获取完整数据
+"""
+from django.core.management.base import BaseCommand
+from vmmanage.models import VcWatermark
+from vmmanage.utils.vc_session import get_session_pool
+from vmmanage.utils.vc_watch import InventoryWatcher, get_watch_setting
+
+
+class Command(BaseCommand):
+    help = "通过WaitForUpdatesEx监听vCenter中虚拟机的变更，增量同步到数据库"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--max-wait', type=int, default=get_watch_setting('WATCH_MAX_WAIT'), help="每次等待变更的最长秒数")
+        parser.add_argument('--max-objects', type=int, default=get_watch_setting('WATCH_MAX_OBJECTS'), help="每次最多返回的对象数")
+        parser.add_argument('--reset', action='store_true', help="丢弃保存的版本号")
+
+    def handle(self, *args, **options):
+        pool = get_session_pool()
+        if options['reset']:
+            VcWatermark.objects.filter(host=pool.host).update(version='')
+        watcher = InventoryWatcher(pool, max_wait=options['max_wait'], max_objects=options['max_objects'],
+                                   retry_base=get_watch_setting('WATCH_RETRY_BASE'), retry_max=get_watch_setting('WATCH_RETRY_MAX'))
+        try:
+            watcher.run()
+        except KeyboardInterrupt:
+            pass
+        self.stdout.write(self.style.SUCCESS("停止监听 %s" % watcher.stats))
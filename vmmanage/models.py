@@ -20,3 +20,12 @@ class Vminfo(models.Model):
     update_time = models.DateTimeField(auto_now_add=True)
     dead_time = models.DateField(default=datetime.date.today()+datetime.timedelta(weeks=52))
     user = models.IntegerField(blank=True, null=True)
+    moid = models.CharField(max_length=30, blank=True, default='', db_index=True)   # vCenter中的managed object id，用于处理增量更新和删除
+    power_state = models.CharField(max_length=20, blank=True, default='')
+
+
+class VcWatermark(models.Model):
+    """ 增量同步虚拟机时PropertyCollector的版本号，按vCenter分别记录 """
+    host = models.CharField(max_length=100, unique=True)
+    version = models.CharField(max_length=255, blank=True, default='')
+    update_time = models.DateTimeField(auto_now=True)
@@ -4,4 +4,4 @@ from vmmanage.models import Vminfo
 class VminfoSerializer(serializers.HyperlinkedModelSerializer):
     class Meta:
         model = Vminfo
-        fields = ['url', 'vmname', 'cpus', 'memorys', 'instanceUuid', 'disk', 'cn', 'os', 'hostname', 'ip', 'dead_time']
+        fields = ['url', 'vmname', 'cpus', 'memorys', 'instanceUuid', 'disk', 'cn', 'os', 'hostname', 'ip', 'dead_time', 'power_state']
@@ -1,5 +1,170 @@
 #!/usr/bin/env python
 # -*- coding=utf-8 -*-
-from django.test import TestCase
+from types import SimpleNamespace
+from unittest import mock
+from django.contrib.auth.models import User
+from django.test import SimpleTestCase, TestCase
+from rest_framework.test import APIClient
+from pyVmomi import vim, vmodl  #pylint: disable=no-name-in-module
+from vmmanage.models import Vminfo, VcWatermark
+from vmmanage.utils.vc_inventory import InventoryIndex
+from vmmanage.utils.vc_watch import InventoryWatcher
+from vmmanage.utils.vm_sync import sync_vc_inventory
 
-# Create your tests here.
+PC = vmodl.query.PropertyCollector
+
+
+def changes(props):
+    return [PC.Change(name=name, op='assign', val=value) for name, value in props.items()]
+
+
+def vm_props(name, uuid, cpus=2):
+    return changes({'name': name, 'config.template': False, 'config.instanceUuid': uuid, 'config.hardware.numCPU': cpus,
+                    'config.hardware.memoryMB': 2048, 'config.hardware.device': [], 'runtime.powerState': 'poweredOn'})
+
+
+def update_set(version, objects, truncated=False):
+    return PC.UpdateSet(version=version, truncated=truncated, filterSet=[PC.FilterUpdate(
+        objectSet=[PC.ObjectUpdate(kind=kind, obj=obj, changeSet=change_set) for kind, obj, change_set in objects])])
+
+
+class FakeCollector():
+    """ 按脚本依次返回WaitForUpdatesEx的结果，'stop'时停止监听 """
+    def __init__(self, watcher, script):
+        self.watcher = watcher
+        self.script = script
+
+    def WaitForUpdatesEx(self, version, options):   # pylint: disable=invalid-name,unused-argument
+        step = self.script.pop(0)
+        if step == 'stop':
+            self.watcher.stop()
+            return None
+        if isinstance(step, Exception):
+            raise step
+        return step
+
+    def CancelWaitForUpdates(self):   # pylint: disable=invalid-name
+        pass
+
+    def DestroyPropertyCollector(self):   # pylint: disable=invalid-name
+        pass
+
+
+class FakePool():
+    host = 'vc'
+
+    def __init__(self, acquire_errors=0, relogin_errors=0):
+        self.acquire_errors = acquire_errors
+        self.relogin_errors = relogin_errors
+        self.released = 0
+
+    def acquire(self):
+        if self.acquire_errors:
+            self.acquire_errors -= 1
+            raise OSError('vCenter unreachable')
+        return SimpleNamespace(content=None)
+
+    def release(self, session):   # pylint: disable=unused-argument
+        self.released += 1
+
+    def relogin(self, session):   # pylint: disable=unused-argument
+        if self.relogin_errors:
+            self.relogin_errors -= 1
+            raise OSError('relogin failed')
+
+
+class InventoryWatcherTests(TestCase):
+    """ 虚拟机增量同步 """
+    def watch(self, pool, script):
+        watcher = InventoryWatcher(pool, retry_base=0, retry_max=0)
+        watcher._create_filter = lambda content: setattr(watcher, '_collector', FakeCollector(watcher, script))   # pylint: disable=protected-access
+        return watcher.run()
+
+    def test_apply_updates(self):
+        Vminfo.objects.create(vmname='gone', cpus=1, memorys=1, instanceUuid='u9', disk=1, moid='vm-9')
+        vm1, vm2 = vim.VirtualMachine('vm-1'), vim.VirtualMachine('vm-2')
+        stats = self.watch(FakePool(), [
+            update_set('1', [('enter', vm1, vm_props('a', 'u1')), ('enter', vm2, vm_props('b', 'u2'))]),
+            update_set('2', [('modify', vm1, changes({'runtime.powerState': 'poweredOff', 'config.hardware.numCPU': 4})), ('leave', vm2, [])]),
+            'stop',
+        ])
+        self.assertEqual((stats['created'], stats['deleted']), (2, 2))
+        self.assertEqual(list(Vminfo.objects.values_list('instanceUuid', 'cpus', 'power_state')), [('u1', 4, 'poweredOff')])
+        self.assertEqual(VcWatermark.objects.get(host='vc').version, '2')
+
+    def test_retry_on_outage(self):
+        VcWatermark.objects.create(host='vc', version='3')
+        pool = FakePool(acquire_errors=1, relogin_errors=1)
+        stats = self.watch(pool, [OSError('socket closed'), vim.fault.NotAuthenticated(), None, 'stop'])
+        self.assertEqual(stats['retries'], 3)
+        self.assertEqual(pool.released, 3)   # 两次出错时归还，退出时归还最后一个会话
+        self.assertEqual(VcWatermark.objects.get(host='vc').version, '3')
+
+
+class SyncVcInventoryTests(TestCase):
+    """ 从vCenter全量同步虚拟机 """
+    def sync(self, objects):
+        props = [(vim.VirtualMachine(mo_id), {change.name: change.val for change in change_set}) for mo_id, change_set in objects]
+        with mock.patch('vmmanage.utils.common.get_session_pool', return_value=FakePool()), \
+                mock.patch('vmmanage.utils.vm_sync.retrieve_properties', return_value=iter(props)):
+            return sync_vc_inventory(chunk_size=1)
+
+    def test_sync(self):
+        Vminfo.objects.create(vmname='old', cpus=1, memorys=1, instanceUuid='u1', disk=1)
+        Vminfo.objects.create(vmname='gone', cpus=1, memorys=1, instanceUuid='u9', disk=1, moid='vm-9')
+        Vminfo.objects.create(vmname='manual', cpus=1, memorys=1, instanceUuid='u8', disk=1)
+        template = vm_props('tpl', 'u3')
+        template[1].val = True
+        res = self.sync([('vm-1', vm_props('a', 'u1', cpus=4)), ('vm-2', vm_props('b', 'u2')), ('vm-3', template)])
+        self.assertEqual((res['created'], res['updated'], res['deleted'], res['skipped']), (1, 1, 1, 1))
+        self.assertEqual(list(Vminfo.objects.order_by('instanceUuid').values_list('instanceUuid', 'moid', 'cpus')),
+                         [('u1', 'vm-1', 4), ('u2', 'vm-2', 2), ('u8', '', 1)])
+
+
+class BatchUpsertVmsTests(TestCase):
+    """ sync_vm提交列表时逐项校验并返回结果 """
+    def setUp(self):
+        self.client = APIClient()
+        self.client.force_authenticate(User.objects.create(username='admin'))
+
+    def test_sync_vm(self):
+        Vminfo.objects.create(vmname='old', cpus=1, memorys=1, instanceUuid='u1', disk=1)
+        items = [{'instanceUuid': 'u1', 'cpus': 4}, {'instanceUuid': 'u2', 'vmname': 'b', 'cpus': 2, 'memorys': 4, 'disk': 50},
+                 {'instanceUuid': 'u3', 'vmname': 'c', 'cpus': 'x', 'memorys': 4, 'disk': 50},
+                 {'instanceUuid': 'u4', 'vmname': 'd', 'cpus': -1, 'memorys': 4, 'disk': 50},
+                 {'instanceUuid': 'u5', 'vmname': 'e', 'cpus': 2}, {'vmname': 'f'}]
+        res = self.client.post('/api/v1/vminfo/sync_vm/', items, format='json').json()
+        self.assertEqual([i['status'] for i in res['obj']], ['updated', 'created', 'error', 'error', 'error', 'error'])
+        self.assertIn('cpus', res['obj'][3]['msg'])
+        self.assertEqual(list(Vminfo.objects.order_by('instanceUuid').values_list('instanceUuid', 'vmname', 'cpus')),
+                         [('u1', 'old', 4), ('u2', 'b', 2)])
+
+
+class InventoryIndexTests(SimpleTestCase):
+    """ vCenter对象索引 """
+    def setUp(self):
+        self.content = SimpleNamespace(propertyCollector=SimpleNamespace(_stub=None))
+        self.objects = [(vim.VirtualMachine('vm-1'), {'name': 'a'}), (vim.VirtualMachine('vm-2'), {'name': 'a'})]
+        patcher = mock.patch('vmmanage.utils.vc_inventory.retrieve_properties', side_effect=lambda *args: iter(self.objects))
+        self.retrieve = patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_lookup(self):
+        index = InventoryIndex(min_refresh=0)
+        self.assertEqual(index.lookup(self.content, [vim.VirtualMachine], 'a')._moId, 'vm-1')   # 重名时保留第一个
+        self.assertEqual(self.retrieve.call_count, 1)
+        self.objects.append((vim.VirtualMachine('vm-3'), {'name': 'c'}))
+        self.assertEqual(index.lookup(self.content, [vim.VirtualMachine], 'c')._moId, 'vm-3')   # 查找不到时重新加载
+        self.assertIsNone(index.lookup(self.content, [vim.VirtualMachine], 'nope'))
+        self.assertEqual(index.get_stats()['loads'], 3)
+
+    def test_invalidate(self):
+        index = InventoryIndex(min_refresh=60)
+        self.assertIsNone(index.lookup(self.content, [vim.VirtualMachine], 'nope'))   # 刚加载的索引不重新加载
+        self.assertEqual(len(index.all(self.content, [vim.VirtualMachine])), 1)
+        index.invalidate([vim.Folder])
+        index.all(self.content, [vim.VirtualMachine])
+        self.assertEqual(self.retrieve.call_count, 1)
+        index.invalidate([vim.VirtualMachine])
+        index.all(self.content, [vim.VirtualMachine])
+        self.assertEqual(self.retrieve.call_count, 2)
@@ -18,8 +18,12 @@ from math import trunc
 from string import ascii_lowercase as allow_string
 from string import digits as allow_digits
 from functools import wraps
+from concurrent.futures import TimeoutError as FutureTimeoutError
 from pyVim.connect import SmartConnectNoSSL, Disconnect
 from django.conf import settings
+from vmmanage.utils.vc_session import get_session_pool
+from vmmanage.utils.vc_inventory import inventory_index
+from vmmanage.utils.vc_task import get_task_tracker, get_task_setting
 
 
 
@@ -67,49 +71,53 @@ class SmartConnectionNoSSL(object):
         return self.service_instance
 
     def __exit__(self, exc_type, exc_val, exc_tb):
-        pass
-        # if self.service_instance:
-        #     Disconnect(self.service_instance)
-        #     self.content = None
-        #     self.service_instance = None
+        if self.service_instance:
+            Disconnect(self.service_instance)
+            self.content = None
+            self.service_instance = None
 
 class LoginVC():
-    """ 利用类装饰器封装上下文管理器和VC进行交互 """
+    """ 类装饰器，从进程内共享的会话池(vc_session.py)借出已登录的会话和VC进行交互，会话失效时重新登录后重试一次 """
     def __init__(self, need_content=False, need_si=False):
-        self.vc = get_default_setting(['HOST', 'USERNAME', 'PASSWORD'])
         self.need_content = need_content
         self.need_si = need_si
-        self.service_instance = None
-        self.content = None
+
+    def _call(self, func, session, args, kwargs):
+        if self.need_content:
+            kwargs['content'] = session.content
+        if self.need_si:
+            kwargs['service_instance'] = session.service_instance
+        return func(*args, **kwargs)
 
     def __call__(self, func):
         @wraps(func)
         def warpped_function(*args, **kwargs):
-            with SmartConnectionNoSSL(host=self.vc['HOST'], user=self.vc['USERNAME'], pwd=self.vc['PASSWORD']) as si:
-                self.service_instance = si
-                self.set_content()
-                if self.need_content:
-                    kwargs['content'] = self.content
-                if self.need_si:
-                    kwargs['service_instance'] = self.service_instance
-                result = func(*args, **kwargs)
-            return result
+            pool = get_session_pool()
+            session = pool.acquire()
+            try:
+                try:
+                    return self._call(func, session, args, kwargs)
+                except vim.fault.NotAuthenticated:
+                    pool.relogin(session)
+                    return self._call(func, session, args, kwargs)
+            finally:
+                pool.release(session)
         return warpped_function
 
-    def set_content(self):
-        self.content = self.service_instance.RetrieveContent()
-
-def wait_for_task(task, msg):
-    """ wait for a vCenter task to finish """
-    vm_logger.info("TASK_ID: %s, NAME: %s", task.info.key, msg)
-    while True:
-        if task.info.state == 'success':
-            vm_logger.info("TASK: %s, SUCCESS", msg)
-            return True, task.info.state
-        if task.info.state == 'error':
-            vm_logger.error("TASK: %s, 出现错误", msg)
-            vm_logger.error(task.info.description)
-            return False, task.info.error.msg
+def wait_for_task(task, msg, timeout=None):
+    """
+    wait for a vCenter task to finish
+    由任务跟踪器(vc_task.py)通过WaitForUpdatesEx等待，不再循环读取task.info；超时后取消任务并返回 (False, "timeout")
+    """
+    if timeout is None:
+        timeout = get_task_setting('TASK_TIMEOUT')
+    tracked = get_task_tracker().track(task, msg, timeout)
+    try:
+        # 跟踪线程异常时也不会一直阻塞，多等待两个轮询周期让跟踪线程先处理超时
+        return tracked.future.result(timeout=timeout + 2 * get_task_setting('TASK_POLL_WAIT') if timeout else None)
+    except FutureTimeoutError:
+        vm_logger.error("TASK: %s, 等待超时", msg)
+        return False, "timeout"
 
 @LoginVC(need_content=True)
 def get_obj(vimtype, name, content=None):
@@ -120,19 +128,17 @@ def get_obj(vimtype, name, content=None):
     @link: 其他可以查询的管理对象查看 https://code.vmware.com/apis/968/vsphere
     @return: 如果查找到MOB，返回当前对象，没有找到，返回None
     '''
-    obj = None
     vm_logger.info("查找 MOB vimtype: %s name:%s", vimtype, name)
-    container = content.viewManager.CreateContainerView(content.rootFolder, vimtype, True)
-    for i in container.view:
-        if i.name == name:
-            obj = i
-            break
-    container.Destroy()
-    return obj
+    return inventory_index.lookup(content, vimtype, name)
 
 @LoginVC(need_content=True)
 def get_obj_by_uuid(uuid, content=None):
-    return content.searchIndex.FindAllByUuid(None, uuid, True, True)
+    '''
+    @description: 通过instanceUuid查找虚拟机
+    @return: 与FindAllByUuid一致，返回列表
+    '''
+    obj = inventory_index.lookup(content, [vim.VirtualMachine], uuid, prop='config.instanceUuid')
+    return [obj] if obj is not None else []
 
 # @LoginVC
 # def get_obj_by_name(name, isVM=True, content=None):
@@ -140,12 +146,8 @@ def get_obj_by_uuid(uuid, content=None):
 
 @LoginVC(need_content=True)
 def get_all_obj(vimtype, content=None):
-    obj = None
     vm_logger.info("查找OBJ类 type:%s", str(vimtype))
-    container = content.viewManager.CreateContainerView(content.rootFolder, vimtype, True)
-    obj = container.view
-    container.Destroy()
-    return obj
+    return inventory_index.all(content, vimtype)
 
 @LoginVC(need_content=True)
 def get_storage(cluster, useSpace, content=None):
@@ -12,6 +12,7 @@
 
 import logging
 from pyVmomi import vim   #pylint: disable=no-name-in-module
+from vmmanage.utils.vc_inventory import inventory_index
 from vmmanage.utils.common import LoginVC, get_vm_default_power_status, get_obj, get_storage, wait_for_task, get_random_vm_name, get_custom_spec, get_obj_prefix_label
 
 vm_logger = logging.getLogger('optVm')
@@ -384,6 +385,7 @@ class OptVM(VM):
         self.vm_deploy_config.update({"vm_conf_spec": vm_config_spec, "custom_spec": custom_spec})
         task = self.clone_vm(**self.vm_deploy_config)
         task_result, task_msg = wait_for_task(task, "Deploy_VM")
+        inventory_index.invalidate([vim.VirtualMachine])
         return task_result, task_msg
 
     def powerchange_vm(self, status):
@@ -466,4 +468,5 @@ class OptVM(VM):
     def del_vm(self):
         task = self.vm_obj.Destroy_Task()
         task_res, task_msg = wait_for_task(task, "Destory_VM")
+        inventory_index.invalidate([vim.VirtualMachine])
         return task_res, task_msg
\ No newline at end of file
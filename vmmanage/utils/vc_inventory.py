@@ -0,0 +1,137 @@
+#!/usr/bin/env python
+# -*- coding=utf-8 -*-
+'''
+@Author: ZhaoLiang
+@Email: zhaoliang@hupu.com
+@Description: 基于PropertyCollector的vCenter对象索引
+    通过ContainerView + RetrievePropertiesEx分页一次取回某类对象的指定属性(如name)，避免逐个对象读取属性
+    索引按类型和属性缓存，超过TTL或执行了新增、删除、重命名后失效
+    索引中只保存moId，取出时绑定到当前会话的stub，会话重新建立后仍然可用
+@FilePath: /Galilee/vmmanage/utils/vc_inventory.py
+'''
+import time
+import logging
+import threading
+from pyVmomi import vim, vmodl  #pylint: disable=no-name-in-module
+from django.conf import settings
+
+vm_logger = logging.getLogger('optVm')
+
+DEFAULT_INVENTORY_SETTINGS = {
+    'INVENTORY_TTL': 300,          # 索引缓存秒数
+    'INVENTORY_MIN_REFRESH': 10,   # 查找不到时，索引已超过该秒数则重新加载一次
+    'INVENTORY_PAGE_SIZE': 1000,   # RetrievePropertiesEx每页对象数
+}
+
+
+def get_inventory_setting(name):
+    '''
+    @description: 获取settings文件VMMANGE中的索引配置，未配置时使用默认值
+    '''
+    settings_dict = getattr(settings, 'VMMANGE', {})
+    return settings_dict.get(name, DEFAULT_INVENTORY_SETTINGS[name])
+
+
+def retrieve_properties(content, vimtype, path_set, page_size=1000):
+    '''
+    @description: 一次分页查询取回vimtype类型所有对象的path_set属性
+    @param {type} vimtype: [vim.VirtualMachine] 等，和ContainerView的类型一致；path_set: ['name']
+    @return: 生成器 (对象, {属性: 值})
+    '''
+    container = content.viewManager.CreateContainerView(content.rootFolder, vimtype, True)
+    try:
+        traversal = vmodl.query.PropertyCollector.TraversalSpec(name='traverseView', path='view', skip=False, type=vim.view.ContainerView)
+        obj_spec = vmodl.query.PropertyCollector.ObjectSpec(obj=container, skip=True, selectSet=[traversal])
+        prop_specs = [vmodl.query.PropertyCollector.PropertySpec(type=i, pathSet=path_set, all=False) for i in vimtype]
+        filter_spec = vmodl.query.PropertyCollector.FilterSpec(objectSet=[obj_spec], propSet=prop_specs)
+        options = vmodl.query.PropertyCollector.RetrieveOptions(maxObjects=page_size)
+        collector = content.propertyCollector
+        result = collector.RetrievePropertiesEx([filter_spec], options)
+        while result:
+            for obj in result.objects:
+                yield obj.obj, {prop.name: prop.val for prop in obj.propSet}
+            if not result.token:
+                break
+            result = collector.ContinueRetrievePropertiesEx(result.token)
+    finally:
+        container.Destroy()
+
+
+class InventoryIndex():
+    """ 按(类型, 属性)缓存的 属性值->对象 索引 """
+    def __init__(self, ttl=300, min_refresh=10, page_size=1000):
+        self.ttl = ttl
+        self.min_refresh = min_refresh
+        self.page_size = page_size
+        self._indexes = {}   # {(类型名, 属性): (加载时间, {属性值: (类型, moId)})}
+        self._lock = threading.Lock()
+        self._stats = {'hits': 0, 'misses': 0, 'loads': 0, 'load_time_total': 0.0}
+
+    @staticmethod
+    def _key(vimtype, prop):
+        return tuple(sorted(i._wsdlName for i in vimtype)), prop   # pylint: disable=protected-access
+
+    def _load(self, content, vimtype, prop):
+        start = time.monotonic()
+        index = {}
+        for obj, props in retrieve_properties(content, vimtype, [prop], self.page_size):
+            if prop in props:
+                index.setdefault(props[prop], (type(obj), obj._moId))   # 重名时与逐个遍历一样保留第一个  pylint: disable=protected-access
+        elapsed = time.monotonic() - start
+        with self._lock:
+            self._indexes[self._key(vimtype, prop)] = (time.monotonic(), index)
+            self._stats['loads'] += 1
+            self._stats['load_time_total'] += elapsed
+        vm_logger.info("加载vCenter对象索引 type:%s prop:%s count:%s 耗时 %.3fs", vimtype, prop, len(index), elapsed)
+        return index
+
+    def _get_index(self, content, vimtype, prop):
+        entry = self._indexes.get(self._key(vimtype, prop))
+        if entry is None or time.monotonic() - entry[0] >= self.ttl:
+            return self._load(content, vimtype, prop), time.monotonic()
+        return entry[1], entry[0]
+
+    @staticmethod
+    def _bind(content, item):
+        obj_type, mo_id = item
+        return obj_type(mo_id, content.propertyCollector._stub)   # pylint: disable=protected-access
+
+    def lookup(self, content, vimtype, value, prop='name'):
+        '''
+        @description: 按属性值查找对象，查找不到且索引不是刚加载的时重新加载一次
+        @return: 找到返回对象，否则返回None
+        '''
+        index, loaded = self._get_index(content, vimtype, prop)
+        if value not in index and time.monotonic() - loaded >= self.min_refresh:
+            index = self._load(content, vimtype, prop)
+        with self._lock:
+            self._stats['hits' if value in index else 'misses'] += 1
+        return self._bind(content, index[value]) if value in index else None
+
+    def all(self, content, vimtype, prop='name'):
+        index, _ = self._get_index(content, vimtype, prop)
+        return [self._bind(content, item) for item in index.values()]
+
+    def invalidate(self, vimtype=None):
+        '''
+        @description: 新增、删除、重命名对象后调用，使包含该类型的索引失效，不传类型时清空所有索引
+        '''
+        names = None if vimtype is None else {i._wsdlName for i in vimtype}   # pylint: disable=protected-access
+        with self._lock:
+            for key in list(self._indexes):
+                if names is None or names & set(key[0]):
+                    del self._indexes[key]
+
+    def get_stats(self):
+        with self._lock:
+            stats = dict(self._stats)
+            stats['indexes'] = {"%s.%s" % ("/".join(key[0]), key[1]): len(entry[1]) for key, entry in self._indexes.items()}
+        stats['objects'] = sum(stats['indexes'].values())
+        return stats
+
+
+inventory_index = InventoryIndex(
+    ttl=get_inventory_setting('INVENTORY_TTL'),
+    min_refresh=get_inventory_setting('INVENTORY_MIN_REFRESH'),
+    page_size=get_inventory_setting('INVENTORY_PAGE_SIZE'),
+)
@@ -0,0 +1,181 @@
+#!/usr/bin/env python
+# -*- coding=utf-8 -*-
+'''
+@Author: ZhaoLiang
+@Email: zhaoliang@hupu.com
+@Description: 进程内共享的vCenter会话池
+    复用少量已登录的会话和ServiceContent，后台线程定期保活，会话失效(NotAuthenticated)时在原会话上重新登录
+    重新登录不会更换stub，已经获取的管理对象(MOB)仍然可用；进程退出时注销所有会话
+@FilePath: /Galilee/vmmanage/utils/vc_session.py
+'''
+import time
+import atexit
+import logging
+import threading
+from pyVim.connect import SmartConnectNoSSL, Disconnect
+from pyVmomi import vim  #pylint: disable=no-name-in-module
+from django.conf import settings
+
+vm_logger = logging.getLogger('optVm')
+
+DEFAULT_SESSION_SETTINGS = {
+    'SESSION_POOL_SIZE': 2,      # 最多保持的会话数，pyVmomi的stub可以被多个线程同时使用
+    'SESSION_KEEPALIVE': 600,    # 保活间隔秒数，需小于vCenter的会话空闲超时(默认30分钟)
+}
+
+
+def get_session_setting(name):
+    '''
+    @description: 获取settings文件VMMANGE中的会话池配置，未配置时使用默认值
+    '''
+    settings_dict = getattr(settings, 'VMMANGE', {})
+    return settings_dict.get(name, DEFAULT_SESSION_SETTINGS[name])
+
+
+class VcSession():
+    """ 一个已登录的vCenter会话 """
+    def __init__(self, service_instance):
+        self.service_instance = service_instance
+        self.content = service_instance.RetrieveContent()
+        self.in_flight = 0
+        self.last_used = time.monotonic()
+
+
+class VcSessionPool():
+    """ vCenter会话池，会话按当前并发数分配，不会阻塞等待 """
+    def __init__(self, host, user, pwd, size=2, keepalive=600):
+        self.host = host
+        self.user = user
+        self.pwd = pwd
+        self.size = size
+        self.keepalive = keepalive
+        self._sessions = []
+        self._lock = threading.Lock()
+        self._local = threading.local()   # 同一线程内嵌套调用复用同一会话
+        self._keepalive_thread = None
+        self._closed = False
+        self._stats = {'logins': 0, 'relogins': 0, 'acquires': 0, 'reuses': 0, 'keepalives': 0, 'disconnects': 0}
+
+    def _login(self):
+        service_instance = SmartConnectNoSSL(host=self.host, user=self.user, pwd=self.pwd)
+        session = VcSession(service_instance)
+        with self._lock:
+            self._stats['logins'] += 1
+        vm_logger.info("登录vCenter %s 会话数:%s", self.host, len(self._sessions) + 1)
+        return session
+
+    def relogin(self, session):
+        '''
+        @description: 会话过期后在原stub上重新登录，已获取的管理对象继续有效
+        '''
+        session.content.sessionManager.Login(self.user, self.pwd)
+        with self._lock:
+            self._stats['relogins'] += 1
+        vm_logger.warning("vCenter会话失效，重新登录 %s", self.host)
+
+    def _start_keepalive(self):
+        if self._keepalive_thread is None:
+            self._keepalive_thread = threading.Thread(target=self._keepalive_loop, name='vc-keepalive', daemon=True)
+            self._keepalive_thread.start()
+
+    def _keepalive_loop(self):
+        while not self._closed:
+            time.sleep(self.keepalive)
+            for session in list(self._sessions):
+                if time.monotonic() - session.last_used >= self.keepalive:
+                    self._ping(session)
+
+    def _ping(self, session):
+        '''
+        @description: 读取当前会话信息保活，会话已失效时重新登录
+        '''
+        try:
+            if session.content.sessionManager.currentSession is None:
+                self.relogin(session)
+            session.last_used = time.monotonic()
+            with self._lock:
+                self._stats['keepalives'] += 1
+        except vim.fault.NotAuthenticated:
+            self.relogin(session)
+        except Exception as ept:   # pylint: disable=broad-except
+            vm_logger.error("vCenter会话保活失败，丢弃会话 %s", ept)
+            with self._lock:
+                if session in self._sessions:
+                    self._sessions.remove(session)
+
+    def acquire(self):
+        '''
+        @description: 借出会话，同一线程的嵌套调用返回同一会话；所有会话都在使用且未达到上限时新建会话
+        '''
+        current = getattr(self._local, 'session', None)
+        if current is not None:
+            self._local.depth += 1
+            return current
+        with self._lock:
+            self._stats['acquires'] += 1
+            idle = min(self._sessions, key=lambda session: session.in_flight, default=None)
+            create = idle is None or (idle.in_flight > 0 and len(self._sessions) < self.size)
+            if not create:
+                self._stats['reuses'] += 1
+                idle.in_flight += 1
+        if create:
+            idle = self._login()
+            idle.in_flight += 1
+            with self._lock:
+                self._sessions.append(idle)
+            self._start_keepalive()
+        self._local.session = idle
+        self._local.depth = 1
+        return idle
+
+    def release(self, session):
+        self._local.depth -= 1
+        if self._local.depth:
+            return
+        self._local.session = None
+        session.last_used = time.monotonic()
+        with self._lock:
+            session.in_flight -= 1
+
+    def close(self):
+        '''
+        @description: 注销所有会话，进程退出时调用
+        '''
+        self._closed = True
+        with self._lock:
+            sessions, self._sessions = self._sessions, []
+        for session in sessions:
+            try:
+                Disconnect(session.service_instance)
+                self._stats['disconnects'] += 1
+            except Exception as ept:   # pylint: disable=broad-except
+                vm_logger.warning("注销vCenter会话失败 %s", ept)
+
+    def get_stats(self):
+        with self._lock:
+            stats = dict(self._stats)
+            stats.update({'size': self.size, 'sessions': len(self._sessions), 'in_flight': sum(i.in_flight for i in self._sessions)})
+        stats['reuse_ratio'] = round(stats['reuses'] / stats['acquires'], 4) if stats['acquires'] else 0
+        return stats
+
+
+_session_pool = None
+_session_pool_lock = threading.Lock()
+
+def get_session_pool():
+    '''
+    @description: 获取进程内共享的vCenter会话池，首次调用时创建并注册退出时注销
+    '''
+    global _session_pool   # pylint: disable=global-statement
+    with _session_pool_lock:
+        if _session_pool is None:
+            vc = getattr(settings, 'VMMANGE', {})
+            _session_pool = VcSessionPool(
+                host=vc['HOST'],
+                user=vc['USERNAME'],
+                pwd=vc['PASSWORD'],
+                size=get_session_setting('SESSION_POOL_SIZE'),
+                keepalive=get_session_setting('SESSION_KEEPALIVE'),
+            )
+            atexit.register(_session_pool.close)
+        return _session_pool
@@ -0,0 +1,333 @@
+#!/usr/bin/env python
+# -*- coding=utf-8 -*-
+'''
+@Author: ZhaoLiang
+@Email: zhaoliang@hupu.com
+@Description: vCenter任务跟踪
+    后台线程使用单独的PropertyCollector，每个任务注册一个过滤器，通过WaitForUpdatesEx同时等待所有任务的状态和进度变化
+    调用方可以阻塞等待Future，也可以按任务ID查询进度；支持超时和取消
+@FilePath: /Galilee/vmmanage/utils/vc_task.py
+'''
+import time
+import logging
+import threading
+from concurrent.futures import Future
+from pyVmomi import vim, vmodl  #pylint: disable=no-name-in-module
+from django.conf import settings
+from vmmanage.utils.vc_session import get_session_pool
+
+vm_logger = logging.getLogger('optVm')
+
+DEFAULT_TASK_SETTINGS = {
+    'TASK_TIMEOUT': 3600,      # 等待任务的默认超时秒数，超时后取消vCenter中的任务
+    'TASK_POLL_WAIT': 5,       # 有任务时每次WaitForUpdatesEx最长等待秒数
+    'TASK_RETENTION': 3600,    # 已结束任务保留多少秒供查询
+    'TASK_RETRY_MAX': 60,      # 连接vCenter失败后重试的最长间隔秒数
+}
+
+TASK_PROPERTIES = ['info.state', 'info.progress', 'info.error', 'info.result', 'info.descriptionId']
+FINISHED_STATES = ('success', 'error', 'timeout')
+
+
+def get_task_setting(name):
+    '''
+    @description: 获取settings文件VMMANGE中的任务跟踪配置，未配置时使用默认值
+    '''
+    settings_dict = getattr(settings, 'VMMANGE', {})
+    return settings_dict.get(name, DEFAULT_TASK_SETTINGS[name])
+
+
+class TrackedTask():
+    """ 一个被跟踪的vCenter任务，future的结果和wait_for_task一致: (是否成功, 信息) """
+    def __init__(self, task, msg, timeout=None):
+        self.task_id = task._moId   # pylint: disable=protected-access
+        self.msg = msg
+        self.task = task            # 注册过滤器后换成绑定到跟踪线程会话的任务对象
+        self.state = 'queued'
+        self.progress = 0
+        self.error = None
+        self.result = None
+        self.description = None
+        self.created = time.monotonic()
+        self.deadline = self.created + timeout if timeout else None
+        self.finished = None
+        self.filter = None
+        self.future = Future()
+
+    @property
+    def done(self):
+        return self.state in FINISHED_STATES
+
+    def to_dict(self):
+        end = self.finished or time.monotonic()
+        return {
+            'id': self.task_id,
+            'name': self.msg,
+            'description': self.description,
+            'state': self.state,
+            'progress': 100 if self.state == 'success' else self.progress,
+            'error': self.error,
+            'elapsed': round(end - self.created, 3),
+        }
+
+
+class TaskTracker():
+    """ 进程内共享的任务跟踪器，所有PropertyCollector调用都在后台线程中执行 """
+    def __init__(self, pool, poll_wait=5, retention=3600, retry_max=60):
+        self.pool = pool
+        self.poll_wait = poll_wait
+        self.retention = retention
+        self.retry_max = retry_max
+        self._tasks = {}
+        self._new = []
+        self._lock = threading.Lock()
+        self._event = threading.Event()
+        self._thread = None
+        self._collector = None
+        self._version = ''
+        self._waiting = False
+        self._stats = {'tracked': 0, 'success': 0, 'error': 0, 'timeout': 0, 'cancelled': 0, 'waits': 0}
+
+    def track(self, task, msg, timeout=None):
+        '''
+        @description: 开始跟踪任务，不阻塞
+        @param {type} task: vim.Task；timeout: 超时秒数，None表示不超时
+        @return: TrackedTask，通过future等待结果或通过task_id查询进度
+        '''
+        with self._lock:
+            tracked = TrackedTask(task, msg, timeout)
+            self._tasks[tracked.task_id] = tracked
+            self._new.append(tracked)
+            self._stats['tracked'] += 1
+            self._start()
+        vm_logger.info("TASK_ID: %s, NAME: %s", tracked.task_id, msg)
+        self._wake()
+        return tracked
+
+    def get(self, task_id):
+        return self._tasks.get(task_id)
+
+    def list(self):
+        with self._lock:
+            return [i.to_dict() for i in sorted(self._tasks.values(), key=lambda i: i.created, reverse=True)]
+
+    def cancel(self, task_id):
+        '''
+        @description: 取消vCenter中的任务，任务结束后future返回失败
+        @return: (是否成功, 信息)
+        '''
+        tracked = self._tasks.get(task_id)
+        if tracked is None:
+            return False, "task not found"
+        if tracked.done:
+            return False, "task already finished"
+        try:
+            tracked.task.CancelTask()
+        except (vim.fault.InvalidState, vmodl.fault.NotSupported, vmodl.fault.ManagedObjectNotFound) as ept:
+            return False, ept.msg
+        with self._lock:
+            self._stats['cancelled'] += 1
+        vm_logger.warning("取消任务 %s %s", task_id, tracked.msg)
+        return True, "cancel requested"
+
+    def _start(self):
+        if self._thread is None or not self._thread.is_alive():
+            self._thread = threading.Thread(target=self._run, name='vc-task-tracker', daemon=True)
+            self._thread.start()
+
+    def _wake(self):
+        '''
+        @description: 有新任务时唤醒后台线程，正在等待的WaitForUpdatesEx被取消后立即注册新任务
+        '''
+        self._event.set()
+        collector = self._collector
+        if collector is not None and self._waiting:
+            try:
+                collector.CancelWaitForUpdates()
+            except Exception as ept:   # pylint: disable=broad-except
+                vm_logger.warning("取消WaitForUpdatesEx失败 %s", ept)
+
+    def _add_filter(self, tracked):
+        task = vim.Task(tracked.task_id, self._collector._stub)   # pylint: disable=protected-access
+        tracked.task = task
+        obj_spec = vmodl.query.PropertyCollector.ObjectSpec(obj=task, skip=False)
+        prop_spec = vmodl.query.PropertyCollector.PropertySpec(type=vim.Task, pathSet=TASK_PROPERTIES, all=False)
+        filter_spec = vmodl.query.PropertyCollector.FilterSpec(objectSet=[obj_spec], propSet=[prop_spec])
+        try:
+            tracked.filter = self._collector.CreateFilter(filter_spec, partialUpdates=False)
+        except vmodl.fault.ManagedObjectNotFound as ept:
+            self._finish(tracked, 'error', ept.msg)
+
+    def _create_collector(self, content):
+        '''
+        @description: 创建单独的PropertyCollector，会话重新登录后重新注册所有未结束的任务
+        '''
+        self._collector = content.propertyCollector.CreatePropertyCollector()
+        self._version = ''
+        with self._lock:
+            self._new = [i for i in self._tasks.values() if not i.done]
+
+    def _finish(self, tracked, state, error=None):
+        with self._lock:
+            if tracked.done:
+                return
+            tracked.state = state
+            tracked.error = error
+            tracked.finished = time.monotonic()
+            self._stats[state] += 1
+        if tracked.filter is not None:
+            try:
+                tracked.filter.DestroyPropertyFilter()
+            except Exception as ept:   # pylint: disable=broad-except
+                vm_logger.warning("删除任务过滤器失败 %s", ept)
+        if state == 'success':
+            vm_logger.info("TASK: %s, SUCCESS", tracked.msg)
+            tracked.future.set_result((True, state))
+        else:
+            vm_logger.error("TASK: %s, 出现错误 %s", tracked.msg, error)
+            tracked.future.set_result((False, error))
+
+    def _apply(self, update_set):
+        with self._lock:
+            by_task = {i.task_id: i for i in self._tasks.values() if not i.done}
+        for filter_update in update_set.filterSet or []:
+            for obj_update in filter_update.objectSet or []:
+                tracked = by_task.get(obj_update.obj._moId)   # pylint: disable=protected-access
+                if tracked is None:
+                    continue
+                props = {change.name: change.val for change in obj_update.changeSet or []}
+                if props.get('info.progress') is not None:
+                    tracked.progress = props['info.progress']
+                if props.get('info.descriptionId'):
+                    tracked.description = props['info.descriptionId']
+                if 'info.result' in props:
+                    tracked.result = props['info.result']
+                state = props.get('info.state', tracked.state)
+                if state == 'success':
+                    self._finish(tracked, 'success')
+                elif state == 'error':
+                    error = props.get('info.error')
+                    self._finish(tracked, 'error', getattr(error, 'msg', None) or str(error))
+                else:
+                    tracked.state = state
+
+    def _expire(self):
+        '''
+        @description: 超时的任务返回失败并取消vCenter中的任务，清理超过保留时间的已结束任务
+        '''
+        now = time.monotonic()
+        for tracked in list(self._tasks.values()):
+            if not tracked.done and tracked.deadline and now >= tracked.deadline:
+                try:
+                    tracked.task.CancelTask()
+                except Exception as ept:   # pylint: disable=broad-except
+                    vm_logger.warning("取消超时任务失败 %s %s", tracked.task_id, ept)
+                self._finish(tracked, 'timeout', "timeout")
+        with self._lock:
+            for task_id in [i.task_id for i in self._tasks.values() if i.done and now - i.finished > self.retention]:
+                del self._tasks[task_id]
+
+    def _wait_seconds(self):
+        deadlines = [i.deadline for i in self._tasks.values() if not i.done and i.deadline]
+        wait = self.poll_wait
+        if deadlines:
+            wait = min(wait, max(0, min(deadlines) - time.monotonic()))
+        return max(1, int(wait))
+
+    def _release(self, session):
+        if session is not None:
+            self._collector = None
+            self.pool.release(session)
+
+    def _run(self):
+        '''
+        @description: 后台线程主循环，借出会话、重新登录失败时按指数退避重试，期间超时的任务照常结束
+        '''
+        session = None
+        retries = 0
+        try:
+            while True:
+                with self._lock:
+                    new, self._new = self._new, []
+                    pending = any(not i.done for i in self._tasks.values())
+                if not pending and not new:
+                    self._event.wait()   # 没有任务时不访问vCenter
+                    self._event.clear()
+                    continue
+                self._event.clear()
+                try:
+                    if session is None:
+                        session = self.pool.acquire()
+                    if self._collector is None:
+                        self._create_collector(session.content)
+                        continue
+                    for tracked in new:
+                        self._add_filter(tracked)
+                    options = vmodl.query.PropertyCollector.WaitOptions(maxWaitSeconds=self._wait_seconds())
+                    self._waiting = True
+                    try:
+                        update_set = self._collector.WaitForUpdatesEx(self._version, options)
+                    finally:
+                        self._waiting = False
+                    self._stats['waits'] += 1
+                    if update_set is not None:
+                        self._version = update_set.version
+                        self._apply(update_set)
+                    retries = 0
+                except vmodl.fault.RequestCanceled:
+                    pass
+                except (vim.fault.NotAuthenticated, vmodl.query.InvalidCollectorVersion, vmodl.fault.ManagedObjectNotFound) as ept:
+                    vm_logger.warning("任务跟踪的PropertyCollector失效，重新注册 %s", ept)
+                    self._collector = None
+                    if isinstance(ept, vim.fault.NotAuthenticated):
+                        try:
+                            self.pool.relogin(session)
+                        except Exception as relogin_ept:   # pylint: disable=broad-except
+                            vm_logger.error("任务跟踪重新登录vCenter失败 %s", relogin_ept)
+                            self._release(session)
+                            session = None
+                            retries = self._backoff(retries)
+                except Exception as ept:   # pylint: disable=broad-except
+                    vm_logger.error("任务跟踪出现错误 %s", ept)
+                    self._release(session)
+                    session = None
+                    retries = self._backoff(retries)
+                self._expire()
+        finally:
+            self._release(session)
+
+    def _backoff(self, retries):
+        '''
+        @description: 出错后等待一段时间再重试，等待时间按次数翻倍，但不超过最近任务的超时时间
+        '''
+        wait = min(self.retry_max, self.poll_wait * 2 ** retries)
+        deadlines = [i.deadline for i in self._tasks.values() if not i.done and i.deadline]
+        if deadlines:
+            wait = min(wait, max(0, min(deadlines) - time.monotonic()))
+        time.sleep(wait)
+        return retries + 1
+
+    def get_stats(self):
+        with self._lock:
+            stats = dict(self._stats)
+            stats['running'] = sum(1 for i in self._tasks.values() if not i.done)
+        return stats
+
+
+_task_tracker = None
+_task_tracker_lock = threading.Lock()
+
+def get_task_tracker():
+    '''
+    @description: 获取进程内共享的任务跟踪器
+    '''
+    global _task_tracker   # pylint: disable=global-statement
+    with _task_tracker_lock:
+        if _task_tracker is None:
+            _task_tracker = TaskTracker(
+                get_session_pool(),
+                poll_wait=get_task_setting('TASK_POLL_WAIT'),
+                retention=get_task_setting('TASK_RETENTION'),
+                retry_max=get_task_setting('TASK_RETRY_MAX'),
+            )
+        return _task_tracker
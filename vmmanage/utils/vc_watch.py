@@ -0,0 +1,191 @@
+#!/usr/bin/env python
+# -*- coding=utf-8 -*-
+'''
+@Author: ZhaoLiang
+@Email: zhaoliang@hupu.com
+@Description: 基于WaitForUpdatesEx的虚拟机增量同步
+    使用单独的PropertyCollector在所有虚拟机上注册过滤器，只把变更的属性(电源状态、IP、CPU、内存等)和删除写入Vminfo
+    每批变更写入后保存版本号，重启后从保存的版本继续；版本号失效(如会话重建)时从头获取一次完整的初始数据
+@FilePath: /Galilee/vmmanage/utils/vc_watch.py
+'''
+import time
+import logging
+import threading
+from pyVmomi import vim, vmodl  #pylint: disable=no-name-in-module
+from django.conf import settings
+from django.db import transaction
+from vmmanage.models import Vminfo, VcWatermark
+from vmmanage.utils.vm_sync import VC_PROPERTIES, vc_fields, vc_row, upsert_vms
+
+vm_logger = logging.getLogger('optVm')
+
+DEFAULT_WATCH_SETTINGS = {
+    'WATCH_MAX_WAIT': 60,        # 每次WaitForUpdatesEx最长等待秒数，同时起到会话保活的作用
+    'WATCH_MAX_OBJECTS': 500,    # 每次最多返回的对象数，初始数据较多时分多次返回
+    'WATCH_RETRY_BASE': 5,       # 连接vCenter失败后第一次重试的等待秒数，之后每次翻倍
+    'WATCH_RETRY_MAX': 60,       # 重试的最长间隔秒数
+}
+
+
+def get_watch_setting(name):
+    '''
+    @description: 获取settings文件VMMANGE中的增量同步配置，未配置时使用默认值
+    '''
+    settings_dict = getattr(settings, 'VMMANGE', {})
+    return settings_dict.get(name, DEFAULT_WATCH_SETTINGS[name])
+
+
+class InventoryWatcher():
+    """ 监听vCenter中虚拟机的变更并写入数据库，run()会一直运行直到调用stop() """
+    def __init__(self, pool, max_wait=60, max_objects=500, retry_base=5, retry_max=60):
+        self.pool = pool
+        self.max_wait = max_wait
+        self.max_objects = max_objects
+        self.retry_base = retry_base
+        self.retry_max = retry_max
+        self._stop = threading.Event()
+        self._collector = None
+        self._view = None
+        self._seen = None   # 获取完整初始数据期间出现过的虚拟机moId，结束后删除数据库中已经不存在的虚拟机
+        self.stats = {'updates': 0, 'created': 0, 'updated': 0, 'deleted': 0, 'resets': 0, 'retries': 0}
+
+    def stop(self):
+        '''
+        @description: 停止监听，正在等待的WaitForUpdatesEx会被取消
+        '''
+        self._stop.set()
+        collector = self._collector
+        if collector is not None:
+            try:
+                collector.CancelWaitForUpdates()
+            except Exception as ept:   # pylint: disable=broad-except
+                vm_logger.warning("取消WaitForUpdatesEx失败 %s", ept)
+
+    def _create_filter(self, content):
+        '''
+        @description: 创建单独的PropertyCollector，避免和共享会话中其他查询的过滤器互相影响
+        '''
+        self._collector = content.propertyCollector.CreatePropertyCollector()
+        self._view = content.viewManager.CreateContainerView(content.rootFolder, [vim.VirtualMachine], True)
+        traversal = vmodl.query.PropertyCollector.TraversalSpec(name='traverseView', path='view', skip=False, type=vim.view.ContainerView)
+        obj_spec = vmodl.query.PropertyCollector.ObjectSpec(obj=self._view, skip=True, selectSet=[traversal])
+        prop_spec = vmodl.query.PropertyCollector.PropertySpec(type=vim.VirtualMachine, pathSet=VC_PROPERTIES, all=False)
+        filter_spec = vmodl.query.PropertyCollector.FilterSpec(objectSet=[obj_spec], propSet=[prop_spec])
+        self._collector.CreateFilter(filter_spec, partialUpdates=False)
+
+    def _destroy_filter(self):
+        for obj, method in [(self._collector, 'DestroyPropertyCollector'), (self._view, 'Destroy')]:
+            if obj is not None:
+                try:
+                    getattr(obj, method)()
+                except Exception as ept:   # pylint: disable=broad-except
+                    vm_logger.warning("清理PropertyCollector失败 %s", ept)
+        self._collector = self._view = None
+
+    def apply(self, update_set):
+        '''
+        @description: 将一批变更写入数据库，新出现的虚拟机新增或整行更新，已有的只更新变更的字段，离开的删除
+        @return: {"created": 新增数, "updated": 更新数, "deleted": 删除数}
+        '''
+        rows, changes, removed = [], {}, []
+        for filter_update in update_set.filterSet or []:
+            for obj_update in filter_update.objectSet or []:
+                mo_id = obj_update.obj._moId   # pylint: disable=protected-access
+                props = {change.name: change.val for change in obj_update.changeSet or [] if change.op != 'remove'}
+                if self._seen is not None:
+                    self._seen.add(mo_id)
+                if obj_update.kind == 'leave' or props.get('config.template'):
+                    removed.append(mo_id)
+                elif obj_update.kind == 'enter':
+                    row = vc_row(obj_update.obj, props)
+                    if row is not None:
+                        rows.append(row)
+                else:
+                    fields = vc_fields(props)
+                    fields.pop('instanceUuid', None)
+                    if fields:
+                        changes.setdefault(mo_id, {}).update(fields)
+        res = {'created': 0, 'updated': 0, 'deleted': 0}
+        with transaction.atomic():
+            if rows:
+                upserted = upsert_vms(rows)
+                res['created'] += len(upserted['created'])
+                res['updated'] += len(upserted['updated'])
+            for mo_id, fields in changes.items():
+                res['updated'] += Vminfo.objects.filter(moid=mo_id).update(**fields)
+            if removed:
+                res['deleted'] += Vminfo.objects.filter(moid__in=removed).delete()[0]
+            if self._seen is not None and not update_set.truncated:
+                # 完整的初始数据已经全部返回，删除停止监听期间被删除的虚拟机
+                res['deleted'] += Vminfo.objects.exclude(moid='').exclude(moid__in=self._seen).delete()[0]
+                self._seen = None
+        return res
+
+    def _save_version(self, watermark, version):
+        watermark.version = version
+        watermark.save(update_fields=['version', 'update_time'])
+
+    def _backoff(self, retries, ept):
+        '''
+        @description: 出错后等待一段时间再重试，等待时间按次数翻倍，不超过retry_max，调用stop()时立即返回
+        '''
+        wait = min(self.retry_max, self.retry_base * 2 ** retries)
+        self.stats['retries'] += 1
+        vm_logger.error("监听vCenter虚拟机变更出错，%ss后第%s次重试 %s", wait, retries + 1, ept)
+        self._stop.wait(wait)
+        return retries + 1
+
+    def run(self):
+        '''
+        @description: 循环调用WaitForUpdatesEx，直到调用stop()；连接、重新登录或写入失败时按指数退避重试，不会退出
+        '''
+        session = None
+        retries = 0
+        watermark, _ = VcWatermark.objects.get_or_create(host=self.pool.host)
+        version = watermark.version
+        options = vmodl.query.PropertyCollector.WaitOptions(maxWaitSeconds=self.max_wait, maxObjectUpdates=self.max_objects)
+        vm_logger.info("开始监听vCenter虚拟机变更 %s version:%s", self.pool.host, version or '-')
+        try:
+            while not self._stop.is_set():
+                try:
+                    if session is None:
+                        session = self.pool.acquire()
+                    if self._collector is None:
+                        self._create_filter(session.content)
+                    if not version:
+                        self._seen = set()
+                    try:
+                        update_set = self._collector.WaitForUpdatesEx(version, options)
+                    except vmodl.query.InvalidCollectorVersion:
+                        vm_logger.warning("PropertyCollector版本号 %s 已失效，重新获取完整数据", version)
+                        version = ''
+                        self.stats['resets'] += 1
+                        continue
+                    except vmodl.fault.RequestCanceled:
+                        continue
+                    except vim.fault.NotAuthenticated:
+                        self._destroy_filter()
+                        self.pool.relogin(session)   # 重新登录失败时按其他错误处理
+                        continue
+                    retries = 0
+                    if update_set is None:   # 等待超时，没有变更
+                        continue
+                    start = time.monotonic()
+                    res = self.apply(update_set)
+                    version = update_set.version
+                    self._save_version(watermark, version)
+                    self.stats['updates'] += 1
+                    for key, value in res.items():
+                        self.stats[key] += value
+                    vm_logger.info("应用vCenter虚拟机变更 %s version:%s 耗时 %.3fs", res, version, time.monotonic() - start)
+                except Exception as ept:   # pylint: disable=broad-except
+                    self._destroy_filter()
+                    if session is not None:
+                        self.pool.release(session)
+                        session = None
+                    retries = self._backoff(retries, ept)
+        finally:
+            self._destroy_filter()
+            if session is not None:
+                self.pool.release(session)
+        return self.stats
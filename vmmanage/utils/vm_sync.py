@@ -0,0 +1,146 @@
+#!/usr/bin/env python
+# -*- coding=utf-8 -*-
+'''
+@Author: your name
+@Email: zhaoliang@hupu.com
+@Description: 虚拟机信息批量同步到数据库
+@FilePath: /Galilee/vmmanage/utils/vm_sync.py
+'''
+import time
+import math
+import logging
+from pyVmomi import vim   #pylint: disable=no-name-in-module
+from django.db import transaction
+from vmmanage.models import Vminfo
+from Galilee.batch import chunked, merge_rows, batch_results, validate_rows, check_items
+from vmmanage.utils.common import LoginVC
+from vmmanage.utils.vc_inventory import retrieve_properties, get_inventory_setting
+
+vm_logger = logging.getLogger('optVm')
+
+VM_FIELDS = ['vmname', 'cpus', 'memorys', 'disk', 'cn', 'os', 'hostname', 'ip', 'dead_time', 'user', 'moid', 'power_state']
+
+# 从vCenter同步时读取的属性
+VC_PROPERTIES = [
+    'name',
+    'config.template',
+    'config.instanceUuid',
+    'config.hardware.numCPU',
+    'config.hardware.memoryMB',
+    'config.hardware.device',
+    'runtime.powerState',
+    'guest.ipAddress',
+    'guest.hostName',
+    'guest.guestFullName',
+]
+
+
+def upsert_vms(rows):
+    '''
+    @description: 按instanceUuid新增或更新虚拟机，只更新行中提供的字段
+    @return: {"created": [instanceUuid], "updated": [instanceUuid]}
+    '''
+    rows = merge_rows(rows, 'instanceUuid')
+    existing = Vminfo.objects.in_bulk(list(rows), field_name='instanceUuid')
+    to_create, to_update, update_fields = [], [], set()
+    for instance_uuid, row in rows.items():
+        values = {field: row[field] for field in VM_FIELDS if field in row}
+        if instance_uuid in existing:
+            obj = existing[instance_uuid]
+            for field, value in values.items():
+                setattr(obj, field, value)
+            update_fields.update(values)
+            to_update.append(obj)
+        else:
+            to_create.append(Vminfo(instanceUuid=instance_uuid, **values))
+    with transaction.atomic():
+        Vminfo.objects.bulk_create(to_create)
+        if update_fields:
+            Vminfo.objects.bulk_update(to_update, list(update_fields))
+    return {'created': [i.instanceUuid for i in to_create], 'updated': [i.instanceUuid for i in to_update]}
+
+
+def batch_upsert_vms(items):
+    '''
+    @description: 批量同步虚拟机信息，单个事务内完成，每一项按Vminfo的字段校验，校验失败的项返回error
+    @param {type} items: [{"instanceUuid": "...", "vmname": "test", "cpus": 2, "memorys": 4, ...}]
+    @return: [{"instanceUuid": "...", "status": "created/updated/error", "msg": "..."}]
+    '''
+    errors = check_items(items, 'instanceUuid', VM_FIELDS + ['instanceUuid'])
+    rows = {index: dict(item) for index, item in enumerate(items) if index not in errors}
+    errors.update(validate_rows(Vminfo, rows, 'instanceUuid'))
+    rows = [row for index, row in rows.items() if index not in errors]
+    res = upsert_vms(rows) if rows else {'created': [], 'updated': []}
+    vm_logger.info("批量同步虚拟机信息 新增:%s 更新:%s 错误:%s", len(res['created']), len(res['updated']), len(errors))
+    return batch_results(items, 'instanceUuid', errors, res)
+
+
+def vc_fields(props):
+    '''
+    @description: 将PropertyCollector取回的属性转换为Vminfo的字段，只转换props中有值的属性，增量更新时也使用
+    内存、磁盘单位为GB，和创建虚拟机时一致；虚拟机关机时guest属性为空，保留数据库中原有的值
+    '''
+    fields = {}
+    if props.get('config.instanceUuid'):
+        fields['instanceUuid'] = props['config.instanceUuid']
+    if props.get('name'):
+        fields['vmname'] = props['name'][:50]
+    if props.get('config.hardware.numCPU') is not None:
+        fields['cpus'] = props['config.hardware.numCPU']
+    if props.get('config.hardware.memoryMB') is not None:
+        fields['memorys'] = math.ceil(props['config.hardware.memoryMB'] / 1024)
+    if props.get('config.hardware.device') is not None:
+        disk_kb = sum(i.capacityInKB for i in props['config.hardware.device'] if isinstance(i, vim.vm.device.VirtualDisk))
+        fields['disk'] = math.ceil(disk_kb / 1024 / 1024)
+    if props.get('runtime.powerState'):
+        fields['power_state'] = str(props['runtime.powerState'])
+    for field, prop, length in [('ip', 'guest.ipAddress', None), ('hostname', 'guest.hostName', 50), ('os', 'guest.guestFullName', 40)]:
+        if props.get(prop):
+            fields[field] = props[prop][:length]
+    return fields
+
+
+def vc_row(obj, props):
+    '''
+    @description: 虚拟机的完整同步行，模板和没有配置信息(无法访问)的虚拟机返回None
+    '''
+    if props.get('config.template') or not props.get('config.instanceUuid'):
+        return None
+    row = vc_fields(props)
+    row['moid'] = obj._moId   # pylint: disable=protected-access
+    return row
+
+
+@LoginVC(need_content=True)
+def sync_vc_inventory(chunk_size=500, content=None):
+    '''
+    @description: 通过一次分页的PropertyCollector查询读取vCenter中所有虚拟机，按instanceUuid分批写入数据库
+    全部读取完成后按moid删除vCenter中已经不存在(或已转为模板)的虚拟机，没有moid的手工录入数据不处理
+    @return: {"created": 新增数, "updated": 更新数, "deleted": 删除数, "skipped": 跳过的模板等, "elapsed": 耗时秒数}
+    '''
+    start = time.monotonic()
+    res = {'created': 0, 'updated': 0, 'deleted': 0, 'skipped': 0}
+    rows = []
+    seen = set()
+    for obj, props in retrieve_properties(content, [vim.VirtualMachine], VC_PROPERTIES, get_inventory_setting('INVENTORY_PAGE_SIZE')):
+        row = vc_row(obj, props)
+        if row is None:
+            res['skipped'] += 1
+            continue
+        seen.add(row['moid'])
+        rows.append(row)
+        if len(rows) >= chunk_size:
+            chunk = upsert_vms(rows)
+            res['created'] += len(chunk['created'])
+            res['updated'] += len(chunk['updated'])
+            rows = []
+    if rows:
+        chunk = upsert_vms(rows)
+        res['created'] += len(chunk['created'])
+        res['updated'] += len(chunk['updated'])
+    stale = set(Vminfo.objects.exclude(moid='').values_list('moid', flat=True)) - seen
+    for chunk in chunked(sorted(stale), chunk_size):
+        res['deleted'] += Vminfo.objects.filter(moid__in=chunk).delete()[0]
+    res['elapsed'] = round(time.monotonic() - start, 3)
+    vm_logger.info("从vCenter同步虚拟机 %s", res)
+    return res
@@ -19,6 +19,10 @@ from pyVmomi import vim   # pylint: disable=no-name-in-module
 from vmmanage.serializers import VminfoSerializer
 from vmmanage.models import Vminfo
 from vmmanage.utils.opt_vc import VirtualNet, OptVM
+from vmmanage.utils.vm_sync import batch_upsert_vms, sync_vc_inventory
+from vmmanage.utils.vc_session import get_session_pool
+from vmmanage.utils.vc_inventory import inventory_index
+from vmmanage.utils.vc_task import get_task_tracker
 
 
 views_logger = logging.getLogger("galilee")
@@ -31,14 +35,63 @@ class VminfoViewSet(viewsets.ModelViewSet):
 
     @action(methods=['post'], detail=False, permission_classes=[permissions.IsAuthenticated])
     def sync_vm(self, request, *args, **kwargs):
-        """ 将vCenter中的虚拟机信息同步到系统 """
+        """
+        将vCenter中的虚拟机信息同步到系统
+        提交列表时批量同步，返回每一项的 created/updated/error 结果
+        """
         args = request.data
+        if isinstance(args, list):
+            res = batch_upsert_vms(args)
+            return Response({"status": True, "msg": "success", "obj": res})
         views_logger.info(args)
         query, status = Vminfo.objects.get_or_create(instanceUuid=args['instanceUuid'], defaults=args)
         views_logger.info("系统同步到VM信息 name:%s - %s", query.vmname, status)
         ser = self.get_serializer(query)
         return Response(ser.data)
 
+    @action(methods=['post'], detail=False, permission_classes=[permissions.IsAuthenticated])
+    def sync_vc(self, request, *args, **kwargs):
+        """
+        从vCenter批量同步所有虚拟机到系统，模板不同步，vCenter中已不存在的虚拟机从系统删除
+        :param {"chunk_size": 500}
+        """
+        res = sync_vc_inventory(chunk_size=int(request.data.get('chunk_size', 500)))
+        return Response({"status": True, "msg": "success", "obj": res})
+
+    @action(methods=['get'], detail=False, permission_classes=[permissions.IsAuthenticated])
+    def vc_sessions(self, request, *args, **kwargs):
+        """ vCenter会话池的会话数、登录次数和复用率 """
+        return Response(get_session_pool().get_stats())
+
+    @action(methods=['get'], detail=False, permission_classes=[permissions.IsAuthenticated])
+    def vc_inventory(self, request, *args, **kwargs):
+        """ vCenter对象索引的命中率、加载次数和各类型对象数 """
+        return Response(inventory_index.get_stats())
+
+    @action(methods=['get'], detail=False, permission_classes=[permissions.IsAuthenticated])
+    def vc_tasks(self, request, *args, **kwargs):
+        """
+        正在跟踪的vCenter任务的状态和进度
+        :param ?id=task-123 只查询一个任务，不传时返回所有任务和统计
+        """
+        tracker = get_task_tracker()
+        task_id = request.query_params.get('id')
+        if task_id:
+            tracked = tracker.get(task_id)
+            if tracked is None:
+                return Response({"status": False, "msg": "任务不存在 " + task_id})
+            return Response({"status": True, "msg": "success", "obj": tracked.to_dict()})
+        return Response({"status": True, "msg": "success", "obj": {"tasks": tracker.list(), "stats": tracker.get_stats()}})
+
+    @action(methods=['post'], detail=False, permission_classes=[permissions.IsAuthenticated])
+    def cancel_vc_task(self, request, *args, **kwargs):
+        """
+        取消vCenter任务
+        :param {"id": "task-123"}
+        """
+        status, msg = get_task_tracker().cancel(request.data.get('id'))
+        return Response({"status": status, "msg": msg})
+
     def create(self, request, *args, **kwargs):
         # test = OptVM("ceshi")
         # print(test.del_virtual_device(opt_obj='nic', obj_number=2))